@@ -1,48 +1,109 @@
+import os
 from flask import Flask, render_template
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from services.stripe_service import init_stripe
+from services.password_service import password_hasher
 from utils.error_handlers import register_error_handlers
+from utils.instrumentation import instrumentation
+from utils.rate_limit import rate_limiter
+from utils.db_routing import RoutingSession, replica_router
 
-db = SQLAlchemy()
-migrate = Migrate()
-bcrypt = Bcrypt()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 jwt = JWTManager()
 
-def create_app(config_name='development'):
+def create_app(config_name='development', config_overrides=None):
     app = Flask(__name__, template_folder='templates')
     CORS(app)
 
     # Load configuration
     app.config.from_object(f'config.{config_name.capitalize()}Config')
+    if config_overrides:
+        app.config.update(config_overrides)
+    missing = [name for name in app.config.get('REQUIRED_SETTINGS', ()) if not app.config.get(name)]
+    if missing:
+        raise ValueError(f'Required settings are not set: {", ".join(missing)}')
+    hops = app.config.get('PROXY_FIX_HOPS', 0)
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
     
     # Initialize extensions
     db.init_app(app)
-    migrate.init_app(app, db)
-    bcrypt.init_app(app)
+    replica_router.init_app(app)
+    if not app.config.get('FAST_START', False):
+        # Alembic is only needed by the `db` commands; manage.py builds
+        # the app with FAST_START off.
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    password_hasher.init_app(app)
     jwt.init_app(app)
+    instrumentation.init_app(app)
+    rate_limiter.init_app(app)
+
+    from services.token_service import revocation_filter
+    revocation_filter.init_app(app)
     
-    # Initialize Stripe
-    with app.app_context():
-        init_stripe()
+    # The Stripe gateway is built on first use
+    init_stripe(app)
     
+    # Caches and write-behind buffers
+    from services.entitlement_service import entitlement_cache
+    from services.metrics_service import metrics_buffer
+    from services.device_service import device_activity
+    from services.webhook_service import stripe_event_worker
+    from services.analytics_service import global_counters
+    from services.push_service import push_hub
+    from services.rules_service import rule_bundles
+    entitlement_cache.init_app(app)
+    metrics_buffer.init_app(app)
+    device_activity.init_app(app)
+    stripe_event_worker.init_app(app)
+    global_counters.init_app(app)
+    push_hub.init_app(app)
+    rule_bundles.init_app(app)
+
     # Register blueprints
     from routes.auth import auth_bp
     from routes.subscription import subscription_bp
     from routes.device import device_bp
     from routes.user import user_bp
+    from routes.metrics import metrics_bp
+    from routes.session import session_bp
+    from routes.internal import internal_bp
+    from routes.admin import admin_bp
+    from routes.push import push_bp
+    from routes.rules import rules_bp
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(subscription_bp, url_prefix='/subscription')
     app.register_blueprint(device_bp, url_prefix='/devices')
     app.register_blueprint(user_bp, url_prefix='/user')
+    app.register_blueprint(metrics_bp, url_prefix='/metrics')
+    app.register_blueprint(session_bp, url_prefix='/session')
+    app.register_blueprint(internal_bp, url_prefix='/internal')
+    app.register_blueprint(admin_bp, url_prefix='/admin')
+    app.register_blueprint(push_bp, url_prefix='/push')
+    app.register_blueprint(rules_bp, url_prefix='/rules')
     # Register error handlers
     register_error_handlers(app)
     
     return app
 
+def preload_app(app):
+    # For servers that build the app once and fork workers from it
+    # (gunicorn --preload, see wsgi.py): do the deferred imports and the
+    # mapper configuration in the parent so every worker shares them
+    # copy-on-write, and give each worker its own database connections.
+    import stripe  # noqa: F401
+    import services.stripe_gateway  # noqa: F401
+    from sqlalchemy.orm import configure_mappers
+    configure_mappers()
+    with app.app_context():
+        engines = list(db.engines.values())
+    os.register_at_fork(after_in_child=lambda: [engine.dispose(close=False) for engine in engines])
+    return app
+
 if __name__ == '__main__':
     app = create_app()
     app.run(debug=True)
\ No newline at end of file
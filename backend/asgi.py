@@ -0,0 +1,138 @@
+from quart import Quart, jsonify
+from quart_cors import cors
+from hypercorn.middleware import AsyncioWSGIMiddleware, ProxyFixMiddleware
+from hypercorn.middleware.wsgi import MAX_BODY_SIZE
+from werkzeug.exceptions import HTTPException
+from app import create_app
+from services.async_db import async_db
+from utils.rate_limit import rate_limiter
+from services.stripe_gateway import AsyncStripeGateway, DEFAULT_ASYNC_THREADS
+
+# ASGI serving mode: the auth, subscription, device, user and push routes as async
+# handlers on one event loop, e.g.
+#
+#     WEB_CONCURRENCY=4 hypercorn --workers 4 --bind 0.0.0.0:5000 "asgi:create_asgi_app('production')"
+#
+# Idle keep-alive connections and open /push/stream streams cost no thread.
+# Blocking work is bounded:
+#   - database I/O goes through the async engine's pool (ASYNC_DB_POOL_SIZE)
+#   - Stripe calls use STRIPE_ASYNC_THREADS threads
+#   - bcrypt uses the password hasher's pool, a WEB_CONCURRENCY share of
+#     the node's cores; hypercorn's workers are daemonic and cannot start
+#     processes, so under hypercorn this is a thread pool (bcrypt releases
+#     the GIL)
+#   - rate limit bucket takes and write-behind buffer adds, which may
+#     flush a full buffer through the sync engine, run via asyncio.to_thread
+#
+# The remaining blueprints (/metrics, /session, /rules, /admin and
+# /internal) have no async port; their requests, and /user/export, which
+# streams through the sync engine, are handed to the wrapped Flask app. It
+# runs them in the loop's default executor.
+#
+# Configuration, JWT settings, the entitlement cache and the write-behind
+# buffers come from the regular Flask app built by create_app(). Its
+# background threads (buffer flushers, the Stripe event worker) keep using
+# the sync engine.
+
+WSGI_PREFIXES = ('/metrics', '/session', '/rules', '/admin', '/internal', '/user/export')
+
+
+class WSGIFallback:
+    # Sends HTTP requests under `prefixes` to a WSGI app and everything else
+    # to the ASGI app.
+
+    def __init__(self, asgi_app, wsgi_app, prefixes, max_body_size=MAX_BODY_SIZE):
+        self.asgi_app = asgi_app
+        self.wsgi_app = AsyncioWSGIMiddleware(_nonempty_body(wsgi_app), max_body_size=max_body_size)
+        self.prefixes = prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and any(scope['path'] == prefix or scope['path'].startswith(prefix + '/')
+                                           for prefix in self.prefixes):
+            return await self.wsgi_app(scope, receive, send)
+        return await self.asgi_app(scope, receive, send)
+
+
+def _nonempty_body(wsgi_app):
+    # hypercorn sends the status line with the first body chunk, so a
+    # response with no chunks at all (a 304, say) would never start.
+    def app(environ, start_response):
+        body = wsgi_app(environ, start_response)
+        try:
+            empty = True
+            for chunk in body:
+                empty = False
+                yield chunk
+            if empty:
+                yield b''
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+    return app
+
+
+def create_asgi_app(config_name='development', config_overrides=None):
+    flask_app = create_app(config_name, config_overrides)
+
+    app = Quart(__name__, template_folder='templates')
+    app.config.from_mapping(flask_app.config)
+    app.extensions['flask_app'] = flask_app
+    app = cors(app, allow_origin='*')
+    app.asgi_app = WSGIFallback(app.asgi_app, flask_app, WSGI_PREFIXES,
+                                max_body_size=flask_app.config.get('MAX_CONTENT_LENGTH') or MAX_BODY_SIZE)
+    if app.config.get('PROXY_FIX_HOPS'):
+        app.asgi_app = ProxyFixMiddleware(app.asgi_app, mode='legacy', trusted_hops=app.config['PROXY_FIX_HOPS'])
+
+    async_db.init_app(app)
+    gateway = AsyncStripeGateway(
+        flask_app.extensions['stripe_gateway'],
+        max_threads=app.config.get('STRIPE_ASYNC_THREADS', DEFAULT_ASYNC_THREADS)
+    )
+    app.extensions['async_stripe_gateway'] = gateway
+
+    from async_routes.common import rate_limit
+    if rate_limiter.enabled:
+        app.before_request(rate_limit)
+
+    from async_routes.auth import auth_bp
+    from async_routes.subscription import subscription_bp
+    from async_routes.device import device_bp
+    from async_routes.user import user_bp
+    from async_routes.push import push_bp
+    app.register_blueprint(auth_bp, url_prefix='/auth')
+    app.register_blueprint(subscription_bp, url_prefix='/subscription')
+    app.register_blueprint(device_bp, url_prefix='/devices')
+    app.register_blueprint(user_bp, url_prefix='/user')
+    app.register_blueprint(push_bp, url_prefix='/push')
+
+    @app.errorhandler(HTTPException)
+    async def handle_http_error(error):
+        response = jsonify({
+            "error": {
+                "code": error.code,
+                "name": error.name,
+                "description": error.description,
+            }
+        })
+        response.status_code = error.code
+        return response
+
+    @app.errorhandler(Exception)
+    async def handle_generic_error(error):
+        app.logger.error(f'An unexpected error occurred: {str(error)}')
+        response = jsonify({
+            "error": {
+                "code": 500,
+                "name": "Internal Server Error",
+                "description": "An unexpected error occurred.",
+            }
+        })
+        response.status_code = 500
+        return response
+
+    @app.after_serving
+    async def shutdown():
+        await async_db.dispose()
+        gateway.shutdown()
+
+    return app
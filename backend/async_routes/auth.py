@@ -0,0 +1,125 @@
+import asyncio
+from quart import Blueprint, request, jsonify
+from sqlalchemy import select, or_, update
+from app import db
+from models import User
+from services.async_db import async_db
+from services.password_service import password_hasher, PasswordHasherBusy
+from services.token_service import (
+    issue_tokens_async, rotate_refresh_token_async, revoke_session_async, RefreshInProgress, RefreshTokenReused
+)
+from services.purge_service import request_account_deletion
+from async_routes.common import jwt_required, get_jwt_identity, get_jwt, flask_app, get_entitlement, conditional_get
+
+auth_bp = Blueprint('auth', __name__)
+
+@auth_bp.route('/register', methods=['POST'])
+async def register():
+    data = await request.get_json()
+    username = data.get('username')
+    email = data.get('email')
+    password = data.get('password')
+
+    async with async_db.session() as session:
+        taken = await session.execute(select(User.id).where(or_(User.username == username, User.email == email)))
+        if taken.first():
+            return jsonify({'message': 'Username or email already exists'}), 400
+
+        try:
+            password_hash = await password_hasher.hash_async(password)
+        except PasswordHasherBusy:
+            return jsonify({'message': 'Server busy, please try again'}), 503, {'Retry-After': '1'}
+        user = User(username=username, email=email, password_hash=password_hash)
+        session.add(user)
+        await session.commit()
+        access_token, refresh_token = await issue_tokens_async(session, flask_app(), user.id)
+
+    return jsonify(access_token=access_token, refresh_token=refresh_token), 201
+
+@auth_bp.route('/login', methods=['POST'])
+async def login():
+    data = await request.get_json()
+    username = data.get('username')
+    password = data.get('password')
+
+    async with async_db.session() as session:
+        user = (await session.execute(
+            select(User.id, User.password_hash).where(User.username == username, User.deletion_requested_at.is_(None))
+        )).first()
+
+        if not user:
+            return jsonify({'message': 'User not found'}), 401
+
+        try:
+            if not await password_hasher.verify_async(user.password_hash, password):
+                return jsonify({'message': 'Incorrect password'}), 401
+
+            if password_hasher.needs_rehash(user.password_hash):
+                new_hash = await password_hasher.hash_async(password)
+                await session.execute(update(User).where(User.id == user.id).values(password_hash=new_hash))
+                await session.commit()
+        except PasswordHasherBusy:
+            return jsonify({'message': 'Server busy, please try again'}), 503, {'Retry-After': '1'}
+
+        access_token, refresh_token = await issue_tokens_async(session, flask_app(), user.id)
+
+    return jsonify(access_token=access_token, refresh_token=refresh_token), 200
+
+@auth_bp.route('/user', methods=['GET'])
+@jwt_required()
+@conditional_get('user', state=lambda user_id, entitlement: entitlement['user'])
+async def get_user():
+    entitlement = await get_entitlement(get_jwt_identity())
+    if entitlement:
+        return jsonify(entitlement['user']), 200
+    return jsonify({'message': 'User not found'}), 404
+
+@auth_bp.route('/protected', methods=['GET'])
+@jwt_required()
+async def protected():
+    return jsonify({'logged_in_as': get_jwt_identity()}), 200
+
+@auth_bp.route('/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+async def refresh():
+    try:
+        async with async_db.session() as session:
+            access_token, refresh_token = await rotate_refresh_token_async(session, flask_app(), get_jwt())
+        return jsonify(access_token=access_token, refresh_token=refresh_token), 200
+    except RefreshInProgress:
+        return jsonify({'message': 'Token refresh already in progress'}), 409, {'Retry-After': '1'}
+    except RefreshTokenReused:
+        return jsonify({'message': 'Refresh token has been revoked'}), 401
+
+@auth_bp.route('/logout', methods=['POST'])
+@jwt_required()
+async def logout():
+    async with async_db.session() as session:
+        await revoke_session_async(session, flask_app(), get_jwt())
+    return jsonify({'message': 'Logged out'}), 200
+
+@auth_bp.route('/account', methods=['DELETE'])
+@jwt_required()
+async def delete_account():
+    # routes.auth.delete_account for the ASGI app.
+    user_id = int(get_jwt_identity())
+    async with async_db.session() as session:
+        password_hash = (await session.execute(select(User.password_hash).where(User.id == user_id))).scalar()
+    if password_hash is None:
+        return jsonify({'message': 'User not found'}), 404
+
+    data = await request.get_json(silent=True) or {}
+    try:
+        if not await password_hasher.verify_async(password_hash, data.get('password')):
+            return jsonify({'message': 'Incorrect password'}), 401
+    except PasswordHasherBusy:
+        return jsonify({'message': 'Server busy, please try again'}), 503, {'Retry-After': '1'}
+
+    # Queueing also revokes every refresh token family through the sync
+    # token service, so it runs in a thread.
+    deletion = await asyncio.to_thread(_request_account_deletion, flask_app(), user_id)
+    return jsonify({'message': 'Account scheduled for deletion', 'deletion': deletion}), 202
+
+def _request_account_deletion(app, user_id):
+    with app.app_context():
+        return request_account_deletion(db.session.get(User, user_id)).to_dict()
@@ -0,0 +1,121 @@
+import asyncio
+import math
+from functools import wraps
+from jwt.exceptions import ExpiredSignatureError, InvalidTokenError
+from quart import request, jsonify, current_app, g, make_response
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from services.async_db import async_db
+from services.entitlement_service import get_entitlement_async
+from services.token_service import revocation_filter
+from utils.etag import make_etag
+from utils.rate_limit import rate_limiter
+
+# Helpers shared by the ASGI blueprints. Tokens are issued and decoded by
+# flask_jwt_extended inside the wrapped Flask app's context, so both serving
+# modes accept each other's tokens and apply the same JWT settings.
+
+
+def flask_app():
+    return current_app.extensions['flask_app']
+
+
+def jwt_required(refresh=False):
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            header = request.headers.get('Authorization', '')
+            if not header.startswith('Bearer '):
+                return jsonify({'msg': 'Missing Authorization Header'}), 401
+            try:
+                with flask_app().app_context():
+                    claims = decode_token(header[len('Bearer '):])
+            except ExpiredSignatureError:
+                return jsonify({'msg': 'Token has expired'}), 401
+            except (InvalidTokenError, JWTExtendedException) as e:
+                return jsonify({'msg': str(e)}), 422
+            if await is_revoked(claims):
+                return jsonify({'msg': 'Token has been revoked'}), 401
+            expected = 'refresh' if refresh else 'access'
+            if claims.get('type') != expected:
+                return jsonify({'msg': f'Only {expected} tokens are allowed'}), 422
+            g.jwt = claims
+            return await view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def rate_limit():
+    # utils.rate_limit's before_request hook for the ASGI app. A bucket take
+    # is a BEGIN IMMEDIATE transaction on the node-local store that can wait
+    # up to RATE_LIMIT_LOCK_TIMEOUT for the write lock, so it runs in a
+    # thread rather than on the loop.
+    policy, limits = rate_limiter.limits_for(request.endpoint, request.method)
+    if not limits:
+        return None
+    identity = None
+    if any(limit['key'] != 'ip' for limit in limits):
+        identity = _token_identity()
+    retry_after = await asyncio.to_thread(rate_limiter.check, request.endpoint, request.method, request.remote_addr,
+                                          identity, request.view_args)
+    if retry_after is None:
+        return None
+    return jsonify({'message': 'Too many requests'}), 429, {'Retry-After': str(max(1, math.ceil(retry_after)))}
+
+
+def _token_identity():
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    try:
+        with flask_app().app_context():
+            return decode_token(header[len('Bearer '):])['sub']
+    except (InvalidTokenError, JWTExtendedException):
+        return None
+
+
+async def is_revoked(claims):
+    # revocation_filter.is_revoked without the synchronous refresh query.
+    if revocation_filter.sync_due():
+        async with async_db.session() as session:
+            await revocation_filter.maybe_sync_async(session)
+    return revocation_filter.contains(claims)
+
+
+def get_jwt_identity():
+    return g.jwt['sub']
+
+
+def get_jwt():
+    return g.jwt
+
+
+async def get_entitlement(user_id):
+    async with async_db.session() as session:
+        return await get_entitlement_async(session, user_id)
+
+
+def conditional_get(scope, extra=None, state=None):
+    # utils.etag.conditional_get for async views.
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return await view(*args, **kwargs)
+            user_id = int(get_jwt_identity())
+            entitlement = await get_entitlement(user_id)
+            if entitlement is None:
+                return await view(*args, **kwargs)
+
+            etag = make_etag(scope, user_id, entitlement, extra, state)
+            if request.if_none_match.contains(etag):
+                response = await make_response('', 304)
+            else:
+                response = await make_response(await view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
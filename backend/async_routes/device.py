@@ -0,0 +1,99 @@
+import asyncio
+from quart import Blueprint, request, jsonify, current_app
+from sqlalchemy import select, delete
+from models import Device
+from services.async_db import async_db
+from services.entitlement_service import invalidate_entitlement, version_bump
+from services.analytics_service import global_counters, DEVICES
+from services.push_service import push_hub, DEVICES_CHANGED
+from services.device_service import (
+    device_activity, serialize_devices, register_user_device_async, pending_heartbeats,
+    DEVICE_CREATED, DEVICE_EXISTS, DEVICE_OWNED_ELSEWHERE, SUBSCRIPTION_REQUIRED
+)
+from async_routes.common import jwt_required, get_jwt_identity, get_entitlement, conditional_get
+
+device_bp = Blueprint('device', __name__)
+
+@device_bp.route('/register', methods=['POST'])
+@jwt_required()
+async def register_device():
+    current_user_id = int(get_jwt_identity())
+    data = await request.get_json() or {}
+    device_id = data.get('device_id')
+    device_name = data.get('device_name', 'Unknown Device')
+
+    if not device_id:
+        return jsonify({'message': 'device_id is required'}), 400
+
+    try:
+        async with async_db.session() as session:
+            outcome, device_pk = await register_user_device_async(session, current_user_id, device_id, device_name)
+    except Exception as e:
+        current_app.logger.error(f'Error in register_device: {str(e)}')
+        return jsonify({'error': 'An unexpected error occurred'}), 500
+
+    if outcome == DEVICE_CREATED:
+        return jsonify({'message': 'Device registered successfully', 'id': device_pk}), 201
+    if outcome == DEVICE_EXISTS:
+        return jsonify({'message': 'Device already registered', 'id': device_pk}), 200
+    if outcome == DEVICE_OWNED_ELSEWHERE:
+        return jsonify({'message': 'Device is registered to another account'}), 409
+    if outcome == SUBSCRIPTION_REQUIRED:
+        return jsonify({'message': 'Active subscription required'}), 403
+    return jsonify({'message': 'Device limit reached'}), 403
+
+@device_bp.route('/list', methods=['GET'])
+@jwt_required()
+@conditional_get('devices', extra=lambda user_id, entitlement: pending_heartbeats(entitlement['device_ids']))
+async def get_devices():
+    current_user_id = int(get_jwt_identity())
+    entitlement = await get_entitlement(current_user_id)
+    if not entitlement:
+        return jsonify({'error': 'User not found'}), 404
+
+    devices = []
+    if entitlement['device_ids']:
+        async with async_db.session() as session:
+            devices = (await session.scalars(select(Device).where(Device.user_id == current_user_id))).all()
+    subscription = entitlement['subscription']
+
+    return jsonify({
+        'devices': serialize_devices(devices),
+        'device_limit': subscription['device_limit'] if subscription else 0
+    }), 200
+
+@device_bp.route('/remove/<int:device_id>', methods=['DELETE'])
+@jwt_required()
+async def remove_device(device_id):
+    current_user_id = int(get_jwt_identity())
+    async with async_db.session() as session:
+        result = await session.execute(
+            delete(Device).where(Device.id == device_id, Device.user_id == current_user_id)
+        )
+        if not result.rowcount:
+            return jsonify({'error': 'Device not found'}), 404
+        await session.execute(version_bump([current_user_id]))
+        await global_counters.add_async(session, {DEVICES: -1})
+        await session.commit()
+    invalidate_entitlement(current_user_id)
+    push_hub.publish(current_user_id, DEVICES_CHANGED)
+
+    return jsonify({'message': 'Device removed successfully'}), 200
+
+@device_bp.route('/update-activity/<int:device_id>', methods=['POST'])
+@jwt_required()
+async def update_device_activity(device_id):
+    current_user_id = int(get_jwt_identity())
+    entitlement = await get_entitlement(current_user_id)
+
+    if entitlement and device_id not in entitlement['device_ids']:
+        invalidate_entitlement(current_user_id)
+        entitlement = await get_entitlement(current_user_id)
+
+    if not entitlement or device_id not in entitlement['device_ids']:
+        return jsonify({'error': 'Device not found'}), 404
+
+    # A full buffer flushes through the sync engine in the caller.
+    await asyncio.to_thread(device_activity.touch, device_id)
+
+    return jsonify({'message': 'Device activity updated'}), 200
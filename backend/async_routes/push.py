@@ -0,0 +1,59 @@
+import asyncio
+import time
+from quart import Blueprint, jsonify, make_response
+from services.async_db import async_db
+from services.entitlement_service import get_entitlement_async
+from services.push_service import push_hub, stream_state, format_event, format_retry, HEARTBEAT, KINDS
+from async_routes.common import jwt_required, get_jwt_identity, get_jwt, is_revoked
+
+push_bp = Blueprint('push', __name__)
+
+RECONNECT_MS = 2000
+
+@push_bp.route('/stream', methods=['GET'])
+@jwt_required()
+async def stream():
+    # routes.push.stream on the event loop: an idle stream is a parked
+    # coroutine, not a thread.
+    current_user_id = int(get_jwt_identity())
+    claims = get_jwt()
+    deadline = min(claims['exp'], time.time() + push_hub.max_stream_seconds)
+    channel = push_hub.subscribe(current_user_id, loop=asyncio.get_running_loop())
+    if channel is None:
+        return jsonify({'message': 'Too many open streams'}), 429, {'Retry-After': str(push_hub.heartbeat_interval)}
+
+    async def current_state(kinds):
+        async with async_db.session() as session:
+            entitlement = await get_entitlement_async(session, current_user_id)
+        if entitlement is None:
+            return None
+        return ''.join(format_event(kind, stream_state(kind, entitlement)) for kind in kinds)
+
+    async def events():
+        try:
+            yield format_retry(RECONNECT_MS).encode()
+            kinds = KINDS
+            while True:
+                if await is_revoked(claims):
+                    return
+                if kinds:
+                    state = await current_state(kinds)
+                    if state is None:
+                        return
+                    yield state.encode()
+                else:
+                    yield HEARTBEAT.encode()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                kinds = await channel.wait_async(min(push_hub.heartbeat_interval, remaining))
+        finally:
+            push_hub.unsubscribe(channel)
+
+    response = await make_response(events(), 200, {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    response.timeout = None
+    return response
@@ -0,0 +1,153 @@
+from datetime import datetime
+from quart import Blueprint, request, jsonify, current_app, redirect, render_template, url_for
+from sqlalchemy import select
+from stripe.error import StripeError
+from models import Subscription
+from services.async_db import async_db
+from services.entitlement_service import invalidate_entitlement, version_bump
+from services.stripe_service import checkout_session_params
+from services.webhook_service import record_event_async, stripe_event_worker
+from services.push_service import push_hub, SUBSCRIPTION_CHANGED
+from async_routes.common import jwt_required, get_jwt_identity, get_entitlement, conditional_get
+
+subscription_bp = Blueprint('subscription', __name__)
+
+def _gateway():
+    return current_app.extensions['async_stripe_gateway']
+
+@subscription_bp.route('/create-checkout-session', methods=['POST'])
+@jwt_required()
+async def create_stripe_checkout_session():
+    try:
+        entitlement = await get_entitlement(get_jwt_identity())
+        if not entitlement:
+            return jsonify({'error': 'User not found'}), 404
+
+        data = await request.get_json()
+        plan = data.get('plan')
+
+        if plan not in ['basic_monthly', 'basic_yearly', 'premium_monthly', 'premium_yearly']:
+            return jsonify({'error': 'Invalid plan'}), 400
+
+        session = await _gateway().create_checkout_session(**checkout_session_params(
+            current_app.config, entitlement['user']['id'], plan,
+            success_url=url_for('subscription.subscription_success', _external=True),
+            cancel_url=url_for('subscription.subscription_cancel', _external=True)
+        ))
+
+        return jsonify({'sessionId': session.id, 'url': session.url})
+    except Exception as e:
+        current_app.logger.error(f'Error creating checkout session: {str(e)}')
+        return jsonify({'error': 'Failed to create checkout session'}), 500
+
+@subscription_bp.route('/subscription-success')
+async def subscription_success():
+    session_id = request.args.get('session_id')
+
+    if not session_id:
+        current_app.logger.error('No session_id provided to subscription_success')
+        return jsonify({'error': 'Invalid session ID'}), 400
+
+    try:
+        checkout = await _gateway().retrieve_checkout_session(
+            session_id, expand=['subscription', 'subscription.latest_invoice']
+        )
+        user_id = int(checkout.client_reference_id)
+        stripe_subscription = checkout.subscription
+        plan = checkout.metadata.get('plan')
+
+        async with async_db.session() as session:
+            session.add(Subscription(
+                user_id=user_id,
+                plan=plan,
+                status=stripe_subscription.status,
+                device_limit=5 if plan.startswith('premium') else 1,
+                stripe_customer_id=checkout.customer,
+                stripe_subscription_id=stripe_subscription.id,
+                current_period_end=datetime.fromtimestamp(stripe_subscription.current_period_end)
+            ))
+            await session.execute(version_bump([user_id]))
+            await session.commit()
+        invalidate_entitlement(user_id)
+        push_hub.publish(user_id, SUBSCRIPTION_CHANGED)
+
+        current_app.logger.info(f'Subscription created successfully for user: {user_id}')
+        return await render_template('subscription_success.html')
+    except Exception as e:
+        current_app.logger.error(f'Error processing subscription success: {str(e)}')
+        return jsonify({'error': 'Failed to process subscription'}), 500
+
+@subscription_bp.route('/subscription', methods=['GET'])
+@jwt_required()
+@conditional_get('subscription', state=lambda user_id, entitlement: entitlement['subscription'])
+async def get_subscription():
+    entitlement = await get_entitlement(get_jwt_identity())
+    if not entitlement:
+        return jsonify({'error': 'User not found'}), 404
+
+    subscription = entitlement['subscription']
+    if not subscription:
+        return jsonify({
+            'status': 'inactive',
+            'message': 'No active subscription'
+        }), 200
+
+    return jsonify({
+        'status': subscription['status'],
+        'plan': subscription['plan'],
+        'device_limit': subscription['device_limit'],
+        'current_period_end': subscription['current_period_end']
+    }), 200
+
+@subscription_bp.route('/cancel', methods=['POST'])
+@jwt_required()
+async def cancel_subscription_route():
+    current_user_id = int(get_jwt_identity())
+    try:
+        async with async_db.session() as session:
+            subscription = (await session.scalars(
+                select(Subscription).where(Subscription.user_id == current_user_id)
+            )).first()
+            if not subscription:
+                return jsonify({'error': 'No active subscription to cancel'}), 404
+
+            stripe_subscription = await _gateway().cancel_subscription(subscription.stripe_subscription_id)
+
+            subscription.status = stripe_subscription.status
+            subscription.current_period_end = datetime.fromtimestamp(stripe_subscription.current_period_end)
+            await session.execute(version_bump([current_user_id]))
+            await session.commit()
+        invalidate_entitlement(current_user_id)
+        push_hub.publish(current_user_id, SUBSCRIPTION_CHANGED)
+
+        return jsonify({'message': 'Subscription cancelled successfully'}), 200
+    except StripeError as e:
+        current_app.logger.error(f"Stripe error in cancel_subscription: {str(e)}")
+        return jsonify({'error': 'An error occurred while cancelling your subscription'}), 500
+    except Exception as e:
+        current_app.logger.error(f'Unexpected error in cancel_subscription: {str(e)}')
+        return jsonify({'error': 'An unexpected error occurred'}), 500
+
+@subscription_bp.route('/webhook', methods=['POST'])
+async def webhook():
+    payload = await request.get_data()
+    sig_header = request.headers.get('Stripe-Signature')
+
+    try:
+        event = _gateway().construct_event(payload, sig_header, current_app.config['STRIPE_WEBHOOK_SECRET'])
+    except Exception as e:
+        current_app.logger.warning(f'Rejected webhook: {str(e)}')
+        return jsonify(error='Invalid webhook signature'), 400
+
+    try:
+        async with async_db.session() as session:
+            await record_event_async(session, event)
+        stripe_event_worker.notify()
+        return jsonify(success=True), 200
+    except Exception as e:
+        current_app.logger.error(f'Error in webhook: {str(e)}')
+        return jsonify(error='An unexpected error occurred'), 500
+
+@subscription_bp.route('/subscription-cancel')
+async def subscription_cancel():
+    return redirect(url_for('subscription.get_subscription'))
@@ -0,0 +1,70 @@
+import asyncio
+from quart import Blueprint, request, jsonify, current_app
+from sqlalchemy import select, update
+from models import User
+from services.async_db import async_db
+from services.entitlement_service import invalidate_entitlement
+from services.metrics_service import metrics_buffer, parse_events
+from services.analytics_service import global_counters, ADS_MUTED, MUTED_TIME
+from async_routes.common import jwt_required, get_jwt_identity, get_entitlement, conditional_get
+
+user_bp = Blueprint('user', __name__)
+
+@user_bp.route('/metrics', methods=['GET', 'POST'])
+@jwt_required()
+@conditional_get('metrics', extra=lambda user_id, entitlement: metrics_buffer.pending_totals(user_id))
+async def user_metrics():
+    current_user_id = int(get_jwt_identity())
+
+    if request.method == 'POST':
+        # Legacy whole-total overwrite, kept for extension versions that
+        # predate /user/metrics/events.
+        metrics = await request.get_json()
+        values = {'data_version': User.data_version + 1}
+        if 'timeMuted' in metrics:
+            values['total_muted_time'] = metrics['timeMuted']
+        if 'adsMuted' in metrics:
+            values['total_ads_muted'] = metrics['adsMuted']
+
+        async with async_db.session() as session:
+            old = (await session.execute(
+                select(User.total_muted_time, User.total_ads_muted)
+                .where(User.id == current_user_id)
+                .with_for_update()
+            )).first()
+            if old is None:
+                return jsonify({'error': 'User not found'}), 404
+            await session.execute(update(User).where(User.id == current_user_id).values(**values))
+            await global_counters.add_async(session, {
+                MUTED_TIME: (values.get('total_muted_time', old.total_muted_time) or 0) - (old.total_muted_time or 0),
+                ADS_MUTED: (values.get('total_ads_muted', old.total_ads_muted) or 0) - (old.total_ads_muted or 0),
+            })
+            await session.commit()
+        invalidate_entitlement(current_user_id)
+
+        return jsonify({'message': 'User metrics updated successfully'}), 200
+
+    entitlement = await get_entitlement(current_user_id)
+    if not entitlement:
+        return jsonify({'error': 'User not found'}), 404
+
+    pending_time, pending_ads = metrics_buffer.pending_totals(current_user_id)
+    return jsonify({
+        'total_muted_time': (entitlement['user']['total_muted_time'] or 0) + pending_time,
+        'total_ads_muted': (entitlement['user']['total_ads_muted'] or 0) + pending_ads
+    }), 200
+
+@user_bp.route('/metrics/events', methods=['POST'])
+@jwt_required()
+async def ingest_metric_events():
+    current_user_id = int(get_jwt_identity())
+    try:
+        events = parse_events(await request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Buffered in memory. A full buffer flushes through the sync engine in
+    # the caller, so that stays off the loop.
+    accepted, duplicates = await asyncio.to_thread(metrics_buffer.add_events, current_user_id, events)
+    current_app.logger.debug(f'Buffered {accepted} metric events for user: {current_user_id}')
+    return jsonify({'accepted': accepted, 'duplicates': duplicates}), 202
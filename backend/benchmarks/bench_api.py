@@ -0,0 +1,413 @@
+"""End-to-end API load and latency benchmark.
+
+Starts create_app() on a local threaded WSGI server, drives each scenario
+with concurrent keep-alive clients and reports throughput, p50/p95/p99
+latency and SQL statements per request. Results are written as JSON so they
+can be kept as baselines and compared in later runs.
+
+    python benchmarks/bench_api.py                          # SQLite, all scenarios
+    python benchmarks/bench_api.py --database-url postgresql://localhost/admute_bench
+    python benchmarks/bench_api.py --scenario login --scenario device_list --duration 20
+    python benchmarks/bench_api.py --compare benchmarks/baselines/sqlite.json
+
+A comparison run leaves the baseline alone and only writes its results when
+--output is given.
+
+Stripe is replaced by the in-process FakeStripeGateway, so nothing leaves
+the machine. The database at --database-url is dropped and recreated.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from app import create_app, db
+from models import User, Subscription
+from services.metrics_service import metrics_buffer
+from services.device_service import device_activity
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+PASSWORD = 'bench-password'
+
+
+class StatementCounter:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.count += 1
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+
+    def request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if body is not None and not isinstance(body, (bytes, str)):
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()
+            self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+        data = response.read()
+        return response.status, data
+
+    def json(self, method, path, body=None, headers=None):
+        status, data = self.request(method, path, body, headers)
+        return status, json.loads(data) if data else None
+
+
+class Bench:
+    def __init__(self, app, port, concurrency):
+        self.app = app
+        self.port = port
+        self.concurrency = concurrency
+        self.gateway = app.extensions['stripe_gateway']
+        self.sequence = itertools.count()
+        self.users = []
+
+    # -- fixtures -----------------------------------------------------------
+
+    def create_users(self, count):
+        client = Client(self.port)
+        users = []
+        for _ in range(count):
+            n = next(self.sequence)
+            username = f'bench{n}'
+            status, data = client.json('POST', '/auth/register', {
+                'username': username, 'email': f'{username}@example.com', 'password': PASSWORD
+            })
+            if status != 201:
+                raise RuntimeError(f'register failed during setup: {status} {data}')
+            users.append({
+                'username': username,
+                'access': data['access_token'],
+                'refresh': data['refresh_token'],
+                'auth': {'Authorization': f"Bearer {data['access_token']}"}
+            })
+        with self.app.app_context():
+            for user in users:
+                user['id'] = User.query.filter_by(username=user['username']).one().id
+        return users
+
+    def subscribe(self, users, device_limit=1000):
+        with self.app.app_context():
+            for user in users:
+                session = self.gateway.create_checkout_session(line_items=[{'price': 'price_bench'}],
+                                                               metadata={'plan': 'premium_monthly'})
+                stripe_session = self.gateway.complete_checkout_session(session.id)
+                user['stripe_subscription_id'] = stripe_session.subscription
+                db.session.add(Subscription(
+                    user_id=user['id'], plan='premium_monthly', status='active', device_limit=device_limit,
+                    stripe_customer_id=stripe_session.customer,
+                    stripe_subscription_id=stripe_session.subscription
+                ))
+            db.session.commit()
+
+    def register_devices(self, users, per_user):
+        client = Client(self.port)
+        for user in users:
+            user['devices'] = []
+            for _ in range(per_user):
+                device_id = f'device-{next(self.sequence)}'
+                status, data = client.json('POST', '/devices/register',
+                                           {'device_id': device_id, 'device_name': 'Bench'}, user['auth'])
+                if status not in (200, 201):
+                    raise RuntimeError(f'device register failed during setup: {status} {data}')
+                user['devices'].append(data['id'])
+
+    # -- scenarios ----------------------------------------------------------
+    # Each returns a function (worker, i) -> (method, path, body, headers, expected statuses),
+    # or that and a function (worker, status, body) that sees each response.
+
+    def scenario_register(self):
+        def make(worker, i):
+            username = f'bench{next(self.sequence)}'
+            return 'POST', '/auth/register', {
+                'username': username, 'email': f'{username}@example.com', 'password': PASSWORD
+            }, None, (201,)
+        return make
+
+    def scenario_login(self):
+        users = self.create_users(self.concurrency)
+
+        def make(worker, i):
+            return 'POST', '/auth/login', {'username': users[worker]['username'], 'password': PASSWORD}, None, (200,)
+        return make
+
+    def scenario_refresh(self):
+        # Refresh tokens rotate: each one is good for a single exchange, and
+        # presenting it again revokes the whole family, so every request
+        # sends the token the previous response returned.
+        users = self.create_users(self.concurrency)
+
+        def make(worker, i):
+            return 'POST', '/auth/refresh', None, {'Authorization': f"Bearer {users[worker]['refresh']}"}, (200,)
+
+        def record(worker, status, body):
+            if status == 200:
+                users[worker]['refresh'] = json.loads(body)['refresh_token']
+        return make, record
+
+    def scenario_metrics_post(self):
+        users = self.create_users(self.concurrency)
+
+        def make(worker, i):
+            events = [{'id': f'{worker}-{i}-{k}', 'duration': 15, 'service': 'YouTube'} for k in range(5)]
+            return 'POST', '/user/metrics/events', {'events': events}, users[worker]['auth'], (202,)
+        return make
+
+    def scenario_metrics_overwrite(self):
+        users = self.create_users(self.concurrency)
+
+        def make(worker, i):
+            return 'POST', '/user/metrics', {'timeMuted': i * 15, 'adsMuted': i}, users[worker]['auth'], (200,)
+        return make
+
+    def scenario_metrics_get(self):
+        users = self.create_users(self.concurrency)
+
+        def make(worker, i):
+            return 'GET', '/user/metrics', None, users[worker]['auth'], (200,)
+        return make
+
+    def scenario_device_register(self):
+        users = self.create_users(self.concurrency)
+        self.subscribe(users)
+
+        def make(worker, i):
+            return 'POST', '/devices/register', {'device_id': f'device-{next(self.sequence)}', 'device_name': 'Bench'}, \
+                users[worker]['auth'], (201,)
+        return make
+
+    def scenario_device_list(self):
+        users = self.create_users(self.concurrency)
+        self.subscribe(users)
+        self.register_devices(users, 3)
+
+        def make(worker, i):
+            return 'GET', '/devices/list', None, users[worker]['auth'], (200,)
+        return make
+
+    def scenario_device_heartbeat(self):
+        users = self.create_users(self.concurrency)
+        self.subscribe(users)
+        self.register_devices(users, 1)
+
+        def make(worker, i):
+            user = users[worker]
+            return 'POST', f"/devices/update-activity/{user['devices'][0]}", None, user['auth'], (200,)
+        return make
+
+    def scenario_webhook(self):
+        users = self.create_users(self.concurrency)
+        self.subscribe(users)
+        secret = self.app.config['STRIPE_WEBHOOK_SECRET']
+
+        def make(worker, i):
+            subscription = self.gateway.retrieve_subscription(users[worker]['stripe_subscription_id'])
+            payload, signature = self.gateway.make_event('customer.subscription.updated', subscription, secret)
+            return 'POST', '/subscription/webhook', payload, \
+                {'Stripe-Signature': signature, 'Content-Type': 'application/json'}, (200,)
+        return make
+
+    SCENARIOS = ('register', 'login', 'refresh', 'metrics_post', 'metrics_overwrite', 'metrics_get',
+                 'device_register', 'device_list', 'device_heartbeat', 'webhook')
+
+    # -- driver -------------------------------------------------------------
+
+    def run(self, name, duration, counter):
+        scenario = getattr(self, f'scenario_{name}')()
+        make, record = scenario if isinstance(scenario, tuple) else (scenario, None)
+        latencies = [[] for _ in range(self.concurrency)]
+        errors = [0] * self.concurrency
+        start_barrier = threading.Barrier(self.concurrency + 1)
+        deadline = [0]
+
+        def worker(index):
+            client = Client(self.port)
+            start_barrier.wait()
+            i = 0
+            while time.perf_counter() < deadline[0]:
+                method, path, body, headers, expected = make(index, i)
+                started = time.perf_counter()
+                status, data = client.request(method, path, body, headers)
+                latencies[index].append(time.perf_counter() - started)
+                if status not in expected:
+                    errors[index] += 1
+                if record:
+                    record(index, status, data)
+                i += 1
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(self.concurrency)]
+        for t in threads:
+            t.start()
+        statements_before = counter.count
+        deadline[0] = time.perf_counter() + duration
+        started = time.perf_counter()
+        start_barrier.wait()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        # Count the writes the request path deferred to the write-behind buffers.
+        with self.app.app_context():
+            metrics_buffer.flush_now()
+            device_activity.flush_now()
+        statements = counter.count - statements_before
+
+        samples = sorted(itertools.chain.from_iterable(latencies))
+        requests = len(samples)
+        return {
+            'requests': requests,
+            'errors': sum(errors),
+            'throughput_rps': round(requests / elapsed, 1) if elapsed else 0,
+            'p50_ms': percentile(samples, 50),
+            'p95_ms': percentile(samples, 95),
+            'p99_ms': percentile(samples, 99),
+            'sql_per_request': round(statements / requests, 2) if requests else None
+        }
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+    return round(samples[index] * 1000, 2)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)['scenarios']
+
+
+def compare(results, baseline, tolerance):
+    # Flags scenarios whose throughput fell or p95 / SQL count grew by more than `tolerance`.
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if before['throughput_rps'] and current['throughput_rps'] < before['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {before['throughput_rps']} -> {current['throughput_rps']} rps")
+        if before['p95_ms'] and current['p95_ms'] and current['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']} -> {current['p95_ms']} ms")
+        if before['sql_per_request'] is not None and current['sql_per_request'] is not None \
+                and current['sql_per_request'] > before['sql_per_request'] * (1 + tolerance) + 0.05:
+            regressions.append(f"{name}: SQL/request {before['sql_per_request']} -> {current['sql_per_request']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='testing', help='config class passed to create_app')
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--scenario', action='append', choices=Bench.SCENARIOS,
+                        help='run only these scenarios (repeatable)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--bcrypt-rounds', type=int, default=4,
+                        help='work factor for register/login; production uses BCRYPT_LOG_ROUNDS')
+    parser.add_argument('--output', help='results file (default benchmarks/baselines/<dialect>.json)')
+    parser.add_argument('--compare', help='baseline file to compare against; exits 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    # Read the baseline up front, before this run can overwrite it.
+    baseline = load_baseline(args.compare) if args.compare else None
+
+    database_url = args.database_url
+    if not database_url:
+        tmp = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        tmp.close()
+        database_url = f'sqlite:///{tmp.name}'
+
+    app = create_app(args.config, config_overrides={
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'STRIPE_GATEWAY': 'fake',
+        'BCRYPT_LOG_ROUNDS': args.bcrypt_rounds,
+        'TESTING': False,
+        # Measure the endpoints, not the limiter's 429s.
+        'RATE_LIMIT_ENABLED': False,
+    })
+    counter = StatementCounter()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        dialect = db.engine.dialect.name
+        event.listen(db.engine, 'before_cursor_execute', counter)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    bench = Bench(app, server.server_port, args.concurrency)
+    results = {}
+    for name in args.scenario or Bench.SCENARIOS:
+        results[name] = bench.run(name, args.duration, counter)
+        r = results[name]
+        print(f"{name:18} {r['throughput_rps']:>9} rps  p50 {r['p50_ms']:>8} ms  p95 {r['p95_ms']:>8} ms  "
+              f"p99 {r['p99_ms']:>8} ms  sql/req {r['sql_per_request']}  errors {r['errors']}")
+    server.shutdown()
+
+    report = {
+        'created_at': datetime.utcnow().isoformat(),
+        'git_revision': git_revision(),
+        'database': dialect,
+        'python': platform.python_version(),
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'bcrypt_rounds': args.bcrypt_rounds,
+        'scenarios': results
+    }
+    regressions = compare(results, baseline, args.tolerance) if args.compare else []
+    output = args.output or os.path.join(BASELINE_DIR, f'{dialect}.json')
+    if args.compare and not args.output:
+        print('Results not written; pass --output to keep them')
+    else:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {output}')
+
+    for line in regressions:
+        print(f'REGRESSION {line}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Password-check throughput: inline bcrypt vs the dedicated process pool.
+
+Simulates request threads doing the bcrypt part of /auth/login and reports
+logins/s and logins/s per core for each mode.
+
+    python benchmarks/bench_login.py --threads 16 --rounds 12 --seconds 10
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from services.password_service import PasswordHasher
+
+
+def run(hasher, threads, seconds, pw_hash):
+    count = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        nonlocal count
+        while time.perf_counter() < deadline:
+            assert hasher.verify(pw_hash, 'correct horse battery staple')
+            with lock:
+                count += 1
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return count / (time.perf_counter() - start)
+
+
+def make_hasher(rounds, workers, threads):
+    app = Flask(__name__)
+    app.config.update(
+        BCRYPT_LOG_ROUNDS=rounds,
+        PASSWORD_HASH_WORKERS=workers,
+        PASSWORD_HASH_MAX_QUEUE=threads,
+        PASSWORD_HASH_QUEUE_TIMEOUT=60,
+    )
+    hasher = PasswordHasher()
+    hasher.init_app(app)
+    return hasher
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16, help='concurrent request threads')
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt work factor')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='hash pool processes')
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    results = {}
+    for mode, workers in (('inline', 0), ('pool', args.workers)):
+        hasher = make_hasher(args.rounds, workers, args.threads)
+        pw_hash = hasher.hash('correct horse battery staple')
+        run(hasher, min(args.threads, 2), 1, pw_hash)  # warm up the pool
+        rate = run(hasher, args.threads, args.seconds, pw_hash)
+        hasher.shutdown()
+        results[mode] = {'logins_per_sec': round(rate, 1), 'logins_per_sec_per_core': round(rate / cores, 2)}
+
+    print(json.dumps({'rounds': args.rounds, 'threads': args.threads, 'cores': cores, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
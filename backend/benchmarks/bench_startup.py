@@ -0,0 +1,107 @@
+"""Cold-start benchmark for create_app().
+
+Runs each measurement in a fresh interpreter and reports the median time to
+import the app module, build the first app (what a new worker or a test's
+setUp pays) and build another one in the same process. Fails when the cold
+start exceeds --budget-ms, when it regressed against a --compare baseline,
+or when a module that create_app defers (Stripe, Alembic) was imported.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 20 --budget-ms 700
+    python benchmarks/bench_startup.py --config production --output startup.json
+    python benchmarks/bench_startup.py --compare benchmarks/baselines/startup.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Imported on first use, never while building the app.
+DEFERRED_MODULES = ('stripe', 'flask_migrate', 'alembic')
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app(sys.argv[1], {'FAST_START': True})
+built = time.perf_counter()
+create_app(sys.argv[1], {'FAST_START': True})
+rebuilt = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_app_ms': (built - imported) * 1000,
+    'next_app_ms': (rebuilt - built) * 1000,
+    'loaded': [name for name in sys.argv[2:] if name in sys.modules],
+}))
+"""
+
+
+def probe(config, python):
+    output = subprocess.check_output([python, '-c', PROBE, config, *DEFERRED_MODULES], cwd=BACKEND_DIR)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def measure(config, runs, python=sys.executable):
+    samples = [probe(config, python) for _ in range(runs)]
+    result = {key: round(statistics.median(s[key] for s in samples), 1)
+              for key in ('import_ms', 'first_app_ms', 'next_app_ms')}
+    result['cold_start_ms'] = round(result['import_ms'] + result['first_app_ms'], 1)
+    result['deferred_modules_loaded'] = sorted({name for s in samples for name in s['loaded']})
+    return result
+
+
+def check(result, budget_ms, baseline_path=None, tolerance=0.2):
+    problems = []
+    if budget_ms and result['cold_start_ms'] > budget_ms:
+        problems.append(f"cold start {result['cold_start_ms']} ms is over the {budget_ms} ms budget")
+    if result['deferred_modules_loaded']:
+        problems.append(f"create_app imported {', '.join(result['deferred_modules_loaded'])}")
+    if baseline_path:
+        with open(baseline_path) as f:
+            before = json.load(f)['result']
+        for key in ('cold_start_ms', 'next_app_ms'):
+            if result[key] > before[key] * (1 + tolerance):
+                problems.append(f'{key} {before[key]} -> {result[key]}')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='testing', help='config class passed to create_app')
+    parser.add_argument('--runs', type=int, default=10, help='fresh interpreters to sample')
+    parser.add_argument('--budget-ms', type=float, default=800,
+                        help='maximum median import + first create_app time; 0 disables')
+    parser.add_argument('--output', help='write the results here as JSON')
+    parser.add_argument('--compare', help='baseline file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    result = measure(args.config, args.runs)
+    print(f"import {result['import_ms']} ms  first create_app {result['first_app_ms']} ms  "
+          f"next create_app {result['next_app_ms']} ms  cold start {result['cold_start_ms']} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created_at': datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'config': args.config,
+                'runs': args.runs,
+                'result': result,
+            }, f, indent=2)
+        print(f'Results written to {args.output}')
+
+    problems = check(result, args.budget_ms, args.compare, args.tolerance)
+    for line in problems:
+        print(f'REGRESSION {line}')
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import os
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _replica_binds(urls):
+    # DATABASE_REPLICA_URLS="postgresql://r1/admute,postgresql://r2/admute"
+    return {f'replica{i}': url.strip() for i, url in enumerate(urls.split(',')) if url.strip()}
+
+
+class Config:
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'dev-secret-key')
+    JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'dev-jwt-secret-key-change-me-in-production')
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///admute.db')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Read replicas, as extra binds that hold no models of their own; see
+    # utils.db_routing. Empty means every query goes to the primary.
+    SQLALCHEMY_BINDS = _replica_binds(os.environ.get('DATABASE_REPLICA_URLS', ''))
+    SQLALCHEMY_REPLICA_BINDS = tuple(SQLALCHEMY_BINDS)
+    # Seconds a user's reads stay on the primary after they changed something.
+    REPLICA_STICKY_SECONDS = _env_int('REPLICA_STICKY_SECONDS', 15)
+    # Reverse proxies in front of the app whose X-Forwarded-For/-Proto are
+    # trusted, so request.remote_addr (and the per-address rate limits) see
+    # the client. 0 trusts none; more than the real number lets clients
+    # pick their own address.
+    PROXY_FIX_HOPS = _env_int('PROXY_FIX_HOPS', 0)
+    # /push/stream on the WSGI app. Each open stream holds a worker for up
+    # to an access token's lifetime, so it is off (404) unless the server
+    # runs threaded or async workers (gunicorn --threads, gevent); the
+    # ASGI app always serves it.
+    PUSH_STREAM_WSGI = os.environ.get('PUSH_STREAM_WSGI') == '1'
+
+    STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY', '')
+    STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET', '')
+    BASIC_MONTHLY_PRICE_ID = os.environ.get('BASIC_MONTHLY_PRICE_ID')
+    BASIC_YEARLY_PRICE_ID = os.environ.get('BASIC_YEARLY_PRICE_ID')
+    PREMIUM_MONTHLY_PRICE_ID = os.environ.get('PREMIUM_MONTHLY_PRICE_ID')
+    PREMIUM_YEARLY_PRICE_ID = os.environ.get('PREMIUM_YEARLY_PRICE_ID')
+
+    ADMIN_API_TOKEN = os.environ.get('ADMIN_API_TOKEN')
+    METRICS_SCRAPE_TOKEN = os.environ.get('METRICS_SCRAPE_TOKEN')
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    BCRYPT_LOG_ROUNDS = 4
+    PASSWORD_HASH_WORKERS = 0
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SECRET_KEY = 'test-secret-key'
+    JWT_SECRET_KEY = 'test-jwt-secret-key-for-the-test-suite'
+    # Some tests still issue tokens with integer identities.
+    JWT_VERIFY_SUB = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SQLALCHEMY_BINDS = {}
+    SQLALCHEMY_REPLICA_BINDS = ()
+
+    # The in-memory gateway from services.stripe_gateway; nothing leaves the process.
+    STRIPE_GATEWAY = 'fake'
+    STRIPE_SECRET_KEY = 'sk_test_placeholder'
+    STRIPE_WEBHOOK_SECRET = 'whsec_test_placeholder'
+    BASIC_MONTHLY_PRICE_ID = 'price_basic_monthly'
+    BASIC_YEARLY_PRICE_ID = 'price_basic_yearly'
+    PREMIUM_MONTHLY_PRICE_ID = 'price_premium_monthly'
+    PREMIUM_YEARLY_PRICE_ID = 'price_premium_yearly'
+
+    BCRYPT_LOG_ROUNDS = 4
+    PASSWORD_HASH_WORKERS = 0
+    FAST_START = True
+    # Each test starts on an empty revocation log (see RevocationFilter.init_app);
+    # tests that need another worker's revocations call revocation_filter.sync().
+    REVOCATION_SYNC_INTERVAL = 60
+
+
+class ProductionConfig(Config):
+    # No development fallbacks: create_app refuses to start without these.
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY')
+    REQUIRED_SETTINGS = ('SECRET_KEY', 'JWT_SECRET_KEY')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    # Per worker process: pool_size + max_overflow connections to the
+    # primary and to each replica, so keep (workers x that) under the
+    # server's max_connections. Pre-ping drops connections the server or a
+    # proxy closed while idle; recycle retires them before idle timeouts.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': _env_int('DB_POOL_SIZE', 10),
+        'max_overflow': _env_int('DB_MAX_OVERFLOW', 5),
+        'pool_timeout': _env_int('DB_POOL_TIMEOUT', 5),
+        'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': True,
+    }
+    # bcrypt processes per server worker; unset shares the node's cores
+    # between the WEB_CONCURRENCY workers.
+    if os.environ.get('PASSWORD_HASH_WORKERS'):
+        PASSWORD_HASH_WORKERS = _env_int('PASSWORD_HASH_WORKERS', 1)
+    PREFERRED_URL_SCHEME = 'https'
@@ -1,13 +1,164 @@
-from flask_migrate import Migrate, MigrateCommand
-from flask_script import Manager
-from app import create_app, db
-from models import User
+import os
+import sys
+import click
+from flask.cli import FlaskGroup
+from app import create_app
+from models import EventPartition, RuleBundle
+from services.device_service import sweep_stale_devices
+from services.webhook_service import run_worker
+from services.token_service import prune_tokens as prune_expired_tokens
+from services.analytics_service import global_counters
+from services.export_service import DATASETS, FORMATS, export_lines
+from services.purge_service import process_pending_deletions, purge_expired_records, run_purge_worker
+from services.reconcile_service import reconcile_subscriptions, PAGE_SIZE
+from services.expiry_service import expire_lapsed_subscriptions, run_expiry_sweeper
+from services.partition_service import (
+    ensure_partitions, attach_partition, detach_partition, enforce_event_retention, run_partition_maintenance
+)
+from services.rules_service import service_rules, seed_default_rules, publish_rules
 
-app = create_app('development')
-migrate = Migrate(app, db)
-manager = Manager(app)
+# Operational commands, e.g. `python manage.py prune_tokens` from cron.
+# FLASK_CONFIG picks the configuration (default: development). Migrations
+# are under `python manage.py db`, from Flask-Migrate.
+def make_app():
+    return create_app(os.environ.get('FLASK_CONFIG', 'development'), {'FAST_START': False})
 
-manager.add_command('db', MigrateCommand)
+cli = FlaskGroup(create_app=make_app)
+
+@cli.command('prune_devices')
+@click.option('-d', '--days', type=int, default=None, help='Idle days before a device is stale')
+@click.option('--dry-run', is_flag=True, help='Only count stale devices')
+def prune_devices(days, dry_run):
+    count = sweep_stale_devices(days, dry_run=dry_run)
+    click.echo(f"{'Found' if dry_run else 'Pruned'} {count} stale devices")
+
+@cli.command('process_webhooks')
+@click.option('-i', '--interval', type=float, default=2, help='Seconds to sleep when idle')
+def process_webhooks(interval):
+    run_worker(poll_interval=interval)
+
+@cli.command('prune_tokens')
+def prune_tokens():
+    click.echo(f"Removed {prune_expired_tokens()} expired refresh tokens and revocations")
+
+@cli.command('reconcile_counters')
+def reconcile_counters():
+    corrections = global_counters.reconcile()
+    click.echo(f"Corrected {len(corrections)} global counters" if corrections else "Global counters are consistent")
+
+@cli.command('export_data')
+@click.option('-d', '--dataset', 'datasets', multiple=True, type=click.Choice(list(DATASETS)),
+              help='Dataset to export; repeat for several (NDJSON only). Default: all')
+@click.option('-f', '--format', 'fmt', type=click.Choice(FORMATS), default='ndjson')
+@click.option('-u', '--user-id', type=int, default=None, help='Only this user\'s rows')
+@click.option('-o', '--output', default=None, help='File to write (default: stdout)')
+def export_data(datasets, fmt, user_id, output):
+    out = open(output, 'w', newline='', encoding='utf-8') if output else sys.stdout
+    try:
+        for line in export_lines(fmt, list(datasets) or list(DATASETS), user_id=user_id):
+            out.write(line)
+    finally:
+        if output:
+            out.close()
+
+@cli.command('purge_accounts')
+@click.option('--loop', is_flag=True, help='Keep polling the deletion queue')
+@click.option('-i', '--interval', type=float, default=30, help='Seconds to sleep when idle')
+def purge_accounts(loop, interval):
+    if loop:
+        run_purge_worker(poll_interval=interval)
+    else:
+        click.echo(f"Purged {process_pending_deletions()} accounts")
+
+@cli.command('purge_expired')
+def purge_expired():
+    for table, count in purge_expired_records().items():
+        click.echo(f"Removed {count} expired {table} rows")
+
+@cli.command('reconcile_stripe')
+@click.option('-p', '--page-size', type=int, default=PAGE_SIZE, help='Subscriptions per Stripe page')
+@click.option('-m', '--max-pages', type=int, default=None, help='Stop after this many pages')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint and start over')
+def reconcile_stripe(page_size, max_pages, restart):
+    checkpoint = reconcile_subscriptions(page_size, max_pages, restart)
+    state = 'complete' if checkpoint.completed_at else f'paused after {checkpoint.cursor}'
+    click.echo(f"Checked {checkpoint.checked} subscriptions, changed {checkpoint.changed}; run {state}")
+
+@cli.command('expire_subscriptions')
+@click.option('-g', '--grace-hours', type=int, default=None,
+              help='Hours past current_period_end before a subscription expires')
+@click.option('--loop', is_flag=True, help='Keep sweeping every --interval seconds')
+@click.option('-i', '--interval', type=float, default=300)
+def expire_subscriptions(grace_hours, loop, interval):
+    if loop:
+        run_expiry_sweeper(interval, grace_hours)
+    expired = expire_lapsed_subscriptions(grace_hours)
+    click.echo(f"Expired {sum(expired.values())} subscriptions ({', '.join(f'{k}: {v}' for k, v in expired.items())})")
+
+# Monthly ad_event partitions: `manage.py partitions maintain` from a daily cron.
+@cli.group('partitions')
+def partitions():
+    """Create, attach, detach and expire ad event partitions."""
+
+@partitions.command('show')
+def show_partitions():
+    for partition in EventPartition.query.order_by(EventPartition.range_start):
+        rolled_up = f", {partition.rows} events rolled up" if partition.rolled_up_at else ''
+        click.echo(f"{partition.name}  {partition.range_start:%Y-%m-%d} .. {partition.range_end:%Y-%m-%d}  {partition.state}{rolled_up}")
+
+@partitions.command('create')
+@click.option('-a', '--ahead', type=int, default=None, help='Months to create past the current one')
+def create_partitions(ahead):
+    for partition in ensure_partitions(ahead):
+        click.echo(f"{partition.name} {partition.state}")
+
+@partitions.command('detach')
+@click.argument('name')
+def detach(name):
+    """Detach the named partition (ad_event_pYYYYMM)."""
+    detach_partition(name)
+    click.echo(f"Detached {name}")
+
+@partitions.command('attach')
+@click.argument('name')
+def attach(name):
+    """Attach the named partition (ad_event_pYYYYMM)."""
+    attach_partition(name)
+    click.echo(f"Attached {name}")
+
+@partitions.command('expire')
+@click.option('-d', '--days', type=int, default=None, help='Keep raw events for this many days')
+def expire_partitions(days):
+    dropped = enforce_event_retention(days)
+    click.echo(f"Dropped {', '.join(dropped)}" if dropped else "No partitions past retention")
+
+@partitions.command('maintain')
+def maintain_partitions():
+    created, dropped = run_partition_maintenance()
+    click.echo(f"Partitions ready: {', '.join(created)}; dropped: {', '.join(dropped) or 'none'}")
+
+# Ad-detection rules served to the extension from /rules.
+@cli.group('rules')
+def rules():
+    """Seed, inspect and publish ad-detection rules."""
+
+@rules.command('show')
+def show_rules():
+    for service, service_rule in service_rules().items():
+        click.echo(f"{service}  {sum(len(group) for group in service_rule['ad_markers'])} ad marker selectors")
+    for bundle in RuleBundle.query.order_by(RuleBundle.published_at.desc()).limit(10):
+        click.echo(f"{bundle.version}  published {bundle.published_at:%Y-%m-%d %H:%M}  {bundle.size} -> {len(bundle.body)} bytes")
+
+@rules.command('seed')
+@click.option('--overwrite', is_flag=True, help='Replace existing rules with the defaults')
+def seed_rules(overwrite):
+    written = seed_default_rules(overwrite)
+    click.echo(f"Seeded {', '.join(written)}" if written else "Every service already has rules")
+
+@rules.command('publish')
+def publish_rule_bundle():
+    bundle = publish_rules()
+    click.echo(f"Published {bundle.version} ({bundle.size} -> {len(bundle.body)} bytes)")
 
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    cli()
@@ -1,4 +1,5 @@
-from app import db, bcrypt
+from app import db
+from services.password_service import password_hasher
 from datetime import datetime
 
 class User(db.Model):
@@ -8,16 +9,25 @@ class User(db.Model):
     password_hash = db.Column(db.String(128))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     subscription = db.relationship('Subscription', backref='user', uselist=False)
+    devices = db.relationship('Device', backref='user')
     
     # New fields for metrics
     total_muted_time = db.Column(db.Integer, default=0)  # in seconds
     total_ads_muted = db.Column(db.Integer, default=0)
+
+    # Bumped with every change to what the polled read endpoints return; part of their ETags.
+    data_version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # Set when the account is queued for deletion; it can no longer sign in.
+    deletion_requested_at = db.Column(db.DateTime)
     
     def set_password(self, password):
-        self.password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        return bcrypt.check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return password_hasher.needs_rehash(self.password_hash)
 
     def to_dict(self):
         return {
@@ -40,11 +50,202 @@ class Subscription(db.Model):
     current_period_end = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # `created` of the newest Stripe event applied, so older deliveries are ignored.
+    last_event_created = db.Column(db.Integer)
+
+    __table_args__ = (
+        # The expiry sweeper's range scan: one status, period ended before a cutoff.
+        db.Index('ix_subscription_status_period_end', 'status', 'current_period_end'),
+    )
+
+    def to_dict(self):
+        return {
+            'status': self.status,
+            'plan': self.plan,
+            'device_limit': self.device_limit,
+            'current_period_end': self.current_period_end.isoformat() if self.current_period_end else None
+        }
 
 class Device(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     device_id = db.Column(db.String(255), unique=True, nullable=False)
     name = db.Column(db.String(64))
-    last_active = db.Column(db.DateTime, default=datetime.utcnow)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    last_active = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'last_active': self.last_active.isoformat() if self.last_active else None
+        }
+
+
+class MetricRollup(db.Model):
+    # Pre-aggregated muted-ad totals per user, service and time bucket. Every
+    # event is counted once in each granularity ('hour', 'day', 'month').
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    service = db.Column(db.String(32), nullable=False)
+    granularity = db.Column(db.String(8), nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    muted_time = db.Column(db.Integer, nullable=False, default=0)  # in seconds
+    ads_muted = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # Range queries are (user_id, granularity, bucket_start BETWEEN ...), so
+        # they stay index scans over a handful of rows however long the history.
+        db.UniqueConstraint('user_id', 'granularity', 'bucket_start', 'service', name='uq_metric_rollup_bucket'),
+    )
+
+
+class StripeEvent(db.Model):
+    # Ledger of verified Stripe webhook events. The webhook endpoint only
+    # inserts here; services.webhook_service claims and applies the rows.
+    id = db.Column(db.String(255), primary_key=True)  # Stripe event id
+    type = db.Column(db.String(64), nullable=False)
+    created = db.Column(db.Integer, nullable=False)  # Stripe's unix timestamp
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    claim_token = db.Column(db.String(64))
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_stripe_event_status_created', 'status', 'created'),
+    )
+
+
+class RefreshToken(db.Model):
+    # One row per issued refresh token. Tokens sharing a family_id descend
+    # from one login through rotation; each may be exchanged exactly once.
+    jti = db.Column(db.String(36), primary_key=True)
+    family_id = db.Column(db.String(36), nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    issued_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    used_at = db.Column(db.DateTime)
+    revoked_at = db.Column(db.DateTime)
+
+
+class RevokedToken(db.Model):
+    # Append-only revocation log that every worker's in-process filter syncs
+    # from. `key` is an access token jti or a whole refresh-token family id.
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(36), unique=True, nullable=False)
+    revoked_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class GlobalCounter(db.Model):
+    # Sharded running totals behind the admin dashboard. Writers add to one
+    # random shard so concurrent increments rarely touch the same row; a
+    # counter's value is the sum of its shards.
+    name = db.Column(db.String(96), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class AccountDeletion(db.Model):
+    # Queue of accounts to purge. Rows outlive the user (no foreign key) as
+    # the record that the deletion ran, and carry its progress.
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    reason = db.Column(db.String(32), nullable=False, default='user_request')
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    rows_deleted = db.Column(db.Integer, nullable=False, default=0)
+    claim_token = db.Column(db.String(64))
+    locked_until = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    requested_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    completed_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_account_deletion_status_requested', 'status', 'requested_at'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'reason': self.reason,
+            'status': self.status,
+            'rows_deleted': self.rows_deleted,
+            'requested_at': self.requested_at.isoformat() if self.requested_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None,
+            'last_error': self.last_error
+        }
+
+
+class SyncCheckpoint(db.Model):
+    # Resumable progress of a paged background job, one row per job name.
+    # `cursor` is where the next page starts; it is cleared when a run completes.
+    name = db.Column(db.String(64), primary_key=True)
+    cursor = db.Column(db.String(255))
+    run_started_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    completed_at = db.Column(db.DateTime)
+    pages = db.Column(db.Integer, nullable=False, default=0)
+    checked = db.Column(db.Integer, nullable=False, default=0)
+    changed = db.Column(db.Integer, nullable=False, default=0)
+
+
+class EventPartition(db.Model):
+    # Catalog of the monthly ad_event partitions (services.partition_service).
+    # Only 'attached' partitions are written to and read from; 'detached'
+    # ones keep their rows until the retention job drops them.
+    name = db.Column(db.String(64), primary_key=True)
+    range_start = db.Column(db.DateTime, nullable=False, unique=True)
+    range_end = db.Column(db.DateTime, nullable=False)
+    state = db.Column(db.String(16), nullable=False, default='attached')  # attached, detached, dropped
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    detached_at = db.Column(db.DateTime)
+    rolled_up_at = db.Column(db.DateTime)
+    dropped_at = db.Column(db.DateTime)
+    rows = db.Column(db.BigInteger)  # raw events when rolled up
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'range_start': self.range_start.isoformat(),
+            'range_end': self.range_end.isoformat(),
+            'state': self.state,
+            'rolled_up_at': self.rolled_up_at.isoformat() if self.rolled_up_at else None,
+            'dropped_at': self.dropped_at.isoformat() if self.dropped_at else None,
+            'rows': self.rows
+        }
+
+
+class AdRuleSet(db.Model):
+    # Ad-detection rules for one streaming service, edited through the admin
+    # API. Clients never read these rows; they get the compiled RuleBundle
+    # (services.rules_service).
+    service = db.Column(db.String(32), primary_key=True)
+    rules = db.Column(db.Text, nullable=False)  # JSON
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class RuleBundle(db.Model):
+    # Every service's rules compiled into one gzipped JSON document, keyed
+    # by a hash of its content. Only published_at ever changes, when
+    # identical rules are published again.
+    version = db.Column(db.String(32), primary_key=True)
+    body = db.Column(db.LargeBinary, nullable=False)  # gzip
+    size = db.Column(db.Integer, nullable=False)  # uncompressed bytes
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    published_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'size': self.size,
+            'compressed_size': len(self.body),
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'published_at': self.published_at.isoformat()
+        }
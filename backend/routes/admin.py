@@ -0,0 +1,90 @@
+import hmac
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
+from services.analytics_service import global_counters, dashboard
+from services.export_service import export_lines, export_mimetype, parse_export_args
+from services.rules_service import service_rules, set_service_rules, delete_service_rules, publish_rules
+from models import AccountDeletion, RuleBundle
+from utils.db_routing import read_replica
+
+admin_bp = Blueprint('admin', __name__)
+
+@admin_bp.before_request
+def require_admin_token():
+    # Operator-only API, authenticated with the shared ADMIN_API_TOKEN and
+    # disabled while none is configured.
+    token = current_app.config.get('ADMIN_API_TOKEN')
+    if not token:
+        return jsonify({'error': 'Not found'}), 404
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied, token):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+@admin_bp.route('/stats', methods=['GET'])
+@read_replica
+def get_stats():
+    # Served from the global counters, so the cost does not grow with the
+    # number of users, devices or subscriptions.
+    totals = global_counters.totals()
+    return jsonify(dashboard(totals, current_app.config.get('PLAN_MONTHLY_PRICES'))), 200
+
+@admin_bp.route('/export/<dataset>', methods=['GET'])
+@read_replica
+def export_dataset(dataset):
+    # Whole-table export (or one user's rows with ?user_id=), streamed
+    # through a server-side cursor.
+    try:
+        fmt, datasets = parse_export_args(request.args, [dataset])
+        user_id = request.args.get('user_id', type=int)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if datasets != [dataset]:
+        return jsonify({'error': 'Export one dataset at a time'}), 400
+
+    return Response(
+        stream_with_context(export_lines(fmt, datasets, user_id=user_id)),
+        mimetype=export_mimetype(fmt),
+        headers={'Content-Disposition': f'attachment; filename="{dataset}.{fmt}"'}
+    )
+
+@admin_bp.route('/deletions', methods=['GET'])
+def list_deletions():
+    # Account deletion queue with per-deletion progress, newest first.
+    query = AccountDeletion.query
+    if request.args.get('status'):
+        query = query.filter_by(status=request.args['status'])
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    deletions = query.order_by(AccountDeletion.requested_at.desc(), AccountDeletion.id.desc()).limit(limit).all()
+    return jsonify({'deletions': [deletion.to_dict() for deletion in deletions]}), 200
+
+@admin_bp.route('/rules', methods=['GET'])
+def list_rules():
+    # Draft rules per service and the published bundles, newest first.
+    bundles = RuleBundle.query.order_by(RuleBundle.published_at.desc()).all()
+    return jsonify({
+        'services': service_rules(),
+        'bundles': [bundle.to_dict() for bundle in bundles]
+    }), 200
+
+@admin_bp.route('/rules/<service>', methods=['PUT'])
+def put_rules(service):
+    # Takes effect for clients on the next publish.
+    try:
+        rules = set_service_rules(service, request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'service': service, 'rules': rules}), 200
+
+@admin_bp.route('/rules/<service>', methods=['DELETE'])
+def delete_rules(service):
+    if not delete_service_rules(service):
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({'message': f'Rules for {service} deleted'}), 200
+
+@admin_bp.route('/rules/publish', methods=['POST'])
+def publish_rule_bundle():
+    try:
+        bundle = publish_rules()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    current_app.logger.info(f'Published ad rules {bundle.version}')
+    return jsonify(bundle.to_dict()), 200
@@ -1,7 +1,14 @@
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, create_refresh_token, get_jwt
+from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
 from models import User
 from app import db
+from services.password_service import PasswordHasherBusy
+from services.entitlement_service import get_entitlement
+from services.token_service import (
+    issue_tokens, rotate_refresh_token, revoke_session, RefreshInProgress, RefreshTokenReused
+)
+from services.purge_service import request_account_deletion
+from utils.etag import conditional_get
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -16,12 +23,14 @@ def register():
         return jsonify({'message': 'Username or email already exists'}), 400
     
     user = User(username=username, email=email)
-    user.set_password(password)
+    try:
+        user.set_password(password)
+    except PasswordHasherBusy:
+        return jsonify({'message': 'Server busy, please try again'}), 503, {'Retry-After': '1'}
     db.session.add(user)
     db.session.commit()
     
-    access_token = create_access_token(identity=user.id)
-    refresh_token = create_refresh_token(identity=user.id)
+    access_token, refresh_token = issue_tokens(user.id)
     return jsonify(access_token=access_token, refresh_token=refresh_token), 201
 
 @auth_bp.route('/login', methods=['POST'])
@@ -32,23 +41,31 @@ def login():
     
     user = User.query.filter_by(username=username).first()
     
-    if not user:
+    if not user or user.deletion_requested_at:
         return jsonify({'message': 'User not found'}), 401
     
-    if not user.check_password(password):
-        return jsonify({'message': 'Incorrect password'}), 401
+    try:
+        if not user.check_password(password):
+            return jsonify({'message': 'Incorrect password'}), 401
+
+        # Upgrade hashes made with an older BCRYPT_LOG_ROUNDS while we have the password.
+        if user.password_needs_rehash():
+            user.set_password(password)
+            db.session.commit()
+    except PasswordHasherBusy:
+        return jsonify({'message': 'Server busy, please try again'}), 503, {'Retry-After': '1'}
     
-    access_token = create_access_token(identity=user.id)
-    refresh_token = create_refresh_token(identity=user.id)
+    access_token, refresh_token = issue_tokens(user.id)
     return jsonify(access_token=access_token, refresh_token=refresh_token), 200
 
 @auth_bp.route('/user', methods=['GET'])
 @jwt_required()
+@conditional_get('user', state=lambda user_id, entitlement: entitlement['user'])
 def get_user():
     current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    if user:
-        return jsonify(user.to_dict()), 200
+    entitlement = get_entitlement(current_user_id)
+    if entitlement:
+        return jsonify(entitlement['user']), 200
     return jsonify({'message': 'User not found'}), 404
 
 @auth_bp.route('/protected', methods=['GET'])
@@ -62,10 +79,40 @@ def protected():
 @jwt_required(refresh=True)
 def refresh():
     try:
-        current_user_id = get_jwt_identity()
-        new_access_token = create_access_token(identity=current_user_id)
-        new_refresh_token = create_refresh_token(identity=current_user_id)
+        new_access_token, new_refresh_token = rotate_refresh_token(get_jwt())
         return jsonify(access_token=new_access_token, refresh_token=new_refresh_token), 200
+    except RefreshInProgress:
+        # A concurrent request just rotated this token; the client should
+        # retry with the token it stored from that response.
+        return jsonify({"message": "Token refresh already in progress"}), 409, {'Retry-After': '1'}
+    except RefreshTokenReused:
+        return jsonify({"message": "Refresh token has been revoked"}), 401
     except Exception as e:
         print(f"Error in refresh: {str(e)}")
-        return jsonify({"message": "Token refresh failed"}), 401
\ No newline at end of file
+        return jsonify({"message": "Token refresh failed"}), 401
+
+@auth_bp.route('/logout', methods=['POST'])
+@jwt_required()
+def logout():
+    revoke_session(get_jwt())
+    return jsonify({"message": "Logged out"}), 200
+
+@auth_bp.route('/account', methods=['DELETE'])
+@jwt_required()
+def delete_account():
+    # Queues the account for the purge worker and signs it out everywhere.
+    # The password is asked for again so a stolen access token alone cannot
+    # delete the account.
+    user = db.session.get(User, int(get_jwt_identity()))
+    if not user:
+        return jsonify({'message': 'User not found'}), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        if not user.check_password(data.get('password')):
+            return jsonify({'message': 'Incorrect password'}), 401
+    except PasswordHasherBusy:
+        return jsonify({'message': 'Server busy, please try again'}), 503, {'Retry-After': '1'}
+
+    deletion = request_account_deletion(user)
+    return jsonify({'message': 'Account scheduled for deletion', 'deletion': deletion.to_dict()}), 202
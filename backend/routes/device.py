@@ -2,8 +2,15 @@ from flask import Blueprint, request, jsonify, current_app
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import User, Device, Subscription
 from app import db
+from services.entitlement_service import get_entitlement, invalidate_entitlement, bump_version
+from services.device_service import (
+    device_activity, serialize_devices, register_user_device, pending_heartbeats,
+    DEVICE_CREATED, DEVICE_EXISTS, DEVICE_OWNED_ELSEWHERE, SUBSCRIPTION_REQUIRED
+)
 from datetime import datetime
 from werkzeug.exceptions import BadRequest, NotFound
+from utils.etag import conditional_get
+from services.push_service import push_hub, DEVICES_CHANGED
 
 device_bp = Blueprint('device', __name__)
 
@@ -11,44 +18,49 @@ device_bp = Blueprint('device', __name__)
 @jwt_required()
 def register_device():
     current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    
-    if not user:
-        current_app.logger.warning(f"User not found for ID: {current_user_id}")
-        return jsonify({'message': 'User not found'}), 404
-
-    data = request.get_json()
+    data = request.get_json() or {}
     device_id = data.get('device_id')
     device_name = data.get('device_name', 'Unknown Device')
 
-    existing_device = Device.query.filter_by(device_id=device_id).first()
-    if existing_device:
-        current_app.logger.info(f"Device already registered: {device_id}")
-        return jsonify({'message': 'Device registration logged'}), 200
+    if not device_id:
+        return jsonify({'message': 'device_id is required'}), 400
 
-    new_device = Device(user_id=current_user_id, device_id=device_id, name=device_name)
-    db.session.add(new_device)
-    db.session.commit()
+    try:
+        outcome, device_pk = register_user_device(current_user_id, device_id, device_name)
+    except Exception as e:
+        current_app.logger.error(f'Error in register_device: {str(e)}')
+        return jsonify({'error': 'An unexpected error occurred'}), 500
 
-    current_app.logger.info(f"Device registered: {device_id} for user: {current_user_id}")
-    return jsonify({'message': 'Device registration logged'}), 200
-    
+    if outcome == DEVICE_CREATED:
+        current_app.logger.info(f"Device registered: {device_id} for user: {current_user_id}")
+        return jsonify({'message': 'Device registered successfully', 'id': device_pk}), 201
+    if outcome == DEVICE_EXISTS:
+        current_app.logger.info(f"Device already registered: {device_id}")
+        return jsonify({'message': 'Device already registered', 'id': device_pk}), 200
+    if outcome == DEVICE_OWNED_ELSEWHERE:
+        current_app.logger.warning(f"Device {device_id} is registered to another user")
+        return jsonify({'message': 'Device is registered to another account'}), 409
+    if outcome == SUBSCRIPTION_REQUIRED:
+        return jsonify({'message': 'Active subscription required'}), 403
+    return jsonify({'message': 'Device limit reached'}), 403
 
 @device_bp.route('/list', methods=['GET'])
 @jwt_required()
+@conditional_get('devices', extra=lambda user_id, entitlement: pending_heartbeats(entitlement['device_ids']))
 def get_devices():
     try:
         current_user_id = get_jwt_identity()
-        user = db.session.get(User, current_user_id)
+        entitlement = get_entitlement(current_user_id)
         
-        if not user:
+        if not entitlement:
             raise NotFound('User not found')
 
-        devices = Device.query.filter_by(user_id=current_user_id).all()
+        devices = Device.query.filter_by(user_id=current_user_id).all() if entitlement['device_ids'] else []
+        subscription = entitlement['subscription']
         
         return jsonify({
-            'devices': [{'id': d.id, 'name': d.name, 'last_active': d.last_active.isoformat() if d.last_active else None} for d in devices],
-            'device_limit': user.subscription.device_limit if user.subscription else 0
+            'devices': serialize_devices(devices),
+            'device_limit': subscription['device_limit'] if subscription else 0
         }), 200
     except NotFound as e:
         current_app.logger.warning(f"Client error in get_devices: {str(e)}")
@@ -68,7 +80,10 @@ def remove_device(device_id):
             raise NotFound('Device not found')
 
         db.session.delete(device)
+        bump_version(current_user_id)
         db.session.commit()
+        invalidate_entitlement(current_user_id)
+        push_hub.publish(current_user_id, DEVICES_CHANGED)
 
         return jsonify({'message': 'Device removed successfully'}), 200
     except NotFound as e:
@@ -83,13 +98,19 @@ def remove_device(device_id):
 def update_device_activity(device_id):
     try:
         current_user_id = get_jwt_identity()
-        device = Device.query.filter_by(id=device_id, user_id=current_user_id).first()
-        
-        if not device:
+        entitlement = get_entitlement(current_user_id)
+
+        if entitlement and device_id not in entitlement['device_ids']:
+            # The device may have been registered through another worker since
+            # the snapshot was cached.
+            invalidate_entitlement(current_user_id)
+            entitlement = get_entitlement(current_user_id)
+
+        if not entitlement or device_id not in entitlement['device_ids']:
             raise NotFound('Device not found')
 
-        device.last_active = datetime.utcnow()
-        db.session.commit()
+        # Buffered and written in bulk by the device_activity flusher.
+        device_activity.touch(device_id)
 
         return jsonify({'message': 'Device activity updated'}), 200
     except NotFound as e:
@@ -0,0 +1,18 @@
+import hmac
+from flask import Blueprint, Response, request, jsonify, current_app
+from utils.instrumentation import instrumentation
+
+internal_bp = Blueprint('internal', __name__)
+
+@internal_bp.route('/metrics', methods=['GET'])
+def scrape_metrics():
+    # Prometheus scrape target. Counters are per process, so scrape each
+    # worker (or run one worker per port) to see the whole node. Like the
+    # admin API, it is disabled while no METRICS_SCRAPE_TOKEN is configured.
+    token = current_app.config.get('METRICS_SCRAPE_TOKEN')
+    if not token:
+        return jsonify({'error': 'Not found'}), 404
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not hmac.compare_digest(supplied, token):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(instrumentation.render(), mimetype='text/plain; version=0.0.4')
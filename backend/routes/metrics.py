@@ -0,0 +1,96 @@
+from flask import Blueprint, request, jsonify
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from datetime import datetime, timedelta
+from services.metrics_service import GRANULARITIES, bucket_start, next_bucket, query_rollups, summarize_by_service
+from utils.db_routing import read_replica
+
+metrics_bp = Blueprint('metrics', __name__)
+
+# Upper bound on buckets per /usage call, per granularity.
+MAX_BUCKETS = {'hour': 24 * 31, 'day': 366, 'month': 120}
+PERIODS = ('day', 'week', 'month', 'year')
+
+def _parse_date(value, name):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'"{name}" must be an ISO 8601 date or datetime')
+
+def _period_start(period, now):
+    if period == 'day':
+        return bucket_start(now, 'day')
+    if period == 'week':
+        today = bucket_start(now, 'day')
+        return today - timedelta(days=today.weekday())
+    if period == 'month':
+        return bucket_start(now, 'month')
+    return bucket_start(now, 'month').replace(month=1)
+
+@metrics_bp.route('/usage', methods=['GET'])
+@jwt_required()
+@read_replica
+def get_usage():
+    current_user_id = int(get_jwt_identity())
+    granularity = request.args.get('granularity', 'day')
+    service = request.args.get('service')
+
+    if granularity not in GRANULARITIES:
+        return jsonify({'error': f'Invalid granularity, expected one of {", ".join(GRANULARITIES)}'}), 400
+
+    try:
+        end = _parse_date(request.args['end'], 'end') if 'end' in request.args else datetime.utcnow()
+        if 'start' in request.args:
+            start = _parse_date(request.args['start'], 'start')
+        else:
+            start = end - timedelta(days=7)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    start = bucket_start(start, granularity)
+    if end != bucket_start(end, granularity):
+        end = next_bucket(bucket_start(end, granularity), granularity)
+    if start >= end:
+        return jsonify({'error': '"start" must be before "end"'}), 400
+
+    bucket_count = 0
+    cursor = start
+    while cursor < end:
+        bucket_count += 1
+        if bucket_count > MAX_BUCKETS[granularity]:
+            return jsonify({'error': f'Range too large for granularity "{granularity}"'}), 400
+        cursor = next_bucket(cursor, granularity)
+
+    rows = query_rollups(current_user_id, granularity, start, end, service)
+    return jsonify({
+        'granularity': granularity,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'buckets': [{
+            'bucket_start': r.bucket_start.isoformat(),
+            'service': r.service,
+            'muted_time': r.muted_time,
+            'ads_muted': r.ads_muted
+        } for r in rows]
+    }), 200
+
+@metrics_bp.route('/summary', methods=['GET'])
+@jwt_required()
+@read_replica
+def get_summary():
+    current_user_id = int(get_jwt_identity())
+    period = request.args.get('period', 'week')
+
+    if period not in PERIODS:
+        return jsonify({'error': f'Invalid period, expected one of {", ".join(PERIODS)}'}), 400
+
+    now = datetime.utcnow()
+    start = _period_start(period, now)
+    by_service = summarize_by_service(current_user_id, start, now)
+    return jsonify({
+        'period': period,
+        'start': start.isoformat(),
+        'end': now.isoformat(),
+        'total_muted_time': sum(s['muted_time'] for s in by_service.values()),
+        'total_ads_muted': sum(s['ads_muted'] for s in by_service.values()),
+        'services': by_service
+    }), 200
@@ -0,0 +1,78 @@
+import time
+from flask import Blueprint, Response, jsonify, g, stream_with_context, current_app
+from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
+from app import db
+from services.entitlement_service import get_entitlement
+from services.push_service import push_hub, stream_state, format_event, format_retry, HEARTBEAT, KINDS
+from services.token_service import revocation_filter
+
+push_bp = Blueprint('push', __name__)
+
+RECONNECT_MS = 2000
+
+@push_bp.before_request
+def require_stream_workers():
+    # Sync workers would each be pinned by one stream; see PUSH_STREAM_WSGI.
+    if not current_app.config.get('PUSH_STREAM_WSGI'):
+        return jsonify({'error': 'Not found'}), 404
+
+@push_bp.route('/stream', methods=['GET'])
+@jwt_required()
+def stream():
+    # Server-sent events: the current subscription and devices state on
+    # connect, then again whenever one changes, with a comment line every
+    # PUSH_HEARTBEAT_INTERVAL seconds to keep proxies from timing out. The
+    # stream ends when the access token expires or is revoked (or after
+    # PUSH_MAX_STREAM_SECONDS) and the client reconnects with a fresh one.
+    # Each open stream holds a worker thread; the ASGI app serves the same
+    # endpoint from its event loop.
+    current_user_id = int(get_jwt_identity())
+    claims = get_jwt()
+    deadline = min(claims['exp'], time.time() + push_hub.max_stream_seconds)
+    channel = push_hub.subscribe(current_user_id)
+    if channel is None:
+        return jsonify({'message': 'Too many open streams'}), 429, {'Retry-After': str(push_hub.heartbeat_interval)}
+
+    def current_state(kinds):
+        # Fresh from the entitlement cache, not this request's copy of it,
+        # and without holding a database connection between events.
+        g.pop('_entitlements', None)
+        try:
+            entitlement = get_entitlement(current_user_id)
+        finally:
+            db.session.remove()
+        if entitlement is None:
+            return None
+        return ''.join(format_event(kind, stream_state(kind, entitlement)) for kind in kinds)
+
+    def revoked():
+        try:
+            return revocation_filter.is_revoked(claims)
+        finally:
+            db.session.remove()
+
+    def events():
+        try:
+            yield format_retry(RECONNECT_MS)
+            kinds = KINDS
+            while True:
+                if revoked():
+                    return
+                if kinds:
+                    state = current_state(kinds)
+                    if state is None:
+                        return
+                    yield state
+                else:
+                    yield HEARTBEAT
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                kinds = channel.wait(min(push_hub.heartbeat_interval, remaining))
+        finally:
+            push_hub.unsubscribe(channel)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
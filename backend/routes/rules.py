@@ -0,0 +1,45 @@
+import gzip
+from flask import Blueprint, Response, request, jsonify, current_app, url_for
+from services.rules_service import rule_bundles
+
+rules_bp = Blueprint('rules', __name__)
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+@rules_bp.route('/latest', methods=['GET'])
+def latest_rules():
+    # The small document clients poll. Shared caches may keep it for
+    # RULES_POINTER_MAX_AGE seconds; everything it points to is immutable.
+    version = rule_bundles.latest()
+    if version is None:
+        return jsonify({'error': 'No rules published'}), 404
+    response = jsonify({'version': version, 'bundle': url_for('rules.rule_bundle', version=version)})
+    response.set_etag(version)
+    response.headers['Cache-Control'] = f"public, max-age={current_app.config.get('RULES_POINTER_MAX_AGE', 300)}"
+    return response.make_conditional(request)
+
+@rules_bp.route('/bundle/<version>', methods=['GET'])
+def rule_bundle(version):
+    return _immutable(version, rule_bundles.bundle(version))
+
+@rules_bp.route('/delta/<from_version>/<version>', methods=['GET'])
+def rule_delta(from_version, version):
+    # Only the services that changed since from_version. A 404 means that
+    # version is no longer kept; fetch the whole bundle instead.
+    return _immutable(f'{from_version}-{version}', rule_bundles.delta(from_version, version))
+
+def _immutable(etag, body):
+    # Stored gzipped and sent as is to clients that accept it.
+    if body is None:
+        return jsonify({'error': 'Unknown rules version'}), 404
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(gzip.decompress(body), mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,38 @@
+from flask import Blueprint, jsonify
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from sqlalchemy.orm import joinedload
+from models import User
+from services.entitlement_service import build_snapshot, entitlement_cache
+from services.metrics_service import metrics_buffer
+from services.device_service import serialize_devices
+
+session_bp = Blueprint('session', __name__)
+
+@session_bp.route('/bootstrap', methods=['GET'])
+@jwt_required()
+def bootstrap():
+    # Everything the extension needs on wake-up, from one SELECT with the
+    # subscription and devices joined in.
+    current_user_id = int(get_jwt_identity())
+    user = User.query.options(
+        joinedload(User.subscription),
+        joinedload(User.devices)
+    ).filter(User.id == current_user_id).first()
+
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+
+    entitlement_cache.prime(user.id, build_snapshot(user, user.subscription, [d.id for d in user.devices]))
+
+    pending_time, pending_ads = metrics_buffer.pending_totals(user.id)
+    subscription = user.subscription.to_dict() if user.subscription else {'status': 'inactive'}
+    return jsonify({
+        'user': user.to_dict(),
+        'subscription': subscription,
+        'devices': serialize_devices(user.devices),
+        'device_limit': user.subscription.device_limit if user.subscription else 0,
+        'metrics': {
+            'total_muted_time': (user.total_muted_time or 0) + pending_time,
+            'total_ads_muted': (user.total_ads_muted or 0) + pending_ads
+        }
+    }), 200
@@ -3,8 +3,11 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import User, Subscription, Device
 from app import db
 from services.stripe_service import create_checkout_session, retrieve_checkout_session, cancel_subscription, construct_event
+from services.entitlement_service import get_entitlement, invalidate_entitlement, bump_version
+from services.webhook_service import record_event, stripe_event_worker
+from services.push_service import push_hub, SUBSCRIPTION_CHANGED
+from utils.etag import conditional_get
 from werkzeug.exceptions import BadRequest, NotFound
-from stripe.error import StripeError
 from datetime import datetime
 
 subscription_bp = Blueprint('subscription', __name__)
@@ -14,9 +17,9 @@ subscription_bp = Blueprint('subscription', __name__)
 def create_stripe_checkout_session():
     try:
         current_user_id = get_jwt_identity()
-        user = db.session.get(User, current_user_id)
+        entitlement = get_entitlement(current_user_id)
         
-        if not user:
+        if not entitlement:
             return jsonify({'error': 'User not found'}), 404
         
         data = request.json
@@ -25,7 +28,7 @@ def create_stripe_checkout_session():
         if plan not in ['basic_monthly', 'basic_yearly', 'premium_monthly', 'premium_yearly']:
             return jsonify({'error': 'Invalid plan'}), 400
         
-        session = create_checkout_session(user.id, plan)
+        session = create_checkout_session(entitlement['user']['id'], plan)
         
         return jsonify({'sessionId': session.id, 'url': session.url})
     except Exception as e:
@@ -64,7 +67,10 @@ def subscription_success():
             current_period_end=datetime.fromtimestamp(stripe_subscription.current_period_end)
         )
         db.session.add(subscription)
+        bump_version(user.id)
         db.session.commit()
+        invalidate_entitlement(user.id)
+        push_hub.publish(user.id, SUBSCRIPTION_CHANGED)
 
         current_app.logger.info(f'Subscription created successfully for user: {user_id}')
         return render_template('subscription_success.html')
@@ -74,15 +80,16 @@ def subscription_success():
 
 @subscription_bp.route('/subscription', methods=['GET'])
 @jwt_required()
+@conditional_get('subscription', state=lambda user_id, entitlement: entitlement['subscription'])
 def get_subscription():
     try:
         current_user_id = get_jwt_identity()
-        user = User.query.get(current_user_id)
+        entitlement = get_entitlement(current_user_id)
         
-        if not user:
+        if not entitlement:
             return jsonify({'error': 'User not found'}), 404
         
-        subscription = Subscription.query.filter_by(user_id=current_user_id).first()
+        subscription = entitlement['subscription']
         
         if not subscription:
             return jsonify({
@@ -91,10 +98,10 @@ def get_subscription():
             }), 200
         
         return jsonify({
-            'status': subscription.status,
-            'plan': subscription.plan,
-            'device_limit': subscription.device_limit,
-            'current_period_end': subscription.current_period_end.isoformat() if subscription.current_period_end else None
+            'status': subscription['status'],
+            'plan': subscription['plan'],
+            'device_limit': subscription['device_limit'],
+            'current_period_end': subscription['current_period_end']
         }), 200
     
     except Exception as e:
@@ -104,6 +111,7 @@ def get_subscription():
 @subscription_bp.route('/cancel', methods=['POST'])
 @jwt_required()
 def cancel_subscription_route():
+    from stripe.error import StripeError
     try:
         current_user_id = get_jwt_identity()
         user = db.session.get(User, current_user_id)
@@ -115,7 +123,10 @@ def cancel_subscription_route():
         
         user.subscription.status = stripe_subscription.status
         user.subscription.current_period_end = datetime.fromtimestamp(stripe_subscription.current_period_end)
+        bump_version(user.id)
         db.session.commit()
+        invalidate_entitlement(user.id)
+        push_hub.publish(user.id, SUBSCRIPTION_CHANGED)
         
         return jsonify({'message': 'Subscription cancelled successfully'}), 200
     except NotFound as e:
@@ -129,23 +140,20 @@ def cancel_subscription_route():
 
 @subscription_bp.route('/webhook', methods=['POST'])
 def webhook():
+    # Verify and persist only; the Stripe event worker applies events in
+    # `created` order, so Stripe gets its 200 without waiting on handlers.
     payload = request.data
     sig_header = request.headers.get('Stripe-Signature')
 
     try:
         event = construct_event(payload, sig_header, current_app.config['STRIPE_WEBHOOK_SECRET'])
+    except Exception as e:
+        current_app.logger.warning(f'Rejected webhook: {str(e)}')
+        return jsonify(error='Invalid webhook signature'), 400
 
-        if event['type'] == 'customer.subscription.updated':
-            handle_subscription_updated(event['data']['object'])
-        elif event['type'] == 'customer.subscription.deleted':
-            handle_subscription_deleted(event['data']['object'])
-        elif event['type'] == 'invoice.payment_succeeded':
-            handle_invoice_paid(event['data']['object'])
-        elif event['type'] == 'invoice.payment_failed':
-            handle_invoice_failed(event['data']['object'])
-        else:
-            current_app.logger.info(f"Unhandled event type: {event['type']}")
-
+    try:
+        record_event(event)
+        stripe_event_worker.notify()
         return jsonify(success=True), 200
     except Exception as e:
         current_app.logger.error(f'Error in webhook: {str(e)}')
@@ -154,41 +162,3 @@ def webhook():
 @subscription_bp.route('/subscription-cancel')
 def subscription_cancel():
     return redirect(url_for('subscription.get_subscription'))
-
-def handle_subscription_updated(stripe_subscription):
-    subscription = Subscription.query.filter_by(stripe_subscription_id=stripe_subscription.id).first()
-    if subscription:
-        subscription.status = stripe_subscription.status
-        subscription.current_period_end = datetime.fromtimestamp(stripe_subscription.current_period_end)
-        db.session.commit()
-        current_app.logger.info(f"Subscription {subscription.id} updated")
-    else:
-        current_app.logger.warning(f"No subscription found for Stripe subscription: {stripe_subscription.id}")
-
-def handle_subscription_deleted(stripe_subscription):
-    subscription = Subscription.query.filter_by(stripe_subscription_id=stripe_subscription.id).first()
-    if subscription:
-        subscription.status = 'cancelled'
-        db.session.commit()
-        current_app.logger.info(f"Subscription {subscription.id} marked as cancelled")
-    else:
-        current_app.logger.warning(f"No subscription found for Stripe subscription: {stripe_subscription.id}")
-
-def handle_invoice_paid(invoice):
-    subscription = Subscription.query.filter_by(stripe_subscription_id=invoice.subscription).first()
-    if subscription:
-        subscription.status = 'active'
-        subscription.current_period_end = datetime.fromtimestamp(invoice.lines.data[0].period.end)
-        db.session.commit()
-        current_app.logger.info(f"Subscription {subscription.id} renewed")
-    else:
-        current_app.logger.warning(f"No subscription found for invoice: {invoice.id}")
-
-def handle_invoice_failed(invoice):
-    subscription = Subscription.query.filter_by(stripe_subscription_id=invoice.subscription).first()
-    if subscription:
-        subscription.status = 'past_due'
-        db.session.commit()
-        current_app.logger.info(f"Subscription {subscription.id} marked as past due")
-    else:
-        current_app.logger.warning(f"No subscription found for invoice: {invoice.id}")
\ No newline at end of file
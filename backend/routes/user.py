@@ -1,29 +1,84 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models import User
 from app import db
+from services.metrics_service import metrics_buffer, parse_events
+from services.entitlement_service import get_entitlement, invalidate_entitlement
+from services.export_service import DATASETS, export_lines, export_mimetype, parse_export_args
+from utils.etag import conditional_get
+from utils.db_routing import read_replica, replica_router
 
 user_bp = Blueprint('user', __name__)
 
 @user_bp.route('/metrics', methods=['GET', 'POST'])
 @jwt_required()
+@conditional_get('metrics', extra=lambda user_id, entitlement: metrics_buffer.pending_totals(user_id))
 def user_metrics():
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
+    current_user_id = int(get_jwt_identity())
 
     if request.method == 'POST':
+        user = db.session.get(User, current_user_id)
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+
+        # Legacy whole-total overwrite, kept for extension versions that
+        # predate /user/metrics/events.
         metrics = request.json
         user.total_muted_time = metrics.get('timeMuted', user.total_muted_time)
         user.total_ads_muted = metrics.get('adsMuted', user.total_ads_muted)
-        
+        user.data_version = User.data_version + 1
+
         db.session.commit()
-        
+        invalidate_entitlement(current_user_id)
+
         return jsonify({'message': 'User metrics updated successfully'}), 200
     else:  # GET request
+        entitlement = get_entitlement(current_user_id)
+        if not entitlement:
+            return jsonify({'error': 'User not found'}), 404
+
+        pending_time, pending_ads = metrics_buffer.pending_totals(current_user_id)
         return jsonify({
-            'total_muted_time': user.total_muted_time,
-            'total_ads_muted': user.total_ads_muted
-        }), 200
\ No newline at end of file
+            'total_muted_time': (entitlement['user']['total_muted_time'] or 0) + pending_time,
+            'total_ads_muted': (entitlement['user']['total_ads_muted'] or 0) + pending_ads
+        }), 200
+
+@user_bp.route('/metrics/events', methods=['POST'])
+@jwt_required()
+def ingest_metric_events():
+    current_user_id = int(get_jwt_identity())
+    try:
+        events = parse_events(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    accepted, duplicates = metrics_buffer.add_events(current_user_id, events)
+    current_app.logger.debug(f'Buffered {accepted} metric events for user: {current_user_id}')
+    return jsonify({'accepted': accepted, 'duplicates': duplicates}), 202
+
+@user_bp.route('/export', methods=['GET'])
+@jwt_required()
+@read_replica
+def export_data():
+    # Data export for the signed-in user: every dataset as NDJSON, or one
+    # dataset as CSV (?format=csv&dataset=devices). Streamed as it is read.
+    current_user_id = int(get_jwt_identity())
+    try:
+        fmt, datasets = parse_export_args(request.args, DATASETS)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Include buffered metric events in the export. The flush checks users
+    # and recorded event ids, which must come from the primary, and if it
+    # wrote some of this user's events the export reads them there too.
+    pending = metrics_buffer.pending_totals(current_user_id)[1]
+    with replica_router.primary():
+        metrics_buffer.flush_now()
+    if pending:
+        replica_router.use_primary()
+    current_app.logger.info(f'Exporting {", ".join(datasets)} for user: {current_user_id}')
+    return Response(
+        stream_with_context(export_lines(fmt, datasets, user_id=current_user_id)),
+        mimetype=export_mimetype(fmt),
+        headers={'Content-Disposition': f'attachment; filename="export-{current_user_id}.{fmt}"'}
+    )
@@ -0,0 +1,209 @@
+import random
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, attributes
+from app import db
+from models import User, Device, Subscription, GlobalCounter
+from utils.helpers import dialect_insert
+
+USERS = 'users'
+DEVICES = 'devices'
+ADS_MUTED = 'ads_muted'
+MUTED_TIME = 'muted_time'
+SUBSCRIPTIONS_PREFIX = 'subscriptions:'
+UNKNOWN = object()
+
+
+def subscription_counter(status, plan):
+    return f'{SUBSCRIPTIONS_PREFIX}{status}:{plan}'
+
+
+class GlobalCounters:
+    # Incrementally maintained totals for the admin dashboard, written in the
+    # same transaction as the change they count:
+    #   - ORM inserts, deletes and updates of users, devices and
+    #     subscriptions are counted by a Session after_flush hook, which
+    #     covers the async API's sessions too;
+    #   - bulk Core statements (metrics flushes, device registration and
+    #     sweeps) call add() themselves.
+    # reconcile() recomputes everything from the source tables and corrects
+    # any drift, e.g. from rows changed outside the app.
+
+    def __init__(self):
+        self.shards = 16
+
+    def init_app(self, app):
+        self.shards = app.config.get('GLOBAL_COUNTER_SHARDS', 16)
+        app.extensions['global_counters'] = self
+        _listen_once()
+
+    def increments(self, session, deltas):
+        # Upsert adding each non-zero delta onto one random shard, or None.
+        # Rows go in name order so concurrent writers lock them in the same order.
+        shard = random.randrange(self.shards)
+        rows = [{'name': name, 'shard': shard, 'value': delta}
+                for name, delta in sorted(deltas.items()) if delta]
+        if not rows:
+            return None, rows
+        stmt = dialect_insert(session, GlobalCounter.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['name', 'shard'],
+            set_={'value': GlobalCounter.__table__.c.value + stmt.excluded.value}
+        )
+        return stmt, rows
+
+    def add(self, session, deltas):
+        stmt, rows = self.increments(session, deltas)
+        if stmt is not None:
+            session.execute(stmt, rows)
+
+    async def add_async(self, session, deltas):
+        stmt, rows = self.increments(session.sync_session, deltas)
+        if stmt is not None:
+            await session.execute(stmt, rows)
+
+    def totals(self):
+        # One grouped read over the counter rows; independent of table sizes.
+        rows = db.session.execute(
+            select(GlobalCounter.name, func.sum(GlobalCounter.value)).group_by(GlobalCounter.name)
+        ).all()
+        return {name: int(value or 0) for name, value in rows}
+
+    def reconcile(self):
+        # Recounts from the source tables and adds the difference to each
+        # drifted counter. Both sides are read in one snapshot, and the
+        # corrections are increments, so writes that commit meanwhile are
+        # neither lost nor counted twice. Returns {name: correction}.
+        if db.session.get_bind().dialect.name == 'postgresql':
+            db.session.rollback()
+            db.session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        actual = recount()
+        current = self.totals()
+        db.session.rollback()
+
+        corrections = {}
+        for name in set(actual) | set(current):
+            delta = actual.get(name, 0) - current.get(name, 0)
+            if delta:
+                corrections[name] = delta
+        if corrections:
+            self.add(db.session, corrections)
+            db.session.commit()
+            current_app.logger.warning(f'Corrected global counter drift: {corrections}')
+        return corrections
+
+
+global_counters = GlobalCounters()
+
+
+def recount():
+    # The full-scan aggregates the counters stand in for.
+    totals = {
+        USERS: db.session.scalar(select(func.count()).select_from(User)),
+        DEVICES: db.session.scalar(select(func.count()).select_from(Device)),
+        ADS_MUTED: db.session.scalar(select(func.coalesce(func.sum(User.total_ads_muted), 0))),
+        MUTED_TIME: db.session.scalar(select(func.coalesce(func.sum(User.total_muted_time), 0))),
+    }
+    for status, plan, count in db.session.execute(
+        select(Subscription.status, Subscription.plan, func.count()).group_by(Subscription.status, Subscription.plan)
+    ):
+        totals[subscription_counter(status, plan)] = count
+    return {name: int(value or 0) for name, value in totals.items()}
+
+
+def dashboard(totals, monthly_prices=None):
+    # Shapes totals() for the admin API. `monthly_prices` maps plan to its
+    # monthly amount (yearly plans divided by 12) for the revenue estimate.
+    subscriptions = defaultdict(dict)
+    for name, value in totals.items():
+        if name.startswith(SUBSCRIPTIONS_PREFIX) and value:
+            status, plan = name[len(SUBSCRIPTIONS_PREFIX):].split(':', 1)
+            subscriptions[status][plan] = value
+    active = subscriptions.get('active', {})
+    revenue = None
+    if monthly_prices:
+        revenue = sum(count * monthly_prices.get(plan, 0) for plan, count in active.items())
+    return {
+        'users': totals.get(USERS, 0),
+        'devices': totals.get(DEVICES, 0),
+        'total_ads_muted': totals.get(ADS_MUTED, 0),
+        'total_muted_time': totals.get(MUTED_TIME, 0),
+        'subscriptions': dict(subscriptions),
+        'active_subscriptions': sum(active.values()),
+        'monthly_recurring_revenue': revenue
+    }
+
+
+def _old_and_new(obj, key):
+    # Values before and after this flush, without loading anything: either
+    # side is UNKNOWN if the attribute was expired or set without being
+    # loaded first. reconcile() covers those rare cases.
+    history = attributes.get_history(obj, key, passive=attributes.PASSIVE_NO_INITIALIZE)
+    if history.unchanged:
+        return history.unchanged[0], history.unchanged[0]
+    old = history.deleted[0] if history.deleted else UNKNOWN
+    new = history.added[0] if history.added else UNKNOWN
+    return (old, new) if old is not UNKNOWN else (UNKNOWN, UNKNOWN)
+
+
+def _count_flushed_rows(session, flush_context):
+    deltas = defaultdict(int)
+    for obj in session.new:
+        if isinstance(obj, User):
+            deltas[USERS] += 1
+            deltas[ADS_MUTED] += obj.total_ads_muted or 0
+            deltas[MUTED_TIME] += obj.total_muted_time or 0
+        elif isinstance(obj, Device):
+            deltas[DEVICES] += 1
+        elif isinstance(obj, Subscription):
+            deltas[subscription_counter(obj.status, obj.plan)] += 1
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            deltas[USERS] -= 1
+            for name, key in ((ADS_MUTED, 'total_ads_muted'), (MUTED_TIME, 'total_muted_time')):
+                old, _ = _old_and_new(obj, key)
+                if _is_number(old):
+                    deltas[name] -= old or 0
+        elif isinstance(obj, Device):
+            deltas[DEVICES] -= 1
+        elif isinstance(obj, Subscription):
+            old_status, _ = _old_and_new(obj, 'status')
+            old_plan, _ = _old_and_new(obj, 'plan')
+            if old_status is not UNKNOWN and old_plan is not UNKNOWN:
+                deltas[subscription_counter(old_status, old_plan)] -= 1
+    for obj in session.dirty:
+        if obj in session.deleted:
+            continue
+        if isinstance(obj, User):
+            for name, key in ((ADS_MUTED, 'total_ads_muted'), (MUTED_TIME, 'total_muted_time')):
+                old, new = _old_and_new(obj, key)
+                if _is_number(old) and _is_number(new):
+                    deltas[name] += (new or 0) - (old or 0)
+        elif isinstance(obj, Subscription):
+            old_status, new_status = _old_and_new(obj, 'status')
+            old_plan, new_plan = _old_and_new(obj, 'plan')
+            if UNKNOWN in (old_status, old_plan):
+                continue
+            if (old_status, old_plan) != (new_status, new_plan):
+                deltas[subscription_counter(old_status, old_plan)] -= 1
+                deltas[subscription_counter(new_status, new_plan)] += 1
+    stmt, rows = global_counters.increments(session, deltas)
+    if stmt is not None:
+        session.connection().execute(stmt, rows)
+
+
+def _is_number(value):
+    # Not UNKNOWN and not a SQL expression such as `User.total_ads_muted + 1`.
+    return value is None or isinstance(value, int)
+
+
+_listening = False
+
+
+def _listen_once():
+    global _listening
+    if _listening:
+        return
+    event.listen(Session, 'after_flush', _count_flushed_rows)
+    _listening = True
@@ -0,0 +1,51 @@
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+# Async drivers for the sync URLs the rest of the app is configured with.
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_database_url(url):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No async driver configured for {backend}')
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+class AsyncDatabase:
+    # Async engine and session factory over the same models and database as
+    # the Flask app. A request holds a pooled connection only while it is
+    # actually talking to the database, so idle long-lived clients cost no
+    # connection and no thread.
+
+    def __init__(self):
+        self.engine = None
+        self._sessionmaker = None
+
+    def init_app(self, app):
+        url = app.config.get('ASYNC_SQLALCHEMY_DATABASE_URI') or async_database_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        options = {}
+        if make_url(url).get_backend_name() != 'sqlite':
+            options.update(
+                pool_size=app.config.get('ASYNC_DB_POOL_SIZE', 20),
+                max_overflow=app.config.get('ASYNC_DB_MAX_OVERFLOW', 10),
+                pool_timeout=app.config.get('ASYNC_DB_POOL_TIMEOUT', 5),
+                pool_pre_ping=True
+            )
+        self.engine = create_async_engine(url, **options)
+        self._sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+        app.extensions['async_db'] = self
+
+    def session(self):
+        return self._sessionmaker()
+
+    async def dispose(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+
+
+async_db = AsyncDatabase()
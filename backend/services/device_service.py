@@ -0,0 +1,260 @@
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import bindparam, func, literal, or_, select, update, delete
+from sqlalchemy.exc import OperationalError
+from app import db
+from models import Device, Subscription
+from services.entitlement_service import invalidate_entitlement, bump_version, version_bump
+from services.push_service import push_hub, DEVICES_CHANGED
+from services.analytics_service import global_counters, DEVICES
+from utils.helpers import dialect_insert
+from utils.write_behind import WriteBehindBuffer
+
+SWEEP_BATCH_SIZE = 500
+SERIALIZATION_RETRIES = 3
+
+# register_user_device() outcomes
+DEVICE_CREATED = 'created'
+DEVICE_EXISTS = 'exists'
+DEVICE_OWNED_ELSEWHERE = 'owned_elsewhere'
+DEVICE_LIMIT_REACHED = 'limit_reached'
+SUBSCRIPTION_REQUIRED = 'subscription_required'
+
+
+class DeviceActivityBuffer(WriteBehindBuffer):
+    # Last-seen map for device heartbeats. Each flush writes every touched
+    # device once, as a single executemany UPDATE, however many heartbeats
+    # arrived in between.
+
+    name = 'device_activity'
+    config_prefix = 'DEVICE_ACTIVITY'
+    default_interval = 30
+
+    def _reset(self):
+        self._pending = {}
+
+    def touch(self, device_id, when=None):
+        when = when or datetime.utcnow()
+        with self._lock:
+            if device_id not in self._pending:
+                self._pending_count += 1
+            if self._pending.get(device_id) is None or self._pending[device_id] < when:
+                self._pending[device_id] = when
+        self.added()
+
+    def last_seen(self, device_id):
+        with self._lock:
+            return self._pending.get(device_id)
+
+    def _take(self):
+        batch, self._pending = self._pending, {}
+        return batch
+
+    def _restore(self, batch):
+        with self._lock:
+            for device_id, when in batch.items():
+                current = self._pending.get(device_id)
+                if current is None:
+                    self._pending_count += 1
+                if current is None or current < when:
+                    self._pending[device_id] = when
+
+    def flush(self, batch):
+        device_table = Device.__table__
+        try:
+            owners = db.session.scalars(
+                select(device_table.c.user_id).where(device_table.c.id.in_(list(batch))).distinct()
+            ).all()
+            # The last_active guard keeps a slow flush from moving a timestamp backwards.
+            db.session.execute(
+                update(device_table)
+                .where(device_table.c.id == bindparam('b_id'))
+                .where(or_(device_table.c.last_active.is_(None), device_table.c.last_active < bindparam('b_last_active')))
+                .values(last_active=bindparam('b_last_active')),
+                [{'b_id': device_id, 'b_last_active': when} for device_id, when in batch.items()]
+            )
+            # Once flushed, a heartbeat is no longer in any worker's pending
+            # map, so the /devices/list ETag has to move with data_version.
+            bump_version(*owners)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for user_id in owners:
+            invalidate_entitlement(user_id)
+        return len(batch)
+
+
+device_activity = DeviceActivityBuffer()
+
+
+def serialize_devices(devices):
+    # Device dicts with heartbeats that have not been flushed yet applied.
+    result = []
+    for device in devices:
+        data = device.to_dict()
+        pending = device_activity.last_seen(device.id)
+        if pending and (device.last_active is None or pending > device.last_active):
+            data['last_active'] = pending.isoformat()
+        result.append(data)
+    return result
+
+
+def pending_heartbeats(device_ids):
+    # This worker's unflushed last-seen times for device_ids, for the
+    # /devices/list ETag; flushes bump data_version.
+    return tuple(device_activity.last_seen(device_id) for device_id in sorted(device_ids))
+
+
+def register_user_device(user_id, device_id, name):
+    # Registers device_id for user_id in a single INSERT ... SELECT ... ON
+    # CONFLICT statement that only inserts while the user's device count is
+    # below the active subscription's device_limit. Re-registering one's own
+    # device refreshes last_active. The statement runs in a SERIALIZABLE
+    # transaction so concurrent registrations cannot both pass the count
+    # check. Returns (outcome, device pk or None).
+    user_id = int(user_id)
+    for attempt in range(SERIALIZATION_RETRIES):
+        # Isolation can only be set at the start of a transaction.
+        db.session.rollback()
+        db.session.connection(execution_options={'isolation_level': 'SERIALIZABLE'})
+        try:
+            row = db.session.execute(
+                _registration_statement(db.session, user_id, device_id, name, datetime.utcnow())
+            ).first()
+            if row is not None:
+                bump_version(user_id)
+                if row.created:
+                    global_counters.add(db.session, {DEVICES: 1})
+            db.session.commit()
+            break
+        except OperationalError as e:
+            db.session.rollback()
+            if getattr(e.orig, 'pgcode', None) != '40001' or attempt == SERIALIZATION_RETRIES - 1:
+                raise
+
+    if row is not None:
+        invalidate_entitlement(user_id)
+        if row.created:
+            push_hub.publish(user_id, DEVICES_CHANGED)
+        return (DEVICE_CREATED if row.created else DEVICE_EXISTS), row.id
+
+    # Nothing inserted or updated; a read to explain why is fine off the hot path.
+    existing = db.session.execute(_owner_query(device_id)).first()
+    if existing and existing.user_id == user_id:
+        # Already registered while at the limit, so the SELECT produced no row to upsert.
+        device_activity.touch(existing.id)
+        return DEVICE_EXISTS, existing.id
+    if existing:
+        return DEVICE_OWNED_ELSEWHERE, None
+    if not db.session.execute(_active_subscription_query(user_id)).first():
+        return SUBSCRIPTION_REQUIRED, None
+    return DEVICE_LIMIT_REACHED, None
+
+
+async def register_user_device_async(session, user_id, device_id, name):
+    # register_user_device() on an AsyncSession, for the ASGI API.
+    user_id = int(user_id)
+    for attempt in range(SERIALIZATION_RETRIES):
+        await session.rollback()
+        await session.connection(execution_options={'isolation_level': 'SERIALIZABLE'})
+        try:
+            row = (await session.execute(
+                _registration_statement(session.sync_session, user_id, device_id, name, datetime.utcnow())
+            )).first()
+            if row is not None:
+                await session.execute(version_bump([user_id]))
+                if row.created:
+                    await global_counters.add_async(session, {DEVICES: 1})
+            await session.commit()
+            break
+        except OperationalError as e:
+            await session.rollback()
+            if getattr(e.orig, 'pgcode', None) != '40001' or attempt == SERIALIZATION_RETRIES - 1:
+                raise
+
+    if row is not None:
+        invalidate_entitlement(user_id)
+        if row.created:
+            push_hub.publish(user_id, DEVICES_CHANGED)
+        return (DEVICE_CREATED if row.created else DEVICE_EXISTS), row.id
+
+    existing = (await session.execute(_owner_query(device_id))).first()
+    if existing and existing.user_id == user_id:
+        device_activity.touch(existing.id)
+        return DEVICE_EXISTS, existing.id
+    if existing:
+        return DEVICE_OWNED_ELSEWHERE, None
+    if not (await session.execute(_active_subscription_query(user_id))).first():
+        return SUBSCRIPTION_REQUIRED, None
+    return DEVICE_LIMIT_REACHED, None
+
+
+def _owner_query(device_id):
+    return select(Device.id, Device.user_id).where(Device.device_id == device_id)
+
+
+def _active_subscription_query(user_id):
+    return select(Subscription.id).where(Subscription.user_id == user_id, Subscription.status == 'active')
+
+
+def _registration_statement(session, user_id, device_id, name, now):
+    device_table = Device.__table__
+    device_count = (
+        select(func.count())
+        .select_from(device_table)
+        .where(device_table.c.user_id == user_id)
+        .scalar_subquery()
+    )
+    device_limit = (
+        select(Subscription.device_limit)
+        .where(Subscription.user_id == user_id, Subscription.status == 'active')
+        .scalar_subquery()
+    )
+    stmt = dialect_insert(session, device_table).from_select(
+        ['user_id', 'device_id', 'name', 'last_active', 'created_at'],
+        select(literal(user_id), literal(device_id), literal(name), literal(now), literal(now))
+        .where(device_count < device_limit)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['device_id'],
+        set_={'last_active': stmt.excluded.last_active},
+        where=device_table.c.user_id == stmt.excluded.user_id
+    )
+    # created_at only equals `now` on a fresh insert.
+    return stmt.returning(device_table.c.id, (device_table.c.created_at == literal(now)).label('created'))
+
+
+def sweep_stale_devices(max_idle_days=None, batch_size=SWEEP_BATCH_SIZE, dry_run=False):
+    # Removes devices idle for longer than max_idle_days, in batches found
+    # through the last_active index. With dry_run the matching devices are
+    # only counted. Returns the number of stale devices.
+    if max_idle_days is None:
+        max_idle_days = current_app.config.get('DEVICE_STALE_DAYS', 90)
+    device_activity.flush_now()
+    cutoff = datetime.utcnow() - timedelta(days=max_idle_days)
+
+    if dry_run:
+        return db.session.query(Device).filter(Device.last_active < cutoff).count()
+
+    removed = 0
+    while True:
+        rows = db.session.execute(
+            select(Device.id, Device.user_id)
+            .where(Device.last_active < cutoff)
+            .order_by(Device.last_active)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        user_ids = {row.user_id for row in rows}
+        db.session.execute(delete(Device).where(Device.id.in_([row.id for row in rows])))
+        bump_version(*user_ids)
+        global_counters.add(db.session, {DEVICES: -len(rows)})
+        db.session.commit()
+        for user_id in user_ids:
+            invalidate_entitlement(user_id)
+            push_hub.publish(user_id, DEVICES_CHANGED)
+        removed += len(rows)
+        current_app.logger.info(f'Pruned {len(rows)} stale devices ({removed} so far)')
+    return removed
@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import g, has_app_context
+from sqlalchemy import select, update
+from app import db
+from models import User, Subscription, Device
+from utils.db_routing import replica_router
+
+
+class EntitlementCache:
+    # Bounded TTL/LRU cache of compact per-user snapshots (profile,
+    # subscription and device ids), fronted by a per-request dict in `g`.
+    # Anything that changes those rows must call invalidate(); the TTL only
+    # bounds staleness for writes made by other processes.
+
+    def __init__(self):
+        self.ttl = 30
+        self.max_size = 10000
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('ENTITLEMENT_CACHE_TTL', 30)
+        self.max_size = app.config.get('ENTITLEMENT_CACHE_SIZE', 10000)
+        self.clear()
+        app.extensions['entitlement_cache'] = self
+
+    def get(self, user_id):
+        user_id = int(user_id)
+        request_cache = _request_cache()
+        if request_cache is not None and user_id in request_cache:
+            return request_cache[user_id]
+
+        snapshot = self._get_cached(user_id)
+        if snapshot is None:
+            self.misses += 1
+            snapshot = load_snapshot(user_id)
+            if snapshot is not None:
+                self._put(user_id, snapshot)
+        else:
+            self.hits += 1
+
+        if request_cache is not None:
+            request_cache[user_id] = snapshot
+        return snapshot
+
+    def cached(self, user_id):
+        # Process-level lookup without the per-request layer, for the async
+        # API where there is no Flask app context.
+        snapshot = self._get_cached(int(user_id))
+        if snapshot is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return snapshot
+
+    def invalidate(self, user_id):
+        user_id = int(user_id)
+        with self._lock:
+            self._entries.pop(user_id, None)
+        request_cache = _request_cache()
+        if request_cache is not None:
+            request_cache.pop(user_id, None)
+
+    def prime(self, user_id, snapshot):
+        user_id = int(user_id)
+        self._put(user_id, snapshot)
+        request_cache = _request_cache()
+        if request_cache is not None:
+            request_cache[user_id] = snapshot
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get_cached(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, snapshot = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def _put(self, user_id, snapshot):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+def _request_cache():
+    if not has_app_context():
+        return None
+    if '_entitlements' not in g:
+        g._entitlements = {}
+    return g._entitlements
+
+
+def load_snapshot(user_id):
+    # One round trip: the user, its subscription and device ids, one row per
+    # device. Always from the primary, since the snapshot outlives the request.
+    with replica_router.primary():
+        return _snapshot_from_rows(db.session.execute(_snapshot_query(user_id)).all())
+
+
+async def load_snapshot_async(session, user_id):
+    return _snapshot_from_rows((await session.execute(_snapshot_query(user_id))).all())
+
+
+def _snapshot_query(user_id):
+    return (
+        select(User, Subscription, Device.id)
+        .outerjoin(Subscription, Subscription.user_id == User.id)
+        .outerjoin(Device, Device.user_id == User.id)
+        .where(User.id == user_id)
+    )
+
+
+def _snapshot_from_rows(rows):
+    if not rows:
+        return None
+    return build_snapshot(rows[0][0], rows[0][1], [device_id for _, _, device_id in rows if device_id is not None])
+
+
+def build_snapshot(user, subscription, device_ids):
+    return {
+        'user': user.to_dict(),
+        'subscription': dict(subscription.to_dict(), stripe_subscription_id=subscription.stripe_subscription_id)
+        if subscription else None,
+        'device_ids': frozenset(device_ids),
+        'version': user.data_version
+    }
+
+
+entitlement_cache = EntitlementCache()
+
+
+def get_entitlement(user_id):
+    return entitlement_cache.get(user_id)
+
+
+async def get_entitlement_async(session, user_id):
+    user_id = int(user_id)
+    snapshot = entitlement_cache.cached(user_id)
+    if snapshot is None:
+        snapshot = await load_snapshot_async(session, user_id)
+        if snapshot is not None:
+            entitlement_cache.prime(user_id, snapshot)
+    return snapshot
+
+
+def invalidate_entitlement(user_id):
+    entitlement_cache.invalidate(user_id)
+
+
+def bump_version(*user_ids):
+    # Advances data_version inside the caller's transaction, so the new ETag
+    # becomes visible together with the change it describes.
+    if user_ids:
+        db.session.execute(version_bump(user_ids))
+
+
+def version_bump(user_ids):
+    return (
+        update(User).where(User.id.in_([int(user_id) for user_id in user_ids]))
+        .values(data_version=User.data_version + 1)
+        .execution_options(synchronize_session=False)
+    )
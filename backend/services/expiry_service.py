@@ -0,0 +1,76 @@
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update
+from app import db
+from models import Subscription
+from services.analytics_service import global_counters, subscription_counter
+from services.entitlement_service import invalidate_entitlement, bump_version
+from services.push_service import push_hub, SUBSCRIPTION_CHANGED
+
+EXPIRY_BATCH_SIZE = 500
+EXPIRED = 'expired'
+# Statuses that grant or may regain access, and so can lapse.
+LAPSING_STATUSES = ('active', 'trialing', 'past_due')
+
+
+def expire_lapsed_subscriptions(grace_hours=None, batch_size=EXPIRY_BATCH_SIZE):
+    # Moves subscriptions whose current_period_end passed more than
+    # grace_hours ago to 'expired', so entitlement reads can keep trusting
+    # `status`. Each status is walked through the (status,
+    # current_period_end) index in batches; every batch is one short
+    # transaction that also bumps the users' data versions and adjusts the
+    # global counters. Returns {previous status: rows expired}.
+    if grace_hours is None:
+        grace_hours = current_app.config.get('SUBSCRIPTION_EXPIRY_GRACE_HOURS', 24)
+    # current_period_end holds local times (datetime.fromtimestamp of Stripe's value).
+    cutoff = datetime.now() - timedelta(hours=grace_hours)
+
+    expired = {}
+    for status in LAPSING_STATUSES:
+        expired[status] = 0
+        while True:
+            rows = db.session.execute(
+                select(Subscription.id, Subscription.user_id, Subscription.plan)
+                .where(Subscription.status == status, Subscription.current_period_end < cutoff)
+                .order_by(Subscription.current_period_end)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                db.session.rollback()
+                break
+            db.session.execute(
+                update(Subscription)
+                .where(Subscription.id.in_([row.id for row in rows]))
+                .values(status=EXPIRED, updated_at=datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+            user_ids = [row.user_id for row in rows]
+            bump_version(*user_ids)
+            deltas = {}
+            for row in rows:
+                for name, delta in ((subscription_counter(status, row.plan), -1),
+                                    (subscription_counter(EXPIRED, row.plan), 1)):
+                    deltas[name] = deltas.get(name, 0) + delta
+            global_counters.add(db.session, deltas)
+            db.session.commit()
+            for user_id in user_ids:
+                invalidate_entitlement(user_id)
+                push_hub.publish(user_id, SUBSCRIPTION_CHANGED)
+            expired[status] += len(rows)
+            if len(rows) < batch_size:
+                break
+
+    total = sum(expired.values())
+    if total:
+        current_app.logger.info(f'Expired {total} lapsed subscriptions: {expired}')
+    return expired
+
+
+def run_expiry_sweeper(interval=300, grace_hours=None):
+    # Blocking loop for a scheduler-less deployment; cron can call
+    # `manage.py expire_subscriptions` instead.
+    while True:
+        expire_lapsed_subscriptions(grace_hours)
+        time.sleep(interval)
@@ -0,0 +1,135 @@
+import csv
+import io
+import json
+from datetime import datetime
+from sqlalchemy import select
+from app import db
+from models import User, Subscription, Device, MetricRollup
+from services.partition_service import PARENT_TABLE, attached_partitions, event_table
+
+EXPORT_BATCH_SIZE = 1000
+FORMATS = ('ndjson', 'csv')
+
+AD_EVENTS = event_table(PARENT_TABLE)
+
+# Exported columns per dataset, in CSV column order. Password hashes and
+# internal bookkeeping (data_version, webhook ordering) are never exported.
+# 'ad_events' are the raw events still kept in attached partitions.
+DATASETS = {
+    'users': (User, 'id', [
+        User.id, User.username, User.email, User.created_at, User.total_muted_time, User.total_ads_muted
+    ]),
+    'subscriptions': (Subscription, 'user_id', [
+        Subscription.id, Subscription.user_id, Subscription.plan, Subscription.status, Subscription.device_limit,
+        Subscription.stripe_customer_id, Subscription.stripe_subscription_id, Subscription.current_period_end,
+        Subscription.created_at, Subscription.updated_at
+    ]),
+    'devices': (Device, 'user_id', [
+        Device.id, Device.user_id, Device.device_id, Device.name, Device.last_active, Device.created_at
+    ]),
+    'metrics': (MetricRollup, 'user_id', [
+        MetricRollup.user_id, MetricRollup.service, MetricRollup.granularity, MetricRollup.bucket_start,
+        MetricRollup.muted_time, MetricRollup.ads_muted
+    ]),
+    'ad_events': (AD_EVENTS, 'user_id', [
+        AD_EVENTS.c.user_id, AD_EVENTS.c.event_id, AD_EVENTS.c.service, AD_EVENTS.c.duration,
+        AD_EVENTS.c.occurred_at, AD_EVENTS.c.received_at
+    ]),
+}
+
+
+def column_names(dataset):
+    return [column.key for column in DATASETS[dataset][2]]
+
+
+def export_rows(dataset, user_id=None, batch_size=EXPORT_BATCH_SIZE):
+    # Yields one dataset's rows as dicts in primary-key order. The result
+    # is read through a server-side cursor `batch_size` rows at a time, so
+    # memory stays flat whether this is one user or the whole table.
+    model, user_column, columns = DATASETS[dataset]
+    if model is AD_EVENTS:
+        queries = _event_queries(columns, user_id)
+    else:
+        query = select(*columns).order_by(*model.__table__.primary_key.columns)
+        if user_id is not None:
+            query = query.where(getattr(model, user_column) == int(user_id))
+        queries = [query]
+    for query in queries:
+        result = db.session.execute(query.execution_options(yield_per=batch_size))
+        try:
+            for row in result:
+                yield row._asdict()
+        finally:
+            result.close()
+
+
+def _event_queries(columns, user_id):
+    # One query per attached partition, oldest month first, each in
+    # (user_id, occurred_at) order so it follows the partition's index.
+    queries = []
+    for name in attached_partitions():
+        table = event_table(name)
+        query = select(*[table.c[column.key] for column in columns]).order_by(table.c.user_id, table.c.occurred_at)
+        if user_id is not None:
+            query = query.where(table.c.user_id == int(user_id))
+        queries.append(query)
+    return queries
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def ndjson_lines(rows, **extra):
+    # One JSON object per line; `extra` keys (e.g. dataset=...) tag every line.
+    for row in rows:
+        if extra:
+            row = dict(extra, **row)
+        yield json.dumps(row, default=_json_default, separators=(',', ':')) + '\n'
+
+
+def csv_lines(columns, rows):
+    # Header then one line per row, reusing a single buffer.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    yield line(columns)
+    for row in rows:
+        yield line(value.isoformat() if isinstance(value, datetime) else value for value in row.values())
+
+
+def export_lines(fmt, datasets, user_id=None, batch_size=EXPORT_BATCH_SIZE):
+    # NDJSON can mix datasets (each line carries its dataset name); CSV
+    # holds exactly one.
+    if fmt == 'csv':
+        if len(datasets) != 1:
+            raise ValueError('CSV exports contain exactly one dataset')
+        return csv_lines(column_names(datasets[0]), export_rows(datasets[0], user_id, batch_size))
+    return (line for dataset in datasets
+            for line in ndjson_lines(export_rows(dataset, user_id, batch_size), dataset=dataset))
+
+
+def parse_export_args(args, default_datasets):
+    # (format, datasets) from ?format=&dataset= query arguments.
+    fmt = args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        raise ValueError(f'format must be one of {", ".join(FORMATS)}')
+    datasets = args.getlist('dataset') or list(default_datasets)
+    unknown = [dataset for dataset in datasets if dataset not in DATASETS]
+    if unknown:
+        raise ValueError(f'Unknown dataset: {unknown[0]}')
+    if fmt == 'csv' and len(datasets) != 1:
+        raise ValueError('CSV exports contain exactly one dataset')
+    return fmt, datasets
+
+
+def export_mimetype(fmt):
+    return 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
@@ -0,0 +1,288 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from models import User, MetricRollup
+from services.entitlement_service import invalidate_entitlement
+from services.analytics_service import global_counters, ADS_MUTED, MUTED_TIME
+from services.partition_service import store_events, ensure_ledger_month, ledger_months, ledger_table
+from utils.helpers import upsert_increment
+from utils.write_behind import WriteBehindBuffer
+
+MAX_EVENTS_PER_BATCH = 500
+MAX_EVENT_DURATION = 6 * 60 * 60  # seconds; longer "ads" are client bugs
+MAX_SERVICE_LENGTH = 32
+DEFAULT_SERVICE = 'Other'
+KEY_LOOKUP_CHUNK = 500
+GRANULARITIES = ('hour', 'day', 'month')
+
+
+class MetricsBuffer(WriteBehindBuffer):
+    # Buffers per-ad delta events by user and applies them as one grouped
+    # increment per user, so write volume follows active users, not requests.
+
+    name = 'metrics_buffer'
+    config_prefix = 'METRICS'
+
+    def _reset(self):
+        self._pending = {}
+
+    def add_events(self, user_id, events):
+        accepted = 0
+        duplicates = 0
+        with self._lock:
+            user_events = self._pending.setdefault(user_id, {})
+            for event in events:
+                if event['id'] in user_events:
+                    duplicates += 1
+                    continue
+                user_events[event['id']] = (event['duration'], event['service'], event['occurred_at'])
+                accepted += 1
+            self._pending_count += accepted
+        self.added()
+        return accepted, duplicates
+
+    def pending_totals(self, user_id):
+        with self._lock:
+            user_events = self._pending.get(user_id, {})
+            return sum(duration for duration, _, _ in user_events.values()), len(user_events)
+
+    def _take(self):
+        batch, self._pending = self._pending, {}
+        return batch
+
+    def _restore(self, batch):
+        with self._lock:
+            for user_id, events in batch.items():
+                user_events = self._pending.setdefault(user_id, {})
+                for event_id, event in events.items():
+                    if event_id not in user_events:
+                        user_events[event_id] = event
+                        self._pending_count += 1
+
+    def flush(self, batch):
+        try:
+            ledger = ensure_ledger_month()
+            try:
+                return self._apply(batch, ledger)
+            except IntegrityError:
+                # Another worker recorded some of the same event ids between our
+                # lookup and insert; the retry sees them as already applied.
+                db.session.rollback()
+                return self._apply(batch, ledger)
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def _apply(self, batch, ledger):
+        # Events for accounts deleted since they were buffered are dropped.
+        known_users = set(db.session.scalars(select(User.id).where(User.id.in_(list(batch)))))
+        seen = _existing_event_keys(batch)
+        received_at = datetime.utcnow()
+        new_keys = []
+        raw_events = []
+        increments = []
+        rollups = defaultdict(lambda: [0, 0])
+        for user_id, events in batch.items():
+            if user_id not in known_users:
+                continue
+            muted_time = 0
+            ads_muted = 0
+            for event_id, (duration, service, occurred_at) in events.items():
+                if (user_id, event_id) in seen:
+                    continue
+                new_keys.append({'user_id': user_id, 'event_id': event_id, 'created_at': received_at})
+                raw_events.append({'user_id': user_id, 'event_id': event_id, 'service': service,
+                                   'duration': duration, 'occurred_at': occurred_at, 'received_at': received_at})
+                muted_time += duration
+                ads_muted += 1
+                for granularity in GRANULARITIES:
+                    bucket = rollups[(user_id, service, granularity, bucket_start(occurred_at, granularity))]
+                    bucket[0] += duration
+                    bucket[1] += 1
+            if ads_muted:
+                increments.append({'b_user_id': user_id, 'b_muted_time': muted_time, 'b_ads_muted': ads_muted})
+
+        if not increments:
+            db.session.rollback()
+            return 0
+
+        db.session.execute(insert(ledger_table(ledger)), new_keys)
+        user_table = User.__table__
+        db.session.execute(
+            update(user_table)
+            .where(user_table.c.id == bindparam('b_user_id'))
+            .values(
+                total_muted_time=func.coalesce(user_table.c.total_muted_time, 0) + bindparam('b_muted_time'),
+                total_ads_muted=func.coalesce(user_table.c.total_ads_muted, 0) + bindparam('b_ads_muted'),
+                data_version=user_table.c.data_version + 1,
+            ),
+            increments
+        )
+        upsert_increment(
+            db.session,
+            MetricRollup.__table__,
+            [
+                {'user_id': user_id, 'service': service, 'granularity': granularity, 'bucket_start': start,
+                 'muted_time': muted_time, 'ads_muted': ads_muted}
+                for (user_id, service, granularity, start), (muted_time, ads_muted) in rollups.items()
+            ],
+            index_elements=['user_id', 'granularity', 'bucket_start', 'service'],
+            counters=['muted_time', 'ads_muted']
+        )
+        store_events(db.session, raw_events)
+        global_counters.add(db.session, {
+            MUTED_TIME: sum(row['b_muted_time'] for row in increments),
+            ADS_MUTED: sum(row['b_ads_muted'] for row in increments),
+        })
+        db.session.commit()
+        for row in increments:
+            invalidate_entitlement(row['b_user_id'])
+        return len(new_keys)
+
+
+def _existing_event_keys(batch):
+    # Looks the batch's keys up in every kept ledger month.
+    keys = [(user_id, event_id) for user_id, events in batch.items() for event_id in events]
+    seen = set()
+    for name in ledger_months():
+        table = ledger_table(name)
+        for start in range(0, len(keys), KEY_LOOKUP_CHUNK):
+            chunk = keys[start:start + KEY_LOOKUP_CHUNK]
+            rows = db.session.execute(
+                select(table.c.user_id, table.c.event_id).where(
+                    table.c.user_id.in_({user_id for user_id, _ in chunk}),
+                    table.c.event_id.in_({event_id for _, event_id in chunk})
+                )
+            )
+            seen.update((row.user_id, row.event_id) for row in rows)
+    return seen
+
+
+def parse_events(payload):
+    if not isinstance(payload, dict) or not isinstance(payload.get('events'), list):
+        raise ValueError('Expected a JSON object with an "events" list')
+    events = payload['events']
+    if len(events) > MAX_EVENTS_PER_BATCH:
+        raise ValueError(f'At most {MAX_EVENTS_PER_BATCH} events per batch')
+
+    now = datetime.utcnow()
+    parsed = []
+    for event in events:
+        if not isinstance(event, dict):
+            raise ValueError('Each event must be an object')
+        event_id = event.get('id')
+        duration = event.get('duration')
+        if not isinstance(event_id, str) or not 0 < len(event_id) <= 64:
+            raise ValueError('Each event needs a string "id" of at most 64 characters')
+        if isinstance(duration, bool) or not isinstance(duration, (int, float)) or not 0 <= duration <= MAX_EVENT_DURATION:
+            raise ValueError(f'Event "duration" must be between 0 and {MAX_EVENT_DURATION} seconds')
+        service = event.get('service') or DEFAULT_SERVICE
+        if not isinstance(service, str) or len(service) > MAX_SERVICE_LENGTH:
+            raise ValueError(f'Event "service" must be a string of at most {MAX_SERVICE_LENGTH} characters')
+        parsed.append({
+            'id': event_id,
+            'duration': int(round(duration)),
+            'service': service,
+            'occurred_at': _parse_timestamp(event.get('timestamp'), now)
+        })
+    return parsed
+
+
+def _parse_timestamp(value, now):
+    # Client clocks are untrusted: missing or future timestamps count as now.
+    if value is None:
+        return now
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('Event "timestamp" must be milliseconds since the epoch')
+    try:
+        occurred_at = datetime.utcfromtimestamp(value / 1000)
+    except (OverflowError, OSError, ValueError):
+        raise ValueError('Event "timestamp" is out of range')
+    return min(occurred_at, now)
+
+
+def bucket_start(moment, granularity):
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    if granularity == 'day':
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == 'month':
+        return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    raise ValueError(f'Unknown granularity: {granularity}')
+
+
+def next_bucket(moment, granularity):
+    if granularity == 'hour':
+        return moment + timedelta(hours=1)
+    if granularity == 'day':
+        return moment + timedelta(days=1)
+    if moment.month == 12:
+        return moment.replace(year=moment.year + 1, month=1)
+    return moment.replace(month=moment.month + 1)
+
+
+def query_rollups(user_id, granularity, start, end, service=None):
+    # Buckets in [start, end), one row per (bucket, service).
+    query = db.session.query(MetricRollup).filter(
+        MetricRollup.user_id == user_id,
+        MetricRollup.granularity == granularity,
+        MetricRollup.bucket_start >= start,
+        MetricRollup.bucket_start < end
+    )
+    if service:
+        query = query.filter(MetricRollup.service == service)
+    return query.order_by(MetricRollup.bucket_start, MetricRollup.service).all()
+
+
+def summarize_by_service(user_id, start, end):
+    # Totals per service over [start, end), read from the coarsest rollups
+    # that tile the range exactly: months where whole months fit, days for
+    # the ragged edges, hours for any partial days.
+    totals = defaultdict(lambda: [0, 0])
+    for granularity, range_start, range_end in _tile_range(start, end):
+        rows = db.session.query(
+            MetricRollup.service,
+            func.sum(MetricRollup.muted_time),
+            func.sum(MetricRollup.ads_muted)
+        ).filter(
+            MetricRollup.user_id == user_id,
+            MetricRollup.granularity == granularity,
+            MetricRollup.bucket_start >= range_start,
+            MetricRollup.bucket_start < range_end
+        ).group_by(MetricRollup.service)
+        for service, muted_time, ads_muted in rows:
+            totals[service][0] += muted_time or 0
+            totals[service][1] += ads_muted or 0
+    return {service: {'muted_time': muted_time, 'ads_muted': ads_muted}
+            for service, (muted_time, ads_muted) in sorted(totals.items())}
+
+
+def _tile_range(start, end):
+    start = bucket_start(start, 'hour')
+    if end != bucket_start(end, 'hour'):
+        end = next_bucket(bucket_start(end, 'hour'), 'hour')
+    tiles = []
+    first_day = start if start == bucket_start(start, 'day') else next_bucket(bucket_start(start, 'day'), 'day')
+    last_day = bucket_start(end, 'day')
+    if first_day >= last_day:
+        return [('hour', start, end)]
+    if start < first_day:
+        tiles.append(('hour', start, first_day))
+    first_month = first_day if first_day == bucket_start(first_day, 'month') else next_bucket(bucket_start(first_day, 'month'), 'month')
+    last_month = bucket_start(last_day, 'month')
+    if first_month < last_month:
+        if first_day < first_month:
+            tiles.append(('day', first_day, first_month))
+        tiles.append(('month', first_month, last_month))
+        if last_month < last_day:
+            tiles.append(('day', last_month, last_day))
+    else:
+        tiles.append(('day', first_day, last_day))
+    if last_day < end:
+        tiles.append(('hour', last_day, end))
+    return tiles
+
+
+metrics_buffer = MetricsBuffer()
@@ -0,0 +1,335 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Index, Integer, MetaData, String, Table, UniqueConstraint, delete, func, insert,
+    inspect, select, text
+)
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from app import db
+from models import EventPartition, MetricRollup
+from utils.helpers import upsert_greatest
+
+# Raw muted-ad events, one table per calendar month (UTC, by occurred_at).
+# On PostgreSQL the months are native range partitions of `ad_event`; on
+# other databases they are plain tables and the catalog (EventPartition)
+# does the routing. Either way old data goes with DROP TABLE, not DELETE.
+PARENT_TABLE = 'ad_event'
+# The dedupe ledger of accepted client event ids for /user/metrics/events,
+# one plain table per month of receipt. It is kept apart from ad_event,
+# which only holds events whose month has an attached partition, and is
+# dropped a month at a time once the client retry window has passed.
+LEDGER_TABLE = 'metric_event'
+LEDGER_RETENTION_DAYS = 90
+ATTACHED = 'attached'
+DETACHED = 'detached'
+DROPPED = 'dropped'
+PARTITIONS_AHEAD = 2
+RETENTION_DAYS = 180
+ROLLUP_BATCH_SIZE = 1000
+
+partition_metadata = MetaData()
+
+
+def event_table(name):
+    table = partition_metadata.tables.get(name)
+    if table is None:
+        options = {'postgresql_partition_by': 'RANGE (occurred_at)'} if name == PARENT_TABLE else {}
+        table = Table(
+            name, partition_metadata,
+            Column('user_id', Integer, nullable=False),
+            Column('event_id', String(64), nullable=False),
+            Column('service', String(32), nullable=False),
+            Column('duration', Integer, nullable=False),  # in seconds
+            Column('occurred_at', DateTime, nullable=False),
+            Column('received_at', DateTime, nullable=False),
+            **options
+        )
+        Index(f'ix_{name}_user_occurred', table.c.user_id, table.c.occurred_at)
+    return table
+
+
+def ledger_table(name):
+    table = partition_metadata.tables.get(name)
+    if table is None:
+        table = Table(
+            name, partition_metadata,
+            Column('id', BigInteger().with_variant(Integer, 'sqlite'), primary_key=True),
+            Column('user_id', Integer, nullable=False),
+            Column('event_id', String(64), nullable=False),
+            Column('created_at', DateTime, nullable=False),
+            UniqueConstraint('user_id', 'event_id', name=f'uq_{name}_user_event')
+        )
+    return table
+
+
+def month_start(moment):
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(moment):
+    start = month_start(moment)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def partition_name(moment):
+    return f'{PARENT_TABLE}_p{month_start(moment):%Y%m}'
+
+
+def ledger_name(moment):
+    return f'{LEDGER_TABLE}_p{month_start(moment):%Y%m}'
+
+
+def _native():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def _bounds(partition):
+    return f"FROM ('{partition.range_start:%Y-%m-%d}') TO ('{partition.range_end:%Y-%m-%d}')"
+
+
+def create_partition(moment):
+    # Creates the partition for the month containing `moment`, if missing.
+    start = month_start(moment)
+    name = partition_name(start)
+    partition = db.session.get(EventPartition, name)
+    if partition is not None and partition.state != DROPPED:
+        db.session.rollback()
+        return partition
+    if partition is None:
+        partition = EventPartition(name=name, range_start=start, range_end=next_month(start))
+        db.session.add(partition)
+    partition.state = ATTACHED
+    partition.detached_at = partition.rolled_up_at = partition.dropped_at = partition.rows = None
+
+    connection = db.session.connection()
+    if _native():
+        event_table(PARENT_TABLE).create(connection, checkfirst=True)
+        db.session.execute(text(f'CREATE TABLE {name} PARTITION OF {PARENT_TABLE} FOR VALUES {_bounds(partition)}'))
+    else:
+        event_table(name).create(connection, checkfirst=True)
+    db.session.commit()
+    current_app.logger.info(f'Created event partition {name}')
+    return partition
+
+
+def ensure_partitions(ahead=None, now=None):
+    # This month's partition and `ahead` more, so ingestion never waits on
+    # DDL. Returns the catalog rows.
+    if ahead is None:
+        ahead = current_app.config.get('AD_EVENT_PARTITIONS_AHEAD', PARTITIONS_AHEAD)
+    month = month_start(now or datetime.utcnow())
+    partitions = []
+    for _ in range(ahead + 1):
+        partitions.append(create_partition(month))
+        month = next_month(month)
+    return partitions
+
+
+def _get_partition(name, state):
+    partition = db.session.get(EventPartition, name)
+    if partition is None:
+        raise ValueError(f'Unknown event partition: {name}')
+    if partition.state != state:
+        raise ValueError(f'Event partition {name} is {partition.state}, not {state}')
+    return partition
+
+
+def detach_partition(name):
+    # Stops reads and writes to the partition but keeps its rows.
+    partition = _get_partition(name, ATTACHED)
+    if _native():
+        db.session.execute(text(f'ALTER TABLE {PARENT_TABLE} DETACH PARTITION {partition.name}'))
+    partition.state = DETACHED
+    partition.detached_at = datetime.utcnow()
+    db.session.commit()
+    current_app.logger.info(f'Detached event partition {name}')
+    return partition
+
+
+def attach_partition(name):
+    partition = _get_partition(name, DETACHED)
+    if _native():
+        db.session.execute(text(f'ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {partition.name} FOR VALUES {_bounds(partition)}'))
+    partition.state = ATTACHED
+    partition.detached_at = None
+    db.session.commit()
+    current_app.logger.info(f'Attached event partition {name}')
+    return partition
+
+
+def store_events(session, events):
+    # Adds raw events to their month's attached partition in the caller's
+    # transaction. Events for months without one are not kept raw (they
+    # still count in the rollups). Returns how many were stored.
+    if not events:
+        return 0
+    attached = dict(session.execute(
+        select(EventPartition.range_start, EventPartition.name).where(EventPartition.state == ATTACHED)
+    ).all())
+    by_partition = defaultdict(list)
+    for event in events:
+        name = attached.get(month_start(event['occurred_at']))
+        if name:
+            by_partition[name].append(event)
+    for name, rows in by_partition.items():
+        session.execute(insert(event_table(name)), rows)
+    return sum(len(rows) for rows in by_partition.values())
+
+
+def attached_partitions(start=None, end=None):
+    # Names of the attached partitions overlapping [start, end), oldest first.
+    query = select(EventPartition.name).where(EventPartition.state == ATTACHED).order_by(EventPartition.range_start)
+    if start is not None:
+        query = query.where(EventPartition.range_end > start)
+    if end is not None:
+        query = query.where(EventPartition.range_start < end)
+    return db.session.scalars(query).all()
+
+
+def ledger_months():
+    # Names of the kept ledger tables, oldest first.
+    prefix = f'{LEDGER_TABLE}_p'
+    return sorted(name for name in inspect(db.session.connection()).get_table_names() if name.startswith(prefix))
+
+
+def ensure_ledger_month(moment=None):
+    # Creates the ledger table for the month containing `moment` (now by
+    # default) if missing, and returns its name. Another worker may create
+    # it at the same time; losing that race is fine.
+    name = ledger_name(moment or datetime.utcnow())
+    try:
+        ledger_table(name).create(db.session.connection(), checkfirst=True)
+        db.session.commit()
+    except (OperationalError, ProgrammingError):
+        db.session.rollback()
+        if name not in ledger_months():
+            raise
+    return name
+
+
+def enforce_ledger_retention(days=None, now=None):
+    # Drops every ledger table whose month ended more than `days` ago.
+    # Returns the dropped table names.
+    if days is None:
+        days = current_app.config.get('METRIC_EVENT_RETENTION_DAYS', LEDGER_RETENTION_DAYS)
+    cutoff = (now or datetime.utcnow()) - timedelta(days=days)
+    dropped = []
+    for name in ledger_months():
+        if next_month(datetime.strptime(name.rsplit('_p', 1)[1], '%Y%m')) > cutoff:
+            break
+        ledger_table(name).drop(db.session.connection(), checkfirst=True)
+        db.session.commit()
+        current_app.logger.info(f'Dropped metric event ledger {name}')
+        dropped.append(name)
+    return dropped
+
+
+def roll_up_partition(partition):
+    # Folds the partition into the day and month rollups. Those buckets are
+    # already incremented at ingestion, in the transaction that stores the
+    # raw rows, so a bucket can only be raised here (restoring a lost
+    # increment), never lowered, and re-running changes nothing. The daily
+    # totals are streamed in (user, service) order and upserted
+    # ROLLUP_BATCH_SIZE at a time, so memory stays flat however large the
+    # month was.
+    table = event_table(partition.name)
+    day = func.date_trunc('day', table.c.occurred_at) if _native() else func.date(table.c.occurred_at)
+    result = db.session.execute(
+        select(table.c.user_id, table.c.service, day, func.sum(table.c.duration), func.count())
+        .group_by(table.c.user_id, table.c.service, day)
+        .order_by(table.c.user_id, table.c.service, day)
+        .execution_options(yield_per=ROLLUP_BATCH_SIZE)
+    )
+
+    rollups = []
+    month_key, month = None, [0, 0]
+    total = 0
+    try:
+        for user_id, service, bucket, muted_time, ads_muted in result:
+            if (user_id, service) != month_key:
+                if month_key is not None:
+                    rollups.append(_month_rollup(partition, month_key, month))
+                month_key, month = (user_id, service), [0, 0]
+            bucket = bucket if isinstance(bucket, datetime) else datetime.fromisoformat(bucket)
+            rollups.append({'user_id': user_id, 'service': service, 'granularity': 'day', 'bucket_start': bucket,
+                            'muted_time': muted_time, 'ads_muted': ads_muted})
+            month[0] += muted_time
+            month[1] += ads_muted
+            total += ads_muted
+            if len(rollups) >= ROLLUP_BATCH_SIZE:
+                _upsert_rollups(rollups)
+                rollups = []
+    finally:
+        result.close()
+    if month_key is not None:
+        rollups.append(_month_rollup(partition, month_key, month))
+    _upsert_rollups(rollups)
+    partition.rolled_up_at = datetime.utcnow()
+    partition.rows = total
+    db.session.commit()
+    return partition.rows
+
+
+def _month_rollup(partition, key, totals):
+    user_id, service = key
+    return {'user_id': user_id, 'service': service, 'granularity': 'month', 'bucket_start': partition.range_start,
+            'muted_time': totals[0], 'ads_muted': totals[1]}
+
+
+def _upsert_rollups(rollups):
+    if rollups:
+        upsert_greatest(db.session, MetricRollup.__table__, rollups,
+                        index_elements=['user_id', 'granularity', 'bucket_start', 'service'],
+                        columns=['muted_time', 'ads_muted'])
+
+
+def enforce_event_retention(days=None, now=None):
+    # Rolls up and drops every partition whose month ended more than `days`
+    # ago. Returns the dropped partition names.
+    if days is None:
+        days = current_app.config.get('AD_EVENT_RETENTION_DAYS', RETENTION_DAYS)
+    cutoff = (now or datetime.utcnow()) - timedelta(days=days)
+    expired = EventPartition.query.filter(
+        EventPartition.state != DROPPED,
+        EventPartition.range_end <= cutoff
+    ).order_by(EventPartition.range_start).all()
+
+    dropped = []
+    for partition in expired:
+        if partition.rolled_up_at is None:
+            roll_up_partition(partition)
+        event_table(partition.name).drop(db.session.connection(), checkfirst=True)
+        partition.state = DROPPED
+        partition.dropped_at = datetime.utcnow()
+        db.session.commit()
+        current_app.logger.info(f'Dropped event partition {partition.name} ({partition.rows} events rolled up)')
+        dropped.append(partition.name)
+    return dropped
+
+
+def delete_user_events(user_id, on_partition=None):
+    # One index-backed DELETE per kept partition and ledger month, each in
+    # its own transaction; `on_partition(count)` runs inside it. Returns
+    # rows deleted.
+    names = db.session.scalars(select(EventPartition.name).where(EventPartition.state != DROPPED)).all()
+    tables = [event_table(name) for name in names] + [ledger_table(name) for name in ledger_months()]
+    removed = 0
+    for table in tables:
+        count = db.session.execute(delete(table).where(table.c.user_id == user_id)).rowcount
+        if count and on_partition:
+            on_partition(count)
+        db.session.commit()
+        removed += count
+    return removed
+
+
+def run_partition_maintenance(now=None):
+    # Daily job: create upcoming partitions and ledger months, then apply
+    # retention to both.
+    month = month_start(now or datetime.utcnow())
+    created = [partition.name for partition in ensure_partitions(now=now)]
+    created += [ensure_ledger_month(month), ensure_ledger_month(next_month(month))]
+    return created, enforce_event_retention(now=now) + enforce_ledger_retention(now=now)
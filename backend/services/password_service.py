@@ -0,0 +1,152 @@
+import asyncio
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import bcrypt
+
+# bcrypt only reads the first 72 bytes; newer releases raise instead of
+# truncating, so truncate explicitly to keep existing hashes verifiable.
+BCRYPT_MAX_PASSWORD_BYTES = 72
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+def _to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password[:BCRYPT_MAX_PASSWORD_BYTES], bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+
+def _verify(password, pw_hash):
+    return hmac.compare_digest(bcrypt.hashpw(password[:BCRYPT_MAX_PASSWORD_BYTES], pw_hash), pw_hash)
+
+
+def node_share_workers():
+    # The pool is per server worker process, so split the node's cores
+    # between them. WEB_CONCURRENCY is the worker count gunicorn reads when
+    # --workers is not given; set it to the worker count for other servers.
+    workers_per_node = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+    return max(1, (os.cpu_count() or 1) // workers_per_node)
+
+
+def hash_rounds(pw_hash):
+    # "$2b$12$<salt+digest>" -> 12
+    try:
+        return int(pw_hash.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    # Runs bcrypt in a dedicated process pool so login/register bursts burn
+    # those cores instead of request workers. Admission is bounded: once
+    # `workers + max_queue` calls are in flight, further callers wait up to
+    # `queue_timeout` seconds and then get PasswordHasherBusy.
+
+    def __init__(self):
+        self.app = None
+        self.rounds = 12
+        self.workers = 0
+        self.max_queue = 0
+        self.queue_timeout = 0.5
+        self._executor = None
+        self._executor_pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', 12)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', node_share_workers())
+        self.max_queue = app.config.get('PASSWORD_HASH_MAX_QUEUE', self.workers * 4)
+        self.queue_timeout = app.config.get('PASSWORD_HASH_QUEUE_TIMEOUT', 0.5)
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_queue) if self.workers else None
+        self.shutdown()
+        app.extensions['password_hasher'] = self
+
+    def hash(self, password):
+        if not password:
+            raise ValueError('Password must be non-empty.')
+        return self._run(_hash, _to_bytes(password), self.rounds)
+
+    def verify(self, pw_hash, password):
+        if not pw_hash or not password:
+            return False
+        return self._run(_verify, _to_bytes(password), _to_bytes(pw_hash))
+
+    async def hash_async(self, password):
+        if not password:
+            raise ValueError('Password must be non-empty.')
+        return await self._run_async(_hash, _to_bytes(password), self.rounds)
+
+    async def verify_async(self, pw_hash, password):
+        if not pw_hash or not password:
+            return False
+        return await self._run_async(_verify, _to_bytes(password), _to_bytes(pw_hash))
+
+    def needs_rehash(self, pw_hash):
+        return hash_rounds(pw_hash) != self.rounds
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._executor_pid = None
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise PasswordHasherBusy('Too many password operations in progress')
+        try:
+            return self._get_executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    async def _run_async(self, fn, *args):
+        # Same admission rules as _run(), without blocking the event loop
+        # while waiting for a slot or for the pool.
+        loop = asyncio.get_running_loop()
+        if not self.workers:
+            return await loop.run_in_executor(None, fn, *args)
+        deadline = time.monotonic() + self.queue_timeout
+        while not self._slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                raise PasswordHasherBusy('Too many password operations in progress')
+            await asyncio.sleep(0.01)
+        try:
+            return await asyncio.wrap_future(self._get_executor().submit(fn, *args))
+        finally:
+            self._slots.release()
+
+    def _get_executor(self):
+        # A pool inherited across fork() is unusable, so each worker process
+        # starts its own on first use.
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    if multiprocessing.current_process().daemon:
+                        # Daemonic workers (hypercorn's) cannot start child
+                        # processes; bcrypt releases the GIL, so threads still
+                        # keep hashing off the request path.
+                        self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                            thread_name_prefix='bcrypt')
+                    else:
+                        self._executor = ProcessPoolExecutor(
+                            max_workers=self.workers,
+                            mp_context=multiprocessing.get_context('spawn')
+                        )
+                    self._executor_pid = pid
+        return self._executor
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,232 @@
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import delete, func, or_, select, update
+from app import db
+from models import (
+    User, Subscription, Device, MetricRollup, RefreshToken, StripeEvent, AccountDeletion
+)
+from services.analytics_service import global_counters, subscription_counter, USERS, DEVICES, ADS_MUTED, MUTED_TIME
+from services.entitlement_service import invalidate_entitlement
+from services.partition_service import delete_user_events
+from services.stripe_service import cancel_subscription
+from services.token_service import revoke_family
+
+PURGE_BATCH_SIZE = 500
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 5
+
+# Per-user rows deleted before the user row, in this order. The single
+# subscription row goes in the final transaction along with the user.
+DEPENDENT_TABLES = (
+    (RefreshToken, None),
+    (MetricRollup, None),
+    (Device, {DEVICES: -1}),
+)
+
+
+def request_account_deletion(user, reason='user_request'):
+    # Queues the account for purging and signs it out everywhere. Asking
+    # again while a deletion is queued returns the queued one.
+    if user.deletion_requested_at is None:
+        user.deletion_requested_at = datetime.utcnow()
+    deletion = AccountDeletion.query.filter(
+        AccountDeletion.user_id == user.id,
+        AccountDeletion.status.in_(('pending', 'processing'))
+    ).first()
+    if deletion is None:
+        deletion = AccountDeletion(user_id=user.id, reason=reason)
+        db.session.add(deletion)
+    db.session.commit()
+    invalidate_entitlement(user.id)
+
+    families = db.session.scalars(
+        select(RefreshToken.family_id)
+        .where(RefreshToken.user_id == user.id, RefreshToken.revoked_at.is_(None))
+        .distinct()
+    ).all()
+    for family_id in families:
+        revoke_family(family_id)
+    current_app.logger.info(f'Queued deletion {deletion.id} for user {user.id}')
+    return deletion
+
+
+def claim_deletion(lease_seconds=LEASE_SECONDS):
+    # Claims the oldest queued deletion, or one whose worker's lease ran out.
+    now = datetime.utcnow()
+    claimable = or_(
+        AccountDeletion.status == 'pending',
+        (AccountDeletion.status == 'processing') & (AccountDeletion.locked_until < now)
+    )
+    deletion_id = db.session.scalar(
+        select(AccountDeletion.id)
+        .where(claimable)
+        .order_by(AccountDeletion.requested_at, AccountDeletion.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    if deletion_id is None:
+        db.session.rollback()
+        return None
+
+    token = uuid.uuid4().hex
+    claimed = db.session.execute(
+        update(AccountDeletion)
+        .where(AccountDeletion.id == deletion_id, claimable)
+        .values(
+            status='processing',
+            claim_token=token,
+            locked_until=now + timedelta(seconds=lease_seconds),
+            attempts=AccountDeletion.attempts + 1,
+            started_at=func.coalesce(AccountDeletion.started_at, now)
+        )
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if claimed != 1:
+        return None
+    return AccountDeletion.query.filter_by(id=deletion_id, claim_token=token).first()
+
+
+def process_pending_deletions(limit=None, batch_size=None, pause=None):
+    # Claims and purges queued accounts one at a time. Returns how many were purged.
+    batch_size = batch_size or current_app.config.get('PURGE_BATCH_SIZE', PURGE_BATCH_SIZE)
+    pause = current_app.config.get('PURGE_BATCH_PAUSE', 0.05) if pause is None else pause
+    purged = 0
+    while limit is None or purged < limit:
+        deletion = claim_deletion()
+        if deletion is None:
+            break
+        try:
+            purge_account(deletion, batch_size, pause)
+            purged += 1
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f'Error purging account for deletion {deletion.id}: {str(e)}')
+            deletion.status = 'failed' if deletion.attempts >= MAX_ATTEMPTS else 'pending'
+            deletion.locked_until = None
+            deletion.last_error = str(e)
+            db.session.commit()
+    return purged
+
+
+def purge_account(deletion, batch_size=PURGE_BATCH_SIZE, pause=0):
+    # Cancels billing, then deletes the user's rows table by table in
+    # batches of `batch_size`, each in its own short transaction with
+    # `pause` seconds between them to bound lock time and replication lag.
+    # Safe to re-run after a crash: every step only acts on what is left.
+    user_id = deletion.user_id
+    _cancel_billing(user_id)
+
+    for model, deltas in DEPENDENT_TABLES:
+        removed = delete_in_batches(model, model.user_id == user_id, batch_size, pause, deltas,
+                                    on_batch=lambda count: _record_progress(deletion.id, count))
+        if removed:
+            current_app.logger.info(f'Deletion {deletion.id}: removed {removed} {model.__tablename__} rows')
+    removed = delete_user_events(user_id, on_partition=lambda count: _record_progress(deletion.id, count))
+    if removed:
+        current_app.logger.info(f'Deletion {deletion.id}: removed {removed} ad event and ledger rows')
+
+    deltas = {}
+    removed = 0
+    subscription = db.session.execute(
+        select(Subscription.id, Subscription.status, Subscription.plan).where(Subscription.user_id == user_id)
+    ).first()
+    if subscription:
+        db.session.execute(delete(Subscription).where(Subscription.id == subscription.id))
+        deltas[subscription_counter(subscription.status, subscription.plan)] = -1
+        removed += 1
+    user = db.session.execute(
+        select(User.total_ads_muted, User.total_muted_time).where(User.id == user_id)
+    ).first()
+    if user:
+        db.session.execute(delete(User).where(User.id == user_id))
+        deltas.update({USERS: -1, ADS_MUTED: -(user.total_ads_muted or 0), MUTED_TIME: -(user.total_muted_time or 0)})
+        removed += 1
+    global_counters.add(db.session, deltas)
+    db.session.execute(
+        update(AccountDeletion)
+        .where(AccountDeletion.id == deletion.id)
+        .values(status='done', completed_at=datetime.utcnow(), locked_until=None, last_error=None,
+                rows_deleted=AccountDeletion.rows_deleted + removed)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    invalidate_entitlement(user_id)
+    current_app.logger.info(f'Deletion {deletion.id}: purged user {user_id}')
+
+
+def _cancel_billing(user_id):
+    import stripe
+    subscription = Subscription.query.filter_by(user_id=user_id).first()
+    if not subscription or not subscription.stripe_subscription_id or subscription.status in ('canceled', 'cancelled'):
+        return
+    try:
+        subscription.status = cancel_subscription(subscription.stripe_subscription_id).status
+    except stripe.error.InvalidRequestError as e:
+        # Already gone on Stripe's side.
+        if e.http_status != 404:
+            raise
+        subscription.status = 'canceled'
+    # Committed on its own so a retried purge does not cancel twice.
+    db.session.commit()
+
+
+def _record_progress(deletion_id, count):
+    # Also renews the lease, so long purges are not reclaimed mid-way.
+    db.session.execute(
+        update(AccountDeletion)
+        .where(AccountDeletion.id == deletion_id)
+        .values(rows_deleted=AccountDeletion.rows_deleted + count,
+                locked_until=datetime.utcnow() + timedelta(seconds=LEASE_SECONDS))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def delete_in_batches(model, condition, batch_size=PURGE_BATCH_SIZE, pause=0, deltas=None, on_batch=None):
+    # Deletes rows matching `condition` by primary key, batch_size at a
+    # time, committing each batch. `deltas` are global counter changes per
+    # deleted row; `on_batch(count)` runs inside each batch's transaction.
+    # Returns the number of rows deleted.
+    pk = model.__mapper__.primary_key[0]
+    removed = 0
+    while True:
+        ids = db.session.scalars(select(pk).where(condition).limit(batch_size)).all()
+        if not ids:
+            db.session.rollback()
+            return removed
+        db.session.execute(delete(model).where(pk.in_(ids)).execution_options(synchronize_session=False))
+        if deltas:
+            global_counters.add(db.session, {name: delta * len(ids) for name, delta in deltas.items()})
+        if on_batch:
+            on_batch(len(ids))
+        db.session.commit()
+        removed += len(ids)
+        if pause and len(ids) == batch_size:
+            time.sleep(pause)
+
+
+def purge_expired_records(batch_size=None, pause=None):
+    # Retention purge for applied Stripe events. Returns rows removed per
+    # table. The metric event ledger is dropped a month at a time by
+    # partition maintenance instead.
+    batch_size = batch_size or current_app.config.get('PURGE_BATCH_SIZE', PURGE_BATCH_SIZE)
+    pause = current_app.config.get('PURGE_BATCH_PAUSE', 0.05) if pause is None else pause
+    # StripeEvent.created is Stripe's unix timestamp.
+    stripe_cutoff = int(time.time()) - current_app.config.get('STRIPE_EVENT_RETENTION_DAYS', 90) * 86400
+    return {
+        # Through the (status, created) index.
+        'stripe_event': delete_in_batches(
+            StripeEvent,
+            (StripeEvent.status == 'done') & (StripeEvent.created < stripe_cutoff),
+            batch_size, pause
+        ),
+    }
+
+
+def run_purge_worker(poll_interval=30):
+    # Blocking loop for a worker process; safe to run on several nodes.
+    while True:
+        if not process_pending_deletions():
+            time.sleep(poll_interval)
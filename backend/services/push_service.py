@@ -0,0 +1,270 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from flask import current_app, has_app_context
+from services.entitlement_service import entitlement_cache
+from utils.rate_limit import DEFAULT_SQLITE_DIR
+
+# Change kinds pushed on /push/stream. Publishers only name what changed;
+# each stream then sends the user's current state for it, so a burst of
+# changes collapses into one message and nothing is sent that the stream's
+# user may no longer see.
+SUBSCRIPTION_CHANGED = 'subscription'
+DEVICES_CHANGED = 'devices'
+KINDS = (SUBSCRIPTION_CHANGED, DEVICES_CHANGED)
+
+BROKER_RETENTION = 60
+
+
+class Channel:
+    # One open stream. Pending kinds are a set, so a slow or briefly blocked
+    # stream holds at most one entry per kind instead of a growing queue.
+
+    def __init__(self, user_id, loop=None):
+        self.user_id = user_id
+        self.loop = loop
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ready = asyncio.Event() if loop is not None else threading.Event()
+
+    def put(self, kind):
+        with self._lock:
+            self._pending[kind] = None
+            if self.loop is None:
+                self._ready.set()
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self._ready.set)
+            except RuntimeError:
+                # The loop has shut down; the stream is gone with it.
+                pass
+
+    def take(self):
+        with self._lock:
+            kinds = list(self._pending)
+            self._pending.clear()
+            self._ready.clear()
+        return kinds
+
+    def wait(self, timeout):
+        # Blocks up to `timeout` seconds; returns the kinds that changed.
+        self._ready.wait(timeout)
+        return self.take()
+
+    async def wait_async(self, timeout):
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.take()
+
+
+class SQLiteBroker:
+    # Cross-process stand-in for a real pub/sub broker: a small SQLite file
+    # on tmpfs shared by the workers of one node, like the rate limit
+    # buckets. Each process appends its publishes and tails everyone
+    # else's. Rows are only kept for BROKER_RETENTION seconds.
+
+    def __init__(self, path, lock_timeout):
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS push_message (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'origin TEXT NOT NULL, user_id INTEGER NOT NULL, kind TEXT NOT NULL, created REAL NOT NULL)'
+            )
+
+    def _connection(self):
+        # One connection per thread and process; forked workers reconnect.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.lock_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def send(self, origin, user_id, kind):
+        self._connection().execute(
+            'INSERT INTO push_message (origin, user_id, kind, created) VALUES (?, ?, ?, ?)',
+            (origin, user_id, kind, time.time())
+        )
+
+    def last_id(self):
+        return self._connection().execute('SELECT COALESCE(MAX(id), 0) FROM push_message').fetchone()[0]
+
+    def receive(self, origin, after):
+        # Other processes' messages with id > after, oldest first.
+        return self._connection().execute(
+            'SELECT id, user_id, kind FROM push_message WHERE id > ? AND origin != ? ORDER BY id',
+            (after, origin)
+        ).fetchall()
+
+    def prune(self, before):
+        self._connection().execute('DELETE FROM push_message WHERE created < ?', (before,))
+
+
+class PushHub:
+    # In-process fan-out from publishers (webhook handling, cancellation,
+    # device changes) to the open streams of each user. Publish after the
+    # change commits. With a broker, publishes also reach streams held by
+    # the node's other workers, and the receiving worker drops its cached
+    # entitlement for the user first, since the change was made elsewhere.
+
+    def __init__(self):
+        self.app = None
+        self.broker = None
+        self.heartbeat_interval = 15
+        self.max_stream_seconds = 3600
+        self.max_streams_per_user = 5
+        self.poll_interval = 0.5
+        self._channels = {}
+        self._lock = threading.Lock()
+        self._token = uuid.uuid4().hex
+        self._thread = None
+        self._thread_pid = None
+
+    def init_app(self, app):
+        self.app = app
+        self.heartbeat_interval = app.config.get('PUSH_HEARTBEAT_INTERVAL', 15)
+        self.max_stream_seconds = app.config.get('PUSH_MAX_STREAM_SECONDS', 3600)
+        self.max_streams_per_user = app.config.get('PUSH_MAX_STREAMS_PER_USER', 5)
+        self.poll_interval = app.config.get('PUSH_BROKER_POLL_INTERVAL', 0.5)
+        # Tests get a process-local hub unless they ask otherwise.
+        backend = app.config.get('PUSH_BROKER', 'memory' if app.testing else 'sqlite')
+        if backend == 'sqlite':
+            path = app.config.get('PUSH_BROKER_PATH') or os.path.join(DEFAULT_SQLITE_DIR, 'push-messages.sqlite3')
+            self.broker = SQLiteBroker(path, app.config.get('PUSH_BROKER_LOCK_TIMEOUT', 0.1))
+        else:
+            self.broker = None
+        with self._lock:
+            self._channels.clear()
+        app.extensions['push_hub'] = self
+
+    @property
+    def origin(self):
+        return f'{self._token}:{os.getpid()}'
+
+    def subscribe(self, user_id, loop=None):
+        # Returns a Channel, or None when the user already has
+        # max_streams_per_user open.
+        channel = Channel(int(user_id), loop)
+        with self._lock:
+            channels = self._channels.setdefault(channel.user_id, set())
+            if len(channels) >= self.max_streams_per_user:
+                return None
+            channels.add(channel)
+        self._ensure_listener()
+        return channel
+
+    def unsubscribe(self, channel):
+        with self._lock:
+            channels = self._channels.get(channel.user_id)
+            if channels is not None:
+                channels.discard(channel)
+                if not channels:
+                    del self._channels[channel.user_id]
+
+    def stream_count(self, user_id=None):
+        with self._lock:
+            if user_id is not None:
+                return len(self._channels.get(int(user_id), ()))
+            return sum(len(channels) for channels in self._channels.values())
+
+    def publish(self, user_id, kind):
+        user_id = int(user_id)
+        self.deliver(user_id, kind)
+        if self.broker is None:
+            return
+        try:
+            self.broker.send(self.origin, user_id, kind)
+        except sqlite3.Error as e:
+            # Streams in other workers catch up on their next reconnect.
+            self._logger().warning(f'Push broker unavailable, not forwarding {kind} for user {user_id}: {str(e)}')
+
+    def deliver(self, user_id, kind):
+        with self._lock:
+            channels = list(self._channels.get(user_id, ()))
+        for channel in channels:
+            channel.put(kind)
+
+    def _ensure_listener(self):
+        # Tails the broker while this process holds streams; started on the
+        # first subscribe and again in forked workers.
+        if self.broker is None or self.app is None:
+            return
+        pid = os.getpid()
+        with self._lock:
+            if self._thread is None or self._thread_pid != pid or not self._thread.is_alive():
+                # Read from here on, so nothing published after the first
+                # subscribe returns is missed.
+                try:
+                    last_id = self.broker.last_id()
+                except sqlite3.Error:
+                    last_id = None
+                self._thread_pid = pid
+                self._thread = threading.Thread(target=self._listen, args=(last_id,),
+                                                name='push-broker-listener', daemon=True)
+                self._thread.start()
+
+    def _listen(self, last_id):
+        broker = self.broker
+        next_prune = 0
+        while broker is self.broker:
+            try:
+                if last_id is None:
+                    last_id = broker.last_id()
+                for message_id, user_id, kind in broker.receive(self.origin, last_id):
+                    last_id = message_id
+                    entitlement_cache.invalidate(user_id)
+                    self.deliver(user_id, kind)
+                now = time.time()
+                if now >= next_prune:
+                    next_prune = now + BROKER_RETENTION
+                    broker.prune(now - BROKER_RETENTION)
+            except sqlite3.Error as e:
+                self.app.logger.warning(f'Push broker poll failed: {str(e)}')
+            time.sleep(self.poll_interval)
+
+    def _logger(self):
+        return current_app.logger if has_app_context() else self.app.logger
+
+
+push_hub = PushHub()
+
+
+def stream_state(kind, entitlement):
+    # The data sent for `kind`; the subscription event carries the same
+    # fields as GET /subscription/subscription.
+    subscription = entitlement['subscription']
+    if kind == SUBSCRIPTION_CHANGED:
+        if not subscription:
+            return {'status': 'inactive'}
+        return {
+            'status': subscription['status'],
+            'plan': subscription['plan'],
+            'device_limit': subscription['device_limit'],
+            'current_period_end': subscription['current_period_end']
+        }
+    return {
+        'device_ids': sorted(entitlement['device_ids']),
+        'device_limit': subscription['device_limit'] if subscription else 0
+    }
+
+
+def format_event(kind, data):
+    return f'event: {kind}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def format_retry(milliseconds):
+    # Reconnect delay hint for the client.
+    return f'retry: {int(milliseconds)}\n\n'
+
+
+HEARTBEAT = ': keepalive\n\n'
@@ -0,0 +1,128 @@
+import time
+from collections import defaultdict
+from datetime import datetime
+import stripe
+from flask import current_app
+from sqlalchemy import bindparam, select, update
+from app import db
+from models import Subscription, SyncCheckpoint
+from services.analytics_service import global_counters, subscription_counter
+from services.entitlement_service import invalidate_entitlement, bump_version
+from services.push_service import push_hub, SUBSCRIPTION_CHANGED
+from services.stripe_service import get_gateway
+
+CHECKPOINT_NAME = 'stripe_subscriptions'
+PAGE_SIZE = 100
+
+
+def reconcile_subscriptions(page_size=PAGE_SIZE, max_pages=None, restart=False):
+    # Pages through every Stripe subscription and corrects local rows whose
+    # status or current_period_end drifted, e.g. after missed webhooks. Each
+    # page is one transaction: lock the matching local rows, diff them in
+    # memory, write only the changed fields with one executemany UPDATE per
+    # field set, and advance the checkpoint. An interrupted run resumes from
+    # its checkpoint; `restart` starts over. Returns the checkpoint.
+    checkpoint = _load_checkpoint(restart)
+    gateway = get_gateway()
+    pages = 0
+    while max_pages is None or pages < max_pages:
+        fetched_at = int(time.time())
+        try:
+            page = gateway.list_subscriptions(limit=page_size, starting_after=checkpoint.cursor)
+        except stripe.error.InvalidRequestError as e:
+            if e.http_status != 404 or checkpoint.cursor is None:
+                raise
+            # The subscription we stopped at is gone; start this run again.
+            current_app.logger.warning(f'Reconcile cursor {checkpoint.cursor} no longer exists; restarting')
+            checkpoint = _load_checkpoint(restart=True)
+            continue
+
+        user_ids = apply_page(page.data, fetched_at)
+        checkpoint.pages += 1
+        checkpoint.checked += len(page.data)
+        checkpoint.changed += len(user_ids)
+        checkpoint.updated_at = datetime.utcnow()
+        if page.has_more and page.data:
+            checkpoint.cursor = page.data[-1].id
+        else:
+            checkpoint.cursor = None
+            checkpoint.completed_at = checkpoint.updated_at
+        db.session.commit()
+        for user_id in user_ids:
+            invalidate_entitlement(user_id)
+            push_hub.publish(user_id, SUBSCRIPTION_CHANGED)
+        pages += 1
+        current_app.logger.info(
+            f'Reconciled page {checkpoint.pages}: {len(page.data)} subscriptions, {len(user_ids)} changed')
+        if checkpoint.completed_at:
+            break
+    return checkpoint
+
+
+def apply_page(remote_subscriptions, fetched_at):
+    # Diffs one page against local rows and stages the UPDATEs in the
+    # current transaction. Rows changed by a webhook event newer than the
+    # page are left alone. Returns the ids of the users whose rows changed.
+    remote = {s.id: s for s in remote_subscriptions}
+    if not remote:
+        return []
+    local_rows = db.session.execute(
+        select(Subscription.id, Subscription.user_id, Subscription.stripe_subscription_id, Subscription.plan,
+               Subscription.status, Subscription.current_period_end, Subscription.last_event_created)
+        .where(Subscription.stripe_subscription_id.in_(list(remote)))
+        .with_for_update()
+    ).all()
+
+    updates = defaultdict(list)
+    deltas = defaultdict(int)
+    user_ids = []
+    for row in local_rows:
+        if row.last_event_created and row.last_event_created >= fetched_at:
+            continue
+        changes = diff_subscription(row, remote[row.stripe_subscription_id])
+        if not changes:
+            continue
+        updates[tuple(sorted(changes))].append(dict({f'b_{k}': v for k, v in changes.items()}, b_id=row.id))
+        user_ids.append(row.user_id)
+        if 'status' in changes:
+            deltas[subscription_counter(row.status, row.plan)] -= 1
+            deltas[subscription_counter(changes['status'], row.plan)] += 1
+
+    for fields, params in updates.items():
+        db.session.execute(
+            update(Subscription.__table__)
+            .where(Subscription.__table__.c.id == bindparam('b_id'))
+            .values({field: bindparam(f'b_{field}') for field in fields} | {'updated_at': datetime.utcnow()}),
+            params
+        )
+    if user_ids:
+        bump_version(*user_ids)
+        global_counters.add(db.session, deltas)
+    return user_ids
+
+
+def diff_subscription(local, remote):
+    # {field: new value} for the reconciled fields that differ.
+    changes = {}
+    if remote.status != local.status:
+        changes['status'] = remote.status
+    period_end = datetime.fromtimestamp(remote.current_period_end) if remote.get('current_period_end') else None
+    if period_end is not None and period_end != local.current_period_end:
+        changes['current_period_end'] = period_end
+    return changes
+
+
+def _load_checkpoint(restart):
+    checkpoint = db.session.get(SyncCheckpoint, CHECKPOINT_NAME)
+    if checkpoint is None:
+        checkpoint = SyncCheckpoint(name=CHECKPOINT_NAME, pages=0, checked=0, changed=0)
+        db.session.add(checkpoint)
+    if restart or checkpoint.completed_at is not None or checkpoint.run_started_at is None:
+        checkpoint.cursor = None
+        checkpoint.run_started_at = datetime.utcnow()
+        checkpoint.completed_at = None
+        checkpoint.pages = checkpoint.checked = checkpoint.changed = 0
+    elif checkpoint.cursor:
+        current_app.logger.info(f'Resuming reconcile after {checkpoint.cursor} ({checkpoint.pages} pages done)')
+    db.session.commit()
+    return checkpoint
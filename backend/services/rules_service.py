@@ -0,0 +1,275 @@
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import select
+from app import db
+from models import AdRuleSet, RuleBundle
+
+# Ad-detection rules, per streaming service:
+#   ad_markers      selector groups; an ad is showing while every group
+#                   matches at least one element
+#   skip_buttons    selectors for the ad's skip button (optional)
+#   remaining_time  selector for the ad's countdown (optional)
+#   player          selector for the element to observe (optional)
+#   heuristics      named numeric thresholds for the service's script (optional)
+# Operators edit them through the admin API and publish them as a bundle:
+# one gzipped JSON document for every service, named after a hash of its
+# content. Clients poll the small /rules/latest pointer and download a
+# bundle (or the delta from the version they have) only when it moves.
+SERVICE_NAME = re.compile(r'^[a-z0-9_]{1,32}$')
+MAX_SELECTORS = 100
+MAX_SELECTOR_LENGTH = 500
+VERSION_LENGTH = 24
+BUNDLES_KEPT = 50
+
+DEFAULT_RULES = {
+    'youtube': {
+        'player': '#player-container',
+        'ad_markers': [
+            ['.ytp-ad-player-overlay', '.video-ads.ytp-ad-module'],
+            ['.ytp-ad-skip-button', '.videoAdUiSkipButton', '[id^="skip-button"]', '.ytp-ad-skip-button-modern',
+             '.ytp-ad-text', '.videoAdUiAttribution', '.ytp-ad-preview-text', '.ad-showing',
+             '.ytp-ad-overlay-container']
+        ],
+        'skip_buttons': ['.ytp-ad-skip-button', '.videoAdUiSkipButton', '[id^="skip-button"]',
+                         '.ytp-ad-skip-button-modern']
+    },
+    'hulu': {
+        'player': '#content-video-player',
+        'ad_markers': [[
+            '.ad-container', '.AdUnitView', '.ad-overlay', '.ad-progress-bar',
+            '[data-automation-id="ad-unit"]', '[data-automationid="player-ad-notice"]',
+            '.AdBanner', '.AdTag', '[data-ad-break-type]', '[data-ad-break-start]'
+        ]],
+        'heuristics': {'consecutive_checks': 3, 'time_jump_seconds': 5}
+    },
+    'peacock': {
+        'ad_markers': [['.countdown__foreground-ring'], ['.countdown-container.ad-countdown__container']],
+        'remaining_time': '.countdown__remaining-time'
+    },
+    'paramount': {
+        'player': '#video-player',
+        'ad_markers': [['.ad-container', '.ad-overlay', '.ad-banner',
+                        '[data-testid="ad-overlay"]', '[data-testid="ad-banner"]']],
+        'heuristics': {'consecutive_checks': 3}
+    },
+    'hbomax': {
+        'player': '.video-player',
+        'ad_markers': [['.ad-container', '.ad-overlay', '.ad-banner',
+                        '[data-testid="ad-overlay"]', '[data-testid="ad-banner"]']],
+        'heuristics': {'consecutive_checks': 3}
+    },
+    'twitch': {
+        'player': '.video-player',
+        'ad_markers': [['[aria-label="Ad"]', '[data-a-target="video-ad-label"]',
+                        '.video-player__overlay[data-a-target="player-overlay-ad-alert"]']]
+    },
+}
+
+
+def _selector(value, field):
+    if not isinstance(value, str) or not value.strip() or len(value) > MAX_SELECTOR_LENGTH:
+        raise ValueError(f'{field} must be a non-empty selector of at most {MAX_SELECTOR_LENGTH} characters')
+    return value.strip()
+
+
+def _selectors(value, field):
+    if not isinstance(value, list) or not value or len(value) > MAX_SELECTORS:
+        raise ValueError(f'{field} must be a list of 1 to {MAX_SELECTORS} selectors')
+    return [_selector(item, field) for item in value]
+
+
+def validate_rules(rules):
+    # Returns the rules in canonical form; raises ValueError if malformed.
+    if not isinstance(rules, dict):
+        raise ValueError('Rules must be an object')
+    unknown = set(rules) - {'ad_markers', 'skip_buttons', 'remaining_time', 'player', 'heuristics'}
+    if unknown:
+        raise ValueError(f'Unknown rule fields: {", ".join(sorted(unknown))}')
+    groups = rules.get('ad_markers')
+    if not isinstance(groups, list) or not groups:
+        raise ValueError('ad_markers must be a non-empty list of selector groups')
+    valid = {'ad_markers': [_selectors(group, 'ad_markers') for group in groups]}
+    if 'skip_buttons' in rules:
+        valid['skip_buttons'] = _selectors(rules['skip_buttons'], 'skip_buttons')
+    for field in ('remaining_time', 'player'):
+        if field in rules:
+            valid[field] = _selector(rules[field], field)
+    if 'heuristics' in rules:
+        heuristics = rules['heuristics']
+        if not isinstance(heuristics, dict) or not all(
+                isinstance(name, str) and isinstance(value, (int, float)) and not isinstance(value, bool)
+                for name, value in heuristics.items()):
+            raise ValueError('heuristics must map names to numbers')
+        valid['heuristics'] = heuristics
+    return valid
+
+
+def _service_name(service):
+    if not SERVICE_NAME.match(service or ''):
+        raise ValueError('Service names are 1-32 lowercase letters, digits or underscores')
+    return service
+
+
+def set_service_rules(service, rules):
+    rules = validate_rules(rules)
+    rule_set = db.session.get(AdRuleSet, _service_name(service))
+    if rule_set is None:
+        rule_set = AdRuleSet(service=service)
+        db.session.add(rule_set)
+    rule_set.rules = json.dumps(rules)
+    db.session.commit()
+    return rules
+
+
+def delete_service_rules(service):
+    # Returns whether the service had rules.
+    rule_set = db.session.get(AdRuleSet, service)
+    if rule_set is None:
+        return False
+    db.session.delete(rule_set)
+    db.session.commit()
+    return True
+
+
+def seed_default_rules(overwrite=False):
+    # Stores DEFAULT_RULES for services without rules (or all, with
+    # overwrite). Returns the services written.
+    existing = set(db.session.scalars(select(AdRuleSet.service)).all())
+    written = [service for service in DEFAULT_RULES if overwrite or service not in existing]
+    for service in written:
+        set_service_rules(service, DEFAULT_RULES[service])
+    return written
+
+
+def service_rules():
+    return {rule_set.service: json.loads(rule_set.rules)
+            for rule_set in AdRuleSet.query.order_by(AdRuleSet.service)}
+
+
+def _encode(document):
+    # Canonical JSON, so equal rules always hash and compress to equal bytes.
+    return json.dumps(document, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def _compress(data):
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def compile_bundle(services):
+    # Returns (version, uncompressed size, gzipped body).
+    version = hashlib.sha256(_encode(services)).hexdigest()[:VERSION_LENGTH]
+    data = _encode({'version': version, 'services': services})
+    return version, len(data), _compress(data)
+
+
+def publish_rules(keep=BUNDLES_KEPT):
+    # Compiles the current rules and makes them the latest bundle. The
+    # newest `keep` bundles are kept so clients on them can still get a
+    # delta; older clients download the whole bundle.
+    services = service_rules()
+    if not services:
+        raise ValueError('No rules to publish')
+    version, size, body = compile_bundle(services)
+    bundle = db.session.get(RuleBundle, version)
+    if bundle is None:
+        bundle = RuleBundle(version=version, body=body, size=size)
+        db.session.add(bundle)
+    bundle.published_at = datetime.utcnow()
+    db.session.flush()
+    stale = db.session.scalars(
+        select(RuleBundle.version).order_by(RuleBundle.published_at.desc()).offset(keep)
+    ).all()
+    if stale:
+        RuleBundle.query.filter(RuleBundle.version.in_(stale)).delete(synchronize_session=False)
+    db.session.commit()
+    rule_bundles.reset()
+    return bundle
+
+
+def make_delta(old, new):
+    # The services that differ between two bundle documents.
+    return {
+        'from': old['version'],
+        'version': new['version'],
+        'services': {name: rules for name, rules in new['services'].items()
+                     if old['services'].get(name) != rules},
+        'removed': sorted(set(old['services']) - set(new['services']))
+    }
+
+
+class RuleBundleCache:
+    # Process-level cache behind the /rules endpoints. Bundles and deltas
+    # never change once built, so each is read from the database (or
+    # computed) once per worker and then served from memory, already
+    # gzipped. Only the latest-version pointer expires, after
+    # RULES_POINTER_TTL seconds, which bounds how long a publish takes to
+    # reach every worker.
+
+    def __init__(self):
+        self.pointer_ttl = 30
+        self.max_size = 32
+        self._latest = None
+        self._latest_expires = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.pointer_ttl = app.config.get('RULES_POINTER_TTL', 30)
+        self.max_size = app.config.get('RULES_CACHE_SIZE', 32)
+        self.reset()
+        app.extensions['rule_bundles'] = self
+
+    def reset(self):
+        with self._lock:
+            self._latest = None
+            self._latest_expires = 0
+            self._entries.clear()
+
+    def latest(self):
+        # The latest published version, or None before the first publish.
+        with self._lock:
+            if self._latest_expires > time.monotonic():
+                return self._latest
+        latest = db.session.scalar(select(RuleBundle.version).order_by(RuleBundle.published_at.desc()).limit(1))
+        with self._lock:
+            self._latest = latest
+            self._latest_expires = time.monotonic() + self.pointer_ttl
+        return latest
+
+    def bundle(self, version):
+        # The gzipped bundle, or None if there is no such version.
+        return self._cached(('bundle', version), lambda: db.session.scalar(
+            select(RuleBundle.body).where(RuleBundle.version == version)
+        ))
+
+    def delta(self, from_version, version):
+        # The gzipped delta between two kept bundles, or None.
+        def build():
+            old, new = self.bundle(from_version), self.bundle(version)
+            if old is None or new is None:
+                return None
+            return _compress(_encode(make_delta(json.loads(gzip.decompress(old)), json.loads(gzip.decompress(new)))))
+        return self._cached(('delta', from_version, version), build)
+
+    def _cached(self, key, load):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        body = load()
+        if body is not None:
+            # Misses are not cached: the version may be published later.
+            with self._lock:
+                self._entries[key] = body
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return body
+
+
+rule_bundles = RuleBundleCache()
@@ -0,0 +1,326 @@
+import abc
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import stripe
+from stripe import convert_to_stripe_object
+
+DEFAULT_TIMEOUT = 10  # seconds
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_POOL_SIZE = 20
+DEFAULT_ASYNC_THREADS = 16
+
+
+class StripeGateway(abc.ABC):
+    # The Stripe operations the backend uses. services.stripe_service talks
+    # to whichever implementation STRIPE_GATEWAY selects.
+
+    @abc.abstractmethod
+    def create_checkout_session(self, **params):
+        pass
+
+    @abc.abstractmethod
+    def retrieve_checkout_session(self, session_id, expand=None):
+        pass
+
+    @abc.abstractmethod
+    def retrieve_subscription(self, subscription_id):
+        pass
+
+    @abc.abstractmethod
+    def cancel_subscription(self, subscription_id):
+        pass
+
+    @abc.abstractmethod
+    def list_subscriptions(self, limit=100, starting_after=None, status='all'):
+        pass
+
+    def construct_event(self, payload, sig_header, secret):
+        return stripe.Webhook.construct_event(payload, sig_header, secret)
+
+
+class LiveStripeGateway(StripeGateway):
+    # Calls the Stripe API through one keep-alive requests.Session whose
+    # connection pool is shared by all threads, with explicit timeouts. The
+    # API key goes with each call rather than into stripe.api_key, so
+    # gateways with different keys can live in one process; stripe-python 7
+    # only takes the HTTP client and retry count process-wide.
+
+    def __init__(self, api_key, timeout=DEFAULT_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES, pool_size=DEFAULT_POOL_SIZE):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.api_key = api_key
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        self.http_client = stripe.http_client.RequestsClient(timeout=timeout, session=session)
+
+        stripe.default_http_client = self.http_client
+        stripe.max_network_retries = max_retries
+
+    def create_checkout_session(self, **params):
+        return stripe.checkout.Session.create(api_key=self.api_key, **params)
+
+    def retrieve_checkout_session(self, session_id, expand=None):
+        return stripe.checkout.Session.retrieve(session_id, api_key=self.api_key, expand=expand or [])
+
+    def retrieve_subscription(self, subscription_id):
+        return stripe.Subscription.retrieve(subscription_id, api_key=self.api_key)
+
+    def cancel_subscription(self, subscription_id):
+        return stripe.Subscription.delete(subscription_id, api_key=self.api_key)
+
+    def list_subscriptions(self, limit=100, starting_after=None, status='all'):
+        params = {'limit': limit, 'status': status}
+        if starting_after:
+            params['starting_after'] = starting_after
+        return stripe.Subscription.list(api_key=self.api_key, **params)
+
+
+class FakeStripeGateway(StripeGateway):
+    # Deterministic in-memory stand-in for offline tests and benchmarks.
+    # It covers checkout sessions, subscriptions and invoices, and signs
+    # webhook payloads the same way Stripe does, so construct_event
+    # verification runs for real. Ids come from a counter and `clock` can be
+    # replaced to control timestamps.
+
+    PERIOD_SECONDS = 30 * 24 * 60 * 60
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.checkout_sessions = {}
+        self.customers = {}
+        self.subscriptions = {}
+        self.invoices = {}
+
+    def _id(self, prefix):
+        return f'{prefix}_fake_{next(self._ids):06d}'
+
+    def _now(self):
+        return int(self.clock())
+
+    def _not_found(self, kind, object_id):
+        return stripe.error.InvalidRequestError(f"No such {kind}: '{object_id}'", 'id', code='resource_missing',
+                                                http_status=404)
+
+    def create_checkout_session(self, **params):
+        with self._lock:
+            session_id = self._id('cs')
+            session = {
+                'id': session_id,
+                'object': 'checkout.session',
+                'url': f'https://checkout.stripe.test/pay/{session_id}',
+                'mode': params.get('mode'),
+                'status': 'open',
+                'client_reference_id': params.get('client_reference_id'),
+                'customer': None,
+                'subscription': None,
+                'line_items': params.get('line_items', []),
+                'metadata': dict(params.get('metadata') or {}),
+                'success_url': params.get('success_url'),
+                'cancel_url': params.get('cancel_url'),
+                'created': self._now()
+            }
+            self.checkout_sessions[session_id] = session
+            return convert_to_stripe_object(dict(session))
+
+    def complete_checkout_session(self, session_id):
+        # What Stripe does once the customer pays: a customer, an active
+        # subscription and its first paid invoice.
+        with self._lock:
+            session = self.checkout_sessions.get(session_id)
+            if session is None:
+                raise self._not_found('checkout.session', session_id)
+            customer_id = self._id('cus')
+            self.customers[customer_id] = {'id': customer_id, 'object': 'customer'}
+            now = self._now()
+            subscription_id = self._id('sub')
+            price = session['line_items'][0]['price'] if session['line_items'] else None
+            self.subscriptions[subscription_id] = {
+                'id': subscription_id,
+                'object': 'subscription',
+                'customer': customer_id,
+                'status': 'active',
+                'created': now,
+                'current_period_start': now,
+                'current_period_end': now + self.PERIOD_SECONDS,
+                'cancel_at_period_end': False,
+                'items': {'object': 'list', 'data': [{'price': {'id': price}}]},
+                'metadata': dict(session['metadata']),
+                'latest_invoice': None
+            }
+            session.update(status='complete', customer=customer_id, subscription=subscription_id)
+        self.create_invoice(subscription_id, paid=True)
+        return self.retrieve_checkout_session(session_id)
+
+    def retrieve_checkout_session(self, session_id, expand=None):
+        with self._lock:
+            session = self.checkout_sessions.get(session_id)
+            if session is None:
+                raise self._not_found('checkout.session', session_id)
+            session = dict(session)
+            expand = expand or []
+            if 'subscription' in expand and session['subscription']:
+                subscription = dict(self.subscriptions[session['subscription']])
+                if 'subscription.latest_invoice' in expand and subscription['latest_invoice']:
+                    subscription['latest_invoice'] = dict(self.invoices[subscription['latest_invoice']])
+                session['subscription'] = subscription
+            return convert_to_stripe_object(session)
+
+    def retrieve_subscription(self, subscription_id):
+        with self._lock:
+            subscription = self.subscriptions.get(subscription_id)
+            if subscription is None:
+                raise self._not_found('subscription', subscription_id)
+            return convert_to_stripe_object(dict(subscription))
+
+    def update_subscription(self, subscription_id, **fields):
+        with self._lock:
+            subscription = self.subscriptions.get(subscription_id)
+            if subscription is None:
+                raise self._not_found('subscription', subscription_id)
+            subscription.update(fields)
+            return convert_to_stripe_object(dict(subscription))
+
+    def cancel_subscription(self, subscription_id):
+        return self.update_subscription(subscription_id, status='canceled', canceled_at=self._now())
+
+    def list_subscriptions(self, limit=100, starting_after=None, status='all'):
+        # Newest first, like the real API.
+        with self._lock:
+            subscriptions = sorted(self.subscriptions.values(), key=lambda s: (s['created'], s['id']), reverse=True)
+            if status != 'all':
+                subscriptions = [s for s in subscriptions if s['status'] == status]
+            if starting_after:
+                ids = [s['id'] for s in subscriptions]
+                if starting_after not in ids:
+                    raise self._not_found('subscription', starting_after)
+                subscriptions = subscriptions[ids.index(starting_after) + 1:]
+            page = [dict(s) for s in subscriptions[:limit]]
+            return convert_to_stripe_object({
+                'object': 'list',
+                'url': '/v1/subscriptions',
+                'has_more': len(subscriptions) > limit,
+                'data': page
+            })
+
+    def create_invoice(self, subscription_id, paid=True):
+        with self._lock:
+            subscription = self.subscriptions.get(subscription_id)
+            if subscription is None:
+                raise self._not_found('subscription', subscription_id)
+            invoice_id = self._id('in')
+            invoice = {
+                'id': invoice_id,
+                'object': 'invoice',
+                'customer': subscription['customer'],
+                'subscription': subscription_id,
+                'paid': paid,
+                'status': 'paid' if paid else 'open',
+                'created': self._now(),
+                'lines': {'object': 'list', 'data': [{
+                    'period': {'start': subscription['current_period_start'], 'end': subscription['current_period_end']}
+                }]}
+            }
+            self.invoices[invoice_id] = invoice
+            subscription['latest_invoice'] = invoice_id
+            return convert_to_stripe_object(dict(invoice))
+
+    def make_event(self, event_type, obj, secret, created=None):
+        # Returns (payload, Stripe-Signature header) for a signed webhook delivery.
+        created = self._now() if created is None else created
+        with self._lock:
+            event_id = self._id('evt')
+        payload = json.dumps({
+            'id': event_id,
+            'object': 'event',
+            'type': event_type,
+            'created': created,
+            'data': {'object': obj.to_dict_recursive() if hasattr(obj, 'to_dict_recursive') else obj}
+        })
+        return payload, self.sign_payload(payload, secret)
+
+    def construct_event(self, payload, sig_header, secret, tolerance=300):
+        # Same checks as stripe.Webhook.construct_event, against the fake clock.
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
+        try:
+            parts = dict(item.split('=', 1) for item in sig_header.split(','))
+            timestamp = int(parts['t'])
+        except (AttributeError, KeyError, ValueError):
+            raise stripe.error.SignatureVerificationError(
+                'Unable to extract timestamp and signatures from header', sig_header, payload)
+        expected = self.sign_payload(payload, secret, timestamp).split('v1=', 1)[1]
+        if not hmac.compare_digest(expected, parts.get('v1', '')):
+            raise stripe.error.SignatureVerificationError(
+                'No signatures found matching the expected signature for payload', sig_header, payload)
+        if timestamp < self._now() - tolerance:
+            raise stripe.error.SignatureVerificationError(
+                f'Timestamp outside the tolerance zone ({timestamp})', sig_header, payload)
+        return stripe.Event.construct_from(json.loads(payload), None)
+
+    def sign_payload(self, payload, secret, timestamp=None):
+        timestamp = self._now() if timestamp is None else timestamp
+        signature = hmac.new(secret.encode('utf-8'), f'{timestamp}.{payload}'.encode('utf-8'),
+                             hashlib.sha256).hexdigest()
+        return f't={timestamp},v1={signature}'
+
+
+class AsyncStripeGateway:
+    # Awaitable front for a StripeGateway, used by the ASGI API. stripe-python
+    # 7 has no async client, so calls run on a small dedicated thread pool
+    # sharing the gateway's keep-alive connections; a slow Stripe call ties up
+    # one of these threads instead of the event loop.
+
+    def __init__(self, gateway, max_threads=DEFAULT_ASYNC_THREADS):
+        self.gateway = gateway
+        self._executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='stripe')
+
+    async def _call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(getattr(self.gateway, method), *args, **kwargs))
+
+    async def create_checkout_session(self, **params):
+        return await self._call('create_checkout_session', **params)
+
+    async def retrieve_checkout_session(self, session_id, expand=None):
+        return await self._call('retrieve_checkout_session', session_id, expand=expand)
+
+    async def retrieve_subscription(self, subscription_id):
+        return await self._call('retrieve_subscription', subscription_id)
+
+    async def cancel_subscription(self, subscription_id):
+        return await self._call('cancel_subscription', subscription_id)
+
+    async def list_subscriptions(self, limit=100, starting_after=None, status='all'):
+        return await self._call('list_subscriptions', limit=limit, starting_after=starting_after, status=status)
+
+    def construct_event(self, payload, sig_header, secret):
+        # Local HMAC check, no I/O.
+        return self.gateway.construct_event(payload, sig_header, secret)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def create_gateway(config):
+    kind = config.get('STRIPE_GATEWAY', 'live')
+    if kind == 'fake':
+        return FakeStripeGateway()
+    if kind == 'live':
+        return LiveStripeGateway(
+            config['STRIPE_SECRET_KEY'],
+            timeout=config.get('STRIPE_TIMEOUT', DEFAULT_TIMEOUT),
+            max_retries=config.get('STRIPE_MAX_NETWORK_RETRIES', DEFAULT_MAX_RETRIES),
+            pool_size=config.get('STRIPE_HTTP_POOL_SIZE', DEFAULT_POOL_SIZE)
+        )
+    raise ValueError(f'Unknown STRIPE_GATEWAY: {kind}')
@@ -1,34 +1,74 @@
-import stripe
+import threading
 from flask import current_app, url_for
 
-def init_stripe():
-    stripe.api_key = current_app.config['STRIPE_SECRET_KEY']
+# stripe and the gateway module take a large share of startup time, so they
+# are imported when the first Stripe call is made, not when the app is built.
+
+def __getattr__(name):
+    if name == 'stripe':
+        import stripe
+        return stripe
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class LazyStripeGateway:
+    # Stands in for the configured StripeGateway and builds it on first use.
+
+    def __init__(self, config):
+        self._config = config
+        self._gateway = None
+        self._lock = threading.Lock()
+
+    @property
+    def gateway(self):
+        if self._gateway is None:
+            with self._lock:
+                if self._gateway is None:
+                    from services.stripe_gateway import create_gateway
+                    self._gateway = create_gateway(self._config)
+        return self._gateway
+
+    def __getattr__(self, name):
+        return getattr(self.gateway, name)
+
+def init_stripe(app):
+    app.extensions['stripe_gateway'] = LazyStripeGateway(app.config)
+
+def get_gateway():
+    return current_app.extensions['stripe_gateway']
 
 def create_checkout_session(user_id, plan):
+    session = get_gateway().create_checkout_session(**checkout_session_params(
+        current_app.config, user_id, plan,
+        success_url=url_for('subscription.subscription_success', _external=True),
+        cancel_url=url_for('subscription.subscription_cancel', _external=True)
+    ))
+    return session
+
+def checkout_session_params(config, user_id, plan, success_url, cancel_url):
     if plan in ['basic_monthly', 'basic_yearly']:
-        price_id = current_app.config['BASIC_MONTHLY_PRICE_ID' if plan == 'basic_monthly' else 'BASIC_YEARLY_PRICE_ID']
+        price_id = config['BASIC_MONTHLY_PRICE_ID' if plan == 'basic_monthly' else 'BASIC_YEARLY_PRICE_ID']
     else:
-        price_id = current_app.config['PREMIUM_MONTHLY_PRICE_ID' if plan == 'premium_monthly' else 'PREMIUM_YEARLY_PRICE_ID']
+        price_id = config['PREMIUM_MONTHLY_PRICE_ID' if plan == 'premium_monthly' else 'PREMIUM_YEARLY_PRICE_ID']
 
-    session = stripe.checkout.Session.create(
+    return dict(
         payment_method_types=['card'],
         line_items=[{
             'price': price_id,
             'quantity': 1,
         }],
         mode='subscription',
-        success_url=url_for('subscription.subscription_success', _external=True) + '?session_id={CHECKOUT_SESSION_ID}',
-        cancel_url=url_for('subscription.subscription_cancel', _external=True),
+        success_url=success_url + '?session_id={CHECKOUT_SESSION_ID}',
+        cancel_url=cancel_url,
         client_reference_id=str(user_id),
         metadata={
             'plan': plan
         }
     )
-    return session
 
 def retrieve_checkout_session(session_id):
+    import stripe
     try:
-        return stripe.checkout.Session.retrieve(
+        return get_gateway().retrieve_checkout_session(
             session_id,
             expand=['subscription', 'subscription.latest_invoice']
         )
@@ -40,7 +80,7 @@ def retrieve_checkout_session(session_id):
         raise
 
 def cancel_subscription(subscription_id):
-    return stripe.Subscription.delete(subscription_id)
+    return get_gateway().cancel_subscription(subscription_id)
 
 def construct_event(payload, sig_header, webhook_secret):
-    return stripe.Webhook.construct_event(payload, sig_header, webhook_secret)
\ No newline at end of file
+    return get_gateway().construct_event(payload, sig_header, webhook_secret)
@@ -0,0 +1,316 @@
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from flask_jwt_extended import create_access_token, create_refresh_token
+from sqlalchemy import select, update, delete, insert
+from app import db, jwt
+from models import RefreshToken, RevokedToken
+from utils.helpers import dialect_insert
+
+DEFAULT_REFRESH_EXPIRES = timedelta(days=30)
+# Each sync re-reads this much of the log, so revocations committed slightly
+# out of order by concurrent transactions are still picked up.
+SYNC_LOOKBACK = timedelta(seconds=10)
+
+
+class RefreshTokenReused(Exception):
+    pass
+
+
+class RefreshInProgress(Exception):
+    pass
+
+
+class RevocationFilter:
+    # In-process set of revoked token jtis and family ids, checked on every
+    # @jwt_required request. Lookups are a dict membership test; the set is
+    # refreshed from the revoked_token log at most every `sync_interval`
+    # seconds, reading only rows revoked since the previous sync. Revocations
+    # made by this process apply immediately.
+
+    def __init__(self):
+        self.app = None
+        self.sync_interval = 1
+        self._revoked = {}
+        self._synced_until = None
+        self._next_sync = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.sync_interval = app.config.get('REVOCATION_SYNC_INTERVAL', 1)
+        self.clear()
+        if app.config.get('TESTING'):
+            # Test apps start on an empty database, so the log is already
+            # read; statement counts then only see the endpoints' own queries.
+            self._synced_until = datetime.utcnow()
+            self._next_sync = time.monotonic() + self.sync_interval
+        jwt.token_in_blocklist_loader(self._check_blocklist)
+        app.extensions['revocation_filter'] = self
+
+    def clear(self):
+        with self._lock:
+            self._revoked = {}
+            self._synced_until = None
+            self._next_sync = 0
+
+    def is_revoked(self, claims):
+        self.maybe_sync()
+        return self.contains(claims)
+
+    def contains(self, claims):
+        family_id = claims.get('fam')
+        return claims.get('jti') in self._revoked or (family_id is not None and family_id in self._revoked)
+
+    def add(self, key, expires_at):
+        with self._lock:
+            self._revoked[key] = expires_at
+
+    def sync_due(self):
+        return time.monotonic() >= self._next_sync
+
+    def maybe_sync(self):
+        if not self.sync_due():
+            return
+        # One thread syncs; the others keep answering from the current set.
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            self.sync()
+        finally:
+            self._sync_lock.release()
+
+    async def maybe_sync_async(self, session):
+        # maybe_sync for the ASGI app: the query goes through an async_db
+        # session so it never blocks the event loop.
+        if not self.sync_due() or not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            started = datetime.utcnow()
+            self._apply_sync(started, (await session.execute(self._sync_query(started))).all())
+        finally:
+            self._sync_lock.release()
+
+    def sync(self):
+        started = datetime.utcnow()
+        self._apply_sync(started, db.session.execute(self._sync_query(started)).all())
+
+    def _sync_query(self, started):
+        query = select(RevokedToken.key, RevokedToken.expires_at).where(RevokedToken.expires_at > started)
+        if self._synced_until is not None:
+            query = query.where(RevokedToken.revoked_at >= self._synced_until - SYNC_LOOKBACK)
+        return query
+
+    def _apply_sync(self, started, rows):
+        with self._lock:
+            for key, expires_at in rows:
+                self._revoked[key] = expires_at
+            for key in [key for key, expires_at in self._revoked.items() if expires_at <= started]:
+                del self._revoked[key]
+            self._synced_until = started
+            self._next_sync = time.monotonic() + self.sync_interval
+
+    def _check_blocklist(self, jwt_header, jwt_payload):
+        return self.is_revoked(jwt_payload)
+
+
+revocation_filter = RevocationFilter()
+
+
+def _refresh_expires():
+    expires = current_app.config.get('JWT_REFRESH_TOKEN_EXPIRES', DEFAULT_REFRESH_EXPIRES)
+    return expires if isinstance(expires, timedelta) else DEFAULT_REFRESH_EXPIRES
+
+
+def _new_tokens(user_id, family_id, now):
+    # Access and refresh token for one family, plus the refresh_token row to store.
+    jti = str(uuid.uuid4())
+    claims = {'fam': family_id}
+    access_token = create_access_token(identity=str(user_id), additional_claims=claims)
+    refresh_token = create_refresh_token(identity=str(user_id), additional_claims=dict(claims, jti=jti))
+    row = {
+        'jti': jti,
+        'family_id': family_id,
+        'user_id': int(user_id),
+        'issued_at': now,
+        'expires_at': now + _refresh_expires()
+    }
+    return access_token, refresh_token, row
+
+
+def _claim_statement(jti, now):
+    return (
+        update(RefreshToken)
+        .where(RefreshToken.jti == jti, RefreshToken.used_at.is_(None), RefreshToken.revoked_at.is_(None))
+        .values(used_at=now)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _revoke_statements(session, key, now, expires_at, family=True):
+    statements = []
+    if family:
+        statements.append(
+            update(RefreshToken)
+            .where(RefreshToken.family_id == key, RefreshToken.revoked_at.is_(None))
+            .values(revoked_at=now)
+            .execution_options(synchronize_session=False)
+        )
+    statements.append(
+        dialect_insert(session, RevokedToken.__table__)
+        .values(key=key, revoked_at=now, expires_at=expires_at)
+        .on_conflict_do_nothing(index_elements=['key'])
+    )
+    return statements
+
+
+def _family_revocation_expiry(now):
+    # Every token of the family was issued before now, so none outlives this.
+    access_expires = current_app.config.get('JWT_ACCESS_TOKEN_EXPIRES')
+    horizon = _refresh_expires()
+    if isinstance(access_expires, timedelta):
+        horizon = max(horizon, access_expires)
+    return now + horizon
+
+
+def _rejection(row, now):
+    # Why a refresh token could not be claimed: a retry racing its own
+    # rotation within the grace window, or a replay of a spent token.
+    grace = timedelta(seconds=current_app.config.get('REFRESH_TOKEN_REUSE_GRACE', 10))
+    if row is not None and row.revoked_at is None and row.used_at is not None and now - row.used_at < grace:
+        return RefreshInProgress('Refresh token was just used')
+    return RefreshTokenReused('Refresh token reuse detected')
+
+
+def issue_tokens(user_id, family_id=None):
+    # Starts a new family (login, registration) unless family_id is given.
+    now = datetime.utcnow()
+    access_token, refresh_token, row = _new_tokens(user_id, family_id or str(uuid.uuid4()), now)
+    db.session.execute(insert(RefreshToken), [row])
+    db.session.commit()
+    return access_token, refresh_token
+
+
+def rotate_refresh_token(claims):
+    # Exchanges a refresh token for a new pair in the same family. A token can
+    # be claimed once; presenting a spent one again means it leaked, so the
+    # whole family is revoked and RefreshTokenReused raised.
+    now = datetime.utcnow()
+    user_id = claims['sub']
+    family_id = claims.get('fam')
+
+    if family_id is None:
+        # Issued before rotation existed: retire it and start a family.
+        expires_at = datetime.utcfromtimestamp(claims['exp']) if 'exp' in claims else _family_revocation_expiry(now)
+        for stmt in _revoke_statements(db.session, claims['jti'], now, expires_at, family=False):
+            db.session.execute(stmt)
+        revocation_filter.add(claims['jti'], expires_at)
+        return issue_tokens(user_id)
+
+    if db.session.execute(_claim_statement(claims['jti'], now)).rowcount != 1:
+        db.session.rollback()
+        error = _rejection(db.session.get(RefreshToken, claims['jti']), now)
+        if isinstance(error, RefreshTokenReused):
+            revoke_family(family_id)
+            current_app.logger.warning(f'Refresh token reuse for user {user_id}; revoked family {family_id}')
+        raise error
+
+    access_token, refresh_token, row = _new_tokens(user_id, family_id, now)
+    db.session.execute(insert(RefreshToken), [row])
+    db.session.commit()
+    return access_token, refresh_token
+
+
+def revoke_family(family_id):
+    now = datetime.utcnow()
+    expires_at = _family_revocation_expiry(now)
+    for stmt in _revoke_statements(db.session, family_id, now, expires_at):
+        db.session.execute(stmt)
+    db.session.commit()
+    revocation_filter.add(family_id, expires_at)
+
+
+def revoke_session(claims):
+    # Revokes the presented access token and, through its family, every
+    # refresh and access token descended from the same login.
+    now = datetime.utcnow()
+    if claims.get('fam'):
+        revoke_family(claims['fam'])
+    expires_at = datetime.utcfromtimestamp(claims['exp']) if 'exp' in claims else _family_revocation_expiry(now)
+    for stmt in _revoke_statements(db.session, claims['jti'], now, expires_at, family=False):
+        db.session.execute(stmt)
+    db.session.commit()
+    revocation_filter.add(claims['jti'], expires_at)
+
+
+async def issue_tokens_async(session, app, user_id, family_id=None):
+    # issue_tokens() for the ASGI API; `app` is the Flask app whose JWT
+    # settings sign the tokens.
+    now = datetime.utcnow()
+    with app.app_context():
+        access_token, refresh_token, row = _new_tokens(user_id, family_id or str(uuid.uuid4()), now)
+    await session.execute(insert(RefreshToken), [row])
+    await session.commit()
+    return access_token, refresh_token
+
+
+async def rotate_refresh_token_async(session, app, claims):
+    now = datetime.utcnow()
+    user_id = claims['sub']
+    family_id = claims.get('fam')
+
+    with app.app_context():
+        if family_id is None:
+            expires_at = datetime.utcfromtimestamp(claims['exp']) if 'exp' in claims else _family_revocation_expiry(now)
+            for stmt in _revoke_statements(session.sync_session, claims['jti'], now, expires_at, family=False):
+                await session.execute(stmt)
+            revocation_filter.add(claims['jti'], expires_at)
+            return await issue_tokens_async(session, app, user_id)
+
+        if (await session.execute(_claim_statement(claims['jti'], now))).rowcount != 1:
+            await session.rollback()
+            error = _rejection(await session.get(RefreshToken, claims['jti']), now)
+            if isinstance(error, RefreshTokenReused):
+                await revoke_family_async(session, app, family_id)
+                app.logger.warning(f'Refresh token reuse for user {user_id}; revoked family {family_id}')
+            raise error
+
+        access_token, refresh_token, row = _new_tokens(user_id, family_id, now)
+    await session.execute(insert(RefreshToken), [row])
+    await session.commit()
+    return access_token, refresh_token
+
+
+async def revoke_family_async(session, app, family_id):
+    now = datetime.utcnow()
+    with app.app_context():
+        expires_at = _family_revocation_expiry(now)
+    for stmt in _revoke_statements(session.sync_session, family_id, now, expires_at):
+        await session.execute(stmt)
+    await session.commit()
+    revocation_filter.add(family_id, expires_at)
+
+
+async def revoke_session_async(session, app, claims):
+    now = datetime.utcnow()
+    if claims.get('fam'):
+        await revoke_family_async(session, app, claims['fam'])
+    with app.app_context():
+        expires_at = datetime.utcfromtimestamp(claims['exp']) if 'exp' in claims else _family_revocation_expiry(now)
+    for stmt in _revoke_statements(session.sync_session, claims['jti'], now, expires_at, family=False):
+        await session.execute(stmt)
+    await session.commit()
+    revocation_filter.add(claims['jti'], expires_at)
+
+
+def prune_tokens():
+    # Deletes refresh tokens and revocations that can no longer matter
+    # because the tokens involved have expired. Returns rows removed.
+    now = datetime.utcnow()
+    removed = db.session.execute(delete(RefreshToken).where(RefreshToken.expires_at < now)).rowcount
+    removed += db.session.execute(delete(RevokedToken).where(RevokedToken.expires_at < now)).rowcount
+    db.session.commit()
+    return removed
@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import or_, select, update
+from app import db
+from models import Subscription, StripeEvent
+from services.entitlement_service import invalidate_entitlement, bump_version
+from services.push_service import push_hub, SUBSCRIPTION_CHANGED
+from utils.helpers import dialect_insert
+
+CLAIM_BATCH_SIZE = 50
+LEASE_SECONDS = 60
+MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+
+
+def record_event(event):
+    # Persists a verified event once; Stripe retries of the same id are no-ops.
+    db.session.execute(_record_statement(db.session, event))
+    db.session.commit()
+
+
+async def record_event_async(session, event):
+    await session.execute(_record_statement(session.sync_session, event))
+    await session.commit()
+
+
+def _record_statement(session, event):
+    return dialect_insert(session, StripeEvent.__table__).values(
+        id=event['id'],
+        type=event['type'],
+        created=event['created'],
+        payload=json.dumps(event['data']['object']),
+        status='pending',
+        attempts=0,
+        received_at=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=['id'])
+
+
+def claim_events(batch_size=CLAIM_BATCH_SIZE, lease_seconds=LEASE_SECONDS):
+    # Claims up to batch_size pending events, oldest `created` first. Rows
+    # whose lease expired (a worker died mid-batch) are claimable again, and
+    # so are failed attempts once their retry delay (also locked_until) is
+    # over. FOR UPDATE SKIP LOCKED lets workers on several nodes pick
+    # disjoint batches on PostgreSQL; the guarded UPDATE keeps claims
+    # exclusive on databases without row locks.
+    now = datetime.utcnow()
+    claimable = or_(
+        (StripeEvent.status == 'pending') & (StripeEvent.locked_until.is_(None) | (StripeEvent.locked_until <= now)),
+        (StripeEvent.status == 'processing') & (StripeEvent.locked_until < now)
+    )
+    ids = db.session.scalars(
+        select(StripeEvent.id)
+        .where(claimable)
+        .order_by(StripeEvent.created, StripeEvent.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    if not ids:
+        db.session.rollback()
+        return []
+
+    token = uuid.uuid4().hex
+    db.session.execute(
+        update(StripeEvent)
+        .where(StripeEvent.id.in_(ids), claimable)
+        .values(
+            status='processing',
+            claim_token=token,
+            locked_until=now + timedelta(seconds=lease_seconds),
+            attempts=StripeEvent.attempts + 1
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return StripeEvent.query.filter_by(claim_token=token, status='processing') \
+        .order_by(StripeEvent.created, StripeEvent.id).all()
+
+
+def process_pending_events(batch_size=CLAIM_BATCH_SIZE):
+    # Claims and applies one batch. Returns the number of events handled.
+    events = claim_events(batch_size)
+    # Each commit expires the rest of the batch, and a reload would show
+    # the token of whoever holds the event then; keep the one claimed here.
+    token = events[0].claim_token if events else None
+    for event in events:
+        apply_event(event, token)
+    return len(events)
+
+
+def apply_event(event, claim_token):
+    # The subscription change and the ledger update commit together, and
+    # only while this worker's claim still holds: if the lease ran out and
+    # another worker claimed the event, the change is rolled back.
+    event_id, attempts = event.id, event.attempts
+    handler = EVENT_HANDLERS.get(event.type)
+    try:
+        user_id = None
+        if handler:
+            user_id = handler(json.loads(event.payload), event.created)
+        else:
+            current_app.logger.info(f"Unhandled event type: {event.type}")
+        if user_id:
+            bump_version(user_id)
+        if not _finish_claim(event_id, claim_token, status='done', processed_at=datetime.utcnow(),
+                             locked_until=None, last_error=None):
+            db.session.rollback()
+            current_app.logger.warning(f'Lost the claim on Stripe event {event_id}; not applying it')
+            return
+        db.session.commit()
+        if user_id:
+            invalidate_entitlement(user_id)
+            push_hub.publish(user_id, SUBSCRIPTION_CHANGED)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f'Error applying Stripe event {event_id}: {str(e)}')
+        if attempts >= MAX_ATTEMPTS:
+            _finish_claim(event_id, claim_token, status='failed', locked_until=None, last_error=str(e))
+        else:
+            # Retry later rather than on the worker's next poll.
+            delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+            _finish_claim(event_id, claim_token, status='pending', last_error=str(e),
+                          locked_until=datetime.utcnow() + timedelta(seconds=delay))
+        db.session.commit()
+
+
+def _finish_claim(event_id, token, **values):
+    # Updates a claimed event if the claim is still ours; returns whether it was.
+    result = db.session.execute(
+        update(StripeEvent)
+        .where(StripeEvent.id == event_id, StripeEvent.claim_token == token, StripeEvent.status == 'processing')
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+
+def _subscription_for_event(stripe_subscription_id, event_created):
+    # Moves last_event_created forward with a conditional UPDATE, which also
+    # locks the row until commit. Of two workers applying events for one
+    # subscription at once, the one with the older event then matches no
+    # row, whichever of them gets there first.
+    result = db.session.execute(
+        update(Subscription)
+        .where(Subscription.stripe_subscription_id == stripe_subscription_id,
+               Subscription.last_event_created.is_(None) | (Subscription.last_event_created <= event_created))
+        .values(last_event_created=event_created)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        current_app.logger.info(f"Skipping event for Stripe subscription {stripe_subscription_id}: "
+                                f"unknown or superseded by a newer event")
+        return None
+    return Subscription.query.filter_by(stripe_subscription_id=stripe_subscription_id).populate_existing().first()
+
+
+def handle_subscription_updated(stripe_subscription, event_created):
+    subscription = _subscription_for_event(stripe_subscription['id'], event_created)
+    if subscription:
+        subscription.status = stripe_subscription['status']
+        subscription.current_period_end = datetime.fromtimestamp(stripe_subscription['current_period_end'])
+        current_app.logger.info(f"Subscription {subscription.id} updated")
+        return subscription.user_id
+    else:
+        current_app.logger.warning(f"No subscription updated for Stripe subscription: {stripe_subscription['id']}")
+
+def handle_subscription_deleted(stripe_subscription, event_created):
+    subscription = _subscription_for_event(stripe_subscription['id'], event_created)
+    if subscription:
+        subscription.status = 'cancelled'
+        current_app.logger.info(f"Subscription {subscription.id} marked as cancelled")
+        return subscription.user_id
+    else:
+        current_app.logger.warning(f"No subscription updated for Stripe subscription: {stripe_subscription['id']}")
+
+def handle_invoice_paid(invoice, event_created):
+    subscription = _subscription_for_event(invoice['subscription'], event_created)
+    if subscription:
+        subscription.status = 'active'
+        subscription.current_period_end = datetime.fromtimestamp(invoice['lines']['data'][0]['period']['end'])
+        current_app.logger.info(f"Subscription {subscription.id} renewed")
+        return subscription.user_id
+    else:
+        current_app.logger.warning(f"No subscription updated for invoice: {invoice['id']}")
+
+def handle_invoice_failed(invoice, event_created):
+    subscription = _subscription_for_event(invoice['subscription'], event_created)
+    if subscription:
+        subscription.status = 'past_due'
+        current_app.logger.info(f"Subscription {subscription.id} marked as past due")
+        return subscription.user_id
+    else:
+        current_app.logger.warning(f"No subscription updated for invoice: {invoice['id']}")
+
+
+EVENT_HANDLERS = {
+    'customer.subscription.updated': handle_subscription_updated,
+    'customer.subscription.deleted': handle_subscription_deleted,
+    'invoice.payment_succeeded': handle_invoice_paid,
+    'invoice.payment_failed': handle_invoice_failed,
+}
+
+
+class StripeEventWorker:
+    # Optional in-process worker: a daemon thread that drains the ledger
+    # after each webhook and every `poll_interval` seconds. Dedicated worker
+    # nodes run `manage.py process_webhooks` instead.
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.poll_interval = 5
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('STRIPE_EVENT_WORKER_THREAD', True)
+        self.poll_interval = app.config.get('STRIPE_EVENT_POLL_INTERVAL', 5)
+        app.extensions['stripe_event_worker'] = self
+
+    def notify(self):
+        if not self.enabled or self.app is None:
+            return
+        pid = os.getpid()
+        with self._lock:
+            if self._thread is None or self._thread_pid != pid or not self._thread.is_alive():
+                self._thread_pid = pid
+                self._thread = threading.Thread(target=self._run, name='stripe-event-worker', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            with self.app.app_context():
+                try:
+                    while process_pending_events():
+                        pass
+                except Exception as e:
+                    self.app.logger.error(f'Stripe event worker error: {str(e)}')
+                finally:
+                    db.session.remove()
+
+
+def run_worker(poll_interval=2, batch_size=CLAIM_BATCH_SIZE):
+    # Blocking loop for dedicated worker processes; safe to run on several nodes.
+    while True:
+        if not process_pending_events(batch_size):
+            time.sleep(poll_interval)
+
+
+stripe_event_worker = StripeEventWorker()
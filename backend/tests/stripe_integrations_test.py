@@ -1,66 +1,74 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from datetime import datetime
 from app import create_app, db
 from models import User, Subscription
+from services.webhook_service import stripe_event_worker
 from flask_jwt_extended import create_access_token
 
 class StripeIntegrationTestCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app('testing')
         self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        stripe_event_worker.enabled = False
         self.client = self.app.test_client()
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
+        # TestingConfig selects the offline FakeStripeGateway.
+        self.gateway = self.app.extensions['stripe_gateway']
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
 
-    @patch('services.stripe_service.stripe.Customer.create')
-    @patch('services.stripe_service.stripe.PaymentMethod.attach')
-    @patch('services.stripe_service.stripe.Customer.modify')
-    @patch('services.stripe_service.stripe.Subscription.create')
-    def test_create_subscription(self, mock_sub_create, mock_cust_modify, mock_pm_attach, mock_cust_create):
+    def test_create_subscription(self):
         # Create a test user
         user = User(username='testuser', email='test@example.com')
         user.set_password('password')
         db.session.add(user)
         db.session.commit()
 
-        # Mock Stripe API responses
-        mock_cust_create.return_value = MagicMock(id='cus_test123')
-        mock_pm_attach.return_value = MagicMock(id='pm_test123')
-        mock_sub_create.return_value = MagicMock(
-            id='sub_test123',
-            status='active',
-            current_period_end=1609459200
-        )
+        access_token = create_access_token(identity=str(user.id))
 
-        # Create access token
-        with self.app.app_context():
-            access_token = create_access_token(identity=user.id)
-
-        # Create a subscription
-        response = self.client.post('/subscription/subscribe', 
+        # Open a checkout session
+        response = self.client.post('/subscription/create-checkout-session',
                                     headers={'Authorization': f'Bearer {access_token}'},
-                                    json={'plan': 'monthly', 'payment_method_id': 'pm_test123'})
-        
-        self.assertEqual(response.status_code, 201)
-        self.assertIn('Subscription created successfully', response.get_json()['message'])
+                                    json={'plan': 'premium_monthly'})
+
+        self.assertEqual(response.status_code, 200)
+        session_id = response.get_json()['sessionId']
+        self.assertEqual(response.get_json()['url'], self.gateway.checkout_sessions[session_id]['url'])
+
+        # The session carries the user, plan and price through Stripe
+        session = self.gateway.checkout_sessions[session_id]
+        self.assertEqual(session['mode'], 'subscription')
+        self.assertEqual(session['client_reference_id'], str(user.id))
+        self.assertEqual(session['metadata']['plan'], 'premium_monthly')
+        self.assertEqual(session['line_items'][0]['price'], self.app.config['PREMIUM_MONTHLY_PRICE_ID'])
+
+        # Pay, then come back through the success redirect
+        self.gateway.complete_checkout_session(session_id)
+        response = self.client.get(f'/subscription/subscription-success?session_id={session_id}')
+
+        self.assertEqual(response.status_code, 200)
+
+        # Check that the subscription was created in the database from Stripe's records
+        session = self.gateway.checkout_sessions[session_id]
+        stripe_sub = self.gateway.retrieve_subscription(session['subscription'])
+        subscription = Subscription.query.filter_by(user_id=user.id).one()
+        self.assertEqual(subscription.status, 'active')
+        self.assertEqual(subscription.plan, 'premium_monthly')
+        self.assertEqual(subscription.device_limit, 5)
+        self.assertEqual(subscription.stripe_customer_id, session['customer'])
+        self.assertEqual(subscription.stripe_subscription_id, stripe_sub.id)
+        self.assertEqual(subscription.current_period_end, datetime.fromtimestamp(stripe_sub.current_period_end))
 
-        # Check that the subscription was created in the database
-        user = User.query.filter_by(username='testuser').first()
-        self.assertIsNotNone(user.subscription)
-        self.assertEqual(user.subscription.status, 'active')
-        self.assertEqual(user.subscription.plan, 'monthly')
+    def test_unknown_checkout_session(self):
+        response = self.client.get('/subscription/subscription-success?session_id=cs_missing')
 
-        # Verify Stripe API calls
-        mock_cust_create.assert_called_once()
-        mock_pm_attach.assert_called_once()
-        mock_cust_modify.assert_called_once()
-        mock_sub_create.assert_called_once()
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(Subscription.query.count(), 0)
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
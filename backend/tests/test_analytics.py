@@ -0,0 +1,109 @@
+import hashlib
+import hmac
+import json
+import time
+import unittest
+from sqlalchemy import update
+from app import create_app, db
+from models import User, Subscription, Device, GlobalCounter
+from services.analytics_service import global_counters, recount
+from services.metrics_service import metrics_buffer
+from services.device_service import device_activity, sweep_stale_devices
+from services.webhook_service import stripe_event_worker, process_pending_events
+from flask_jwt_extended import create_access_token
+
+class GlobalCountersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing', config_overrides={
+            'ADMIN_API_TOKEN': 'admin-token',
+            'PLAN_MONTHLY_PRICES': {'basic_monthly': 499, 'premium_monthly': 999},
+        })
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        stripe_event_worker.enabled = False
+        metrics_buffer.interval = 0
+        device_activity.interval = 0
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.user = User(username='testuser', email='test@example.com', total_muted_time=10, total_ads_muted=1)
+        other = User(username='other', email='other@example.com')
+        db.session.add_all([self.user, other])
+        db.session.commit()
+        db.session.add(Subscription(user_id=self.user.id, plan='premium_monthly', status='active', device_limit=5,
+                                    stripe_subscription_id='sub_test123'))
+        db.session.add(Subscription(user_id=other.id, plan='basic_monthly', status='active', device_limit=1,
+                                    stripe_subscription_id='sub_test456'))
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {create_access_token(identity=str(self.user.id))}'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def stats(self, token='admin-token'):
+        return self.client.get('/admin/stats', headers={'Authorization': f'Bearer {token}'})
+
+    def post_event(self, event_id, event_type, obj):
+        payload = json.dumps({'id': event_id, 'object': 'event', 'type': event_type, 'created': 1700000000,
+                              'data': {'object': obj}})
+        timestamp = int(time.time())
+        signature = hmac.new(self.app.config['STRIPE_WEBHOOK_SECRET'].encode('utf-8'),
+                             f'{timestamp}.{payload}'.encode('utf-8'), hashlib.sha256).hexdigest()
+        return self.client.post('/subscription/webhook', data=payload,
+                                headers={'Stripe-Signature': f't={timestamp},v1={signature}'})
+
+    def test_write_paths_keep_counters_equal_to_a_recount(self):
+        response = self.client.post('/devices/register', json={'device_id': 'device-1'}, headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+        self.client.post('/devices/register', json={'device_id': 'device-2'}, headers=self.headers)
+        self.client.delete(f'/devices/remove/{response.get_json()["id"]}', headers=self.headers)
+
+        self.client.post('/user/metrics/events', json={'events': [{'id': 'a', 'duration': 15}]},
+                         headers=self.headers)
+        metrics_buffer.flush_now()
+        self.client.post('/user/metrics', json={'timeMuted': 100, 'adsMuted': 7}, headers=self.headers)
+
+        self.post_event('evt_1', 'customer.subscription.deleted', {'id': 'sub_test456', 'object': 'subscription'})
+        process_pending_events()
+
+        nonzero = lambda totals: {name: value for name, value in totals.items() if value}
+        self.assertEqual(nonzero(global_counters.totals()), nonzero(recount()))
+        stats = self.stats().get_json()
+        self.assertEqual(stats['users'], 2)
+        self.assertEqual(stats['devices'], 1)
+        self.assertEqual(stats['total_ads_muted'], 7)
+        self.assertEqual(stats['total_muted_time'], 100)
+        self.assertEqual(stats['subscriptions'], {'active': {'premium_monthly': 1},
+                                                  'cancelled': {'basic_monthly': 1}})
+        self.assertEqual(stats['monthly_recurring_revenue'], 999)
+
+    def test_sweep_decrements_devices(self):
+        db.session.add(Device(user_id=self.user.id, device_id='stale', name='Old'))
+        db.session.commit()
+        self.assertEqual(global_counters.totals()['devices'], 1)
+        # A negative idle time puts the cutoff in the future, so every device is stale.
+        sweep_stale_devices(max_idle_days=-1)
+        self.assertEqual(global_counters.totals()['devices'], 0)
+
+    def test_reconcile_corrects_drift(self):
+        # Rows changed behind the app's back.
+        db.session.execute(update(User).where(User.id == self.user.id).values(total_ads_muted=User.total_ads_muted + 5))
+        db.session.execute(update(GlobalCounter).where(GlobalCounter.name == 'users').values(value=0))
+        db.session.commit()
+
+        corrections = global_counters.reconcile()
+        self.assertEqual(corrections, {'ads_muted': 5, 'users': 2})
+        self.assertEqual(global_counters.totals()['ads_muted'], 6)
+        self.assertEqual(global_counters.totals()['users'], 2)
+        self.assertEqual(global_counters.reconcile(), {})
+
+    def test_stats_require_the_admin_token(self):
+        self.assertEqual(self.stats('wrong').status_code, 401)
+        self.app.config['ADMIN_API_TOKEN'] = None
+        self.assertEqual(self.stats().status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
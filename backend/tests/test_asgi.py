@@ -0,0 +1,271 @@
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+from flask_jwt_extended import decode_token
+from app import db
+from asgi import create_asgi_app
+from models import User, Subscription, Device, StripeEvent, RevokedToken, AccountDeletion
+from services.async_db import async_db
+from services.metrics_service import metrics_buffer
+from services.device_service import device_activity
+from services.webhook_service import stripe_event_worker
+from services.push_service import push_hub, SUBSCRIPTION_CHANGED
+from services.token_service import RevocationFilter, revocation_filter
+from services.rules_service import seed_default_rules, publish_rules
+from utils.rate_limit import rate_limiter
+
+class AsgiApiTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # A file database, so the async engine and the sync flushers share it.
+        handle, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.app = create_asgi_app('testing', config_overrides={
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.db_path}',
+            'JWT_SECRET_KEY': 'test-jwt-secret-key',
+            'STRIPE_GATEWAY': 'fake',
+            'PASSWORD_HASH_WORKERS': 0,
+            'BCRYPT_LOG_ROUNDS': 4,
+            'ADMIN_API_TOKEN': 'admin-token'
+        })
+        self.flask_app = self.app.extensions['flask_app']
+        self.gateway = self.flask_app.extensions['stripe_gateway']
+        stripe_event_worker.enabled = False
+        metrics_buffer.interval = 0
+        device_activity.interval = 0
+        with self.flask_app.app_context():
+            db.create_all()
+        self.client = self.app.test_client()
+
+        response = await self.client.post('/auth/register', json={
+            'username': 'testuser', 'email': 'test@example.com', 'password': 'password123'
+        })
+        self.assertEqual(response.status_code, 201)
+        tokens = await response.get_json()
+        self.refresh_token = tokens['refresh_token']
+        self.headers = {'Authorization': f"Bearer {tokens['access_token']}"}
+        with self.flask_app.app_context():
+            self.user_id = User.query.filter_by(username='testuser').one().id
+
+    async def asyncTearDown(self):
+        with self.flask_app.app_context():
+            metrics_buffer.flush_now()
+            device_activity.flush_now()
+            db.session.remove()
+            db.drop_all()
+        await async_db.dispose()
+        os.remove(self.db_path)
+
+    def subscribe(self, device_limit=2):
+        checkout = self.gateway.create_checkout_session(line_items=[{'price': 'price_test'}],
+                                                        metadata={'plan': 'premium_monthly'})
+        checkout = self.gateway.complete_checkout_session(checkout.id)
+        with self.flask_app.app_context():
+            db.session.add(Subscription(user_id=self.user_id, plan='premium_monthly', status='active',
+                                        device_limit=device_limit, stripe_subscription_id=checkout.subscription))
+            db.session.commit()
+        return checkout.subscription
+
+    async def test_login_refresh_and_conditional_get(self):
+        response = await self.client.post('/auth/login', json={'username': 'testuser', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 401)
+        response = await self.client.post('/auth/login', json={'username': 'testuser', 'password': 'password123'})
+        self.assertEqual(response.status_code, 200)
+
+        response = await self.client.post('/auth/refresh',
+                                          headers={'Authorization': f'Bearer {self.refresh_token}'})
+        self.assertEqual(response.status_code, 200)
+        response = await self.client.post('/auth/refresh', headers=self.headers)
+        self.assertEqual(response.status_code, 422)
+
+        response = await self.client.get('/auth/user', headers=self.headers)
+        self.assertEqual((await response.get_json())['username'], 'testuser')
+        response = await self.client.get('/auth/user', headers=dict(self.headers, **{'If-None-Match': response.headers['ETag']}))
+        self.assertEqual(response.status_code, 304)
+
+    async def test_refresh_rotation_and_logout(self):
+        response = await self.client.post('/auth/refresh',
+                                          headers={'Authorization': f'Bearer {self.refresh_token}'})
+        rotated = await response.get_json()
+
+        response = await self.client.post('/auth/logout',
+                                          headers={'Authorization': f"Bearer {rotated['access_token']}"})
+        self.assertEqual(response.status_code, 200)
+        response = await self.client.get('/auth/user', headers={'Authorization': f"Bearer {rotated['access_token']}"})
+        self.assertEqual(response.status_code, 401)
+        response = await self.client.post('/auth/refresh',
+                                          headers={'Authorization': f"Bearer {rotated['refresh_token']}"})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_revocations_from_other_workers_sync_without_the_sync_session(self):
+        with self.flask_app.app_context():
+            jti = decode_token(self.headers['Authorization'][len('Bearer '):])['jti']
+            # Revoked by another process, so only the next sync can see it.
+            db.session.add(RevokedToken(key=jti, expires_at=datetime.utcnow() + timedelta(hours=1)))
+            db.session.commit()
+        revocation_filter.clear()
+        with mock.patch.object(RevocationFilter, 'sync', side_effect=AssertionError('sync query on the event loop')):
+            response = await self.client.get('/auth/user', headers=self.headers)
+        self.assertEqual(response.status_code, 401)
+
+    async def test_account_deletion_needs_the_password_and_signs_out(self):
+        response = await self.client.delete('/auth/account', json={'password': 'wrong'}, headers=self.headers)
+        self.assertEqual(response.status_code, 401)
+        response = await self.client.delete('/auth/account', json={'password': 'password123'}, headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual((await response.get_json())['deletion']['status'], 'pending')
+
+        with self.flask_app.app_context():
+            self.assertEqual(AccountDeletion.query.filter_by(user_id=self.user_id).count(), 1)
+        response = await self.client.post('/auth/refresh', headers={'Authorization': f'Bearer {self.refresh_token}'})
+        self.assertEqual(response.status_code, 401)
+        response = await self.client.post('/auth/login', json={'username': 'testuser', 'password': 'password123'})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_missing_token_is_rejected(self):
+        response = await self.client.get('/devices/list')
+        self.assertEqual(response.status_code, 401)
+
+    async def test_device_lifecycle_respects_the_limit(self):
+        response = await self.client.post('/devices/register', json={'device_id': 'device-1'}, headers=self.headers)
+        self.assertEqual(response.status_code, 403)
+
+        self.subscribe(device_limit=1)
+        response = await self.client.post('/devices/register', json={'device_id': 'device-1'}, headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+        device_pk = (await response.get_json())['id']
+        response = await self.client.post('/devices/register', json={'device_id': 'device-2'}, headers=self.headers)
+        self.assertEqual(response.status_code, 403)
+
+        response = await self.client.post(f'/devices/update-activity/{device_pk}', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        response = await self.client.get('/devices/list', headers=self.headers)
+        self.assertEqual([d['id'] for d in (await response.get_json())['devices']], [device_pk])
+
+        response = await self.client.delete(f'/devices/remove/{device_pk}', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        with self.flask_app.app_context():
+            self.assertEqual(Device.query.count(), 0)
+
+    async def test_metric_events_are_buffered_and_flushed(self):
+        response = await self.client.post('/user/metrics/events', json={'events': [
+            {'id': 'evt-1', 'duration': 30}, {'id': 'evt-2', 'duration': 15}
+        ]}, headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        response = await self.client.get('/user/metrics', headers=self.headers)
+        self.assertEqual((await response.get_json())['total_muted_time'], 45)
+
+        with self.flask_app.app_context():
+            metrics_buffer.flush_now()
+            self.assertEqual(db.session.get(User, self.user_id).total_ads_muted, 2)
+
+    async def test_rate_limits_and_buffer_flushes_run_off_the_loop(self):
+        loop_thread = threading.get_ident()
+        threads = []
+        take, flush = rate_limiter.storage.take, metrics_buffer.flush
+        metrics_buffer.max_pending = 1
+        with mock.patch.object(rate_limiter.storage, 'take',
+                               side_effect=lambda *args: threads.append(threading.get_ident()) or take(*args)), \
+                mock.patch.object(metrics_buffer, 'flush',
+                                  side_effect=lambda batch: threads.append(threading.get_ident()) or flush(batch)):
+            response = await self.client.post('/user/metrics/events', json={'events': [{'id': 'evt-1', 'duration': 30}]},
+                                              headers=self.headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(loop_thread, threads)
+        with self.flask_app.app_context():
+            self.assertEqual(db.session.get(User, self.user_id).total_muted_time, 30)
+
+    async def test_export_streams_through_the_flask_app(self):
+        await self.client.post('/user/metrics/events', json={'events': [{'id': 'evt-1', 'duration': 30}]},
+                               headers=self.headers)
+        response = await self.client.get('/user/export?format=csv&dataset=users', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], 'text/csv; charset=utf-8')
+        lines = (await response.get_data(as_text=True)).splitlines()
+        self.assertEqual(lines[1].split(',')[1:2] + lines[1].split(',')[4:], ['testuser', '30', '1'])
+
+    async def test_unported_blueprints_are_served_by_the_flask_app(self):
+        response = await self.client.get('/session/bootstrap', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((await response.get_json())['user']['username'], 'testuser')
+        response = await self.client.get('/metrics/usage?granularity=day&start=2026-03-01&end=2026-03-08',
+                                         headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        response = await self.client.get('/admin/stats', headers={'Authorization': 'Bearer admin-token'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((await self.client.get('/admin/stats')).status_code, 401)
+
+        with self.flask_app.app_context():
+            seed_default_rules()
+            version = publish_rules().version
+        response = await self.client.get('/rules/latest')
+        self.assertEqual((await response.get_json())['version'], version)
+        # Bodiless responses still complete.
+        response = await self.client.get('/rules/latest', headers={'If-None-Match': f'"{version}"'})
+        self.assertEqual(response.status_code, 304)
+
+    async def test_cancel_and_webhook_go_through_the_gateway(self):
+        stripe_subscription_id = self.subscribe()
+        response = await self.client.post('/subscription/cancel', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        response = await self.client.get('/subscription/subscription', headers=self.headers)
+        self.assertEqual((await response.get_json())['status'], 'canceled')
+
+        payload, signature = self.gateway.make_event(
+            'customer.subscription.deleted', self.gateway.retrieve_subscription(stripe_subscription_id),
+            self.app.config['STRIPE_WEBHOOK_SECRET']
+        )
+        response = await self.client.post('/subscription/webhook', data=payload,
+                                          headers={'Stripe-Signature': signature})
+        self.assertEqual(response.status_code, 200)
+        response = await self.client.post('/subscription/webhook', data=payload,
+                                          headers={'Stripe-Signature': 't=1,v1=bad'})
+        self.assertEqual(response.status_code, 400)
+        with self.flask_app.app_context():
+            self.assertEqual(StripeEvent.query.count(), 1)
+
+    async def test_push_stream_follows_cancellation(self):
+        self.subscribe()
+        async with self.client.request('/push/stream', headers=self.headers) as connection:
+            await connection.send_complete()
+            received = ''
+            while 'event: devices' not in received:
+                received += (await connection.receive()).decode()
+            self.assertIn('"status":"active"', received)
+
+            response = await self.client.post('/subscription/cancel', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            received = (await connection.receive()).decode()
+            self.assertTrue(received.startswith('event: subscription'))
+            self.assertIn('"status":"canceled"', received)
+            await connection.disconnect()
+
+    async def test_checkout_success_publishes_the_new_subscription(self):
+        channel = push_hub.subscribe(self.user_id)
+        checkout = self.gateway.create_checkout_session(line_items=[{'price': 'price_test'}],
+                                                        client_reference_id=str(self.user_id),
+                                                        metadata={'plan': 'premium_monthly'})
+        self.gateway.complete_checkout_session(checkout.id)
+        response = await self.client.get(f'/subscription/subscription-success?session_id={checkout.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(channel.take(), [SUBSCRIPTION_CHANGED])
+        push_hub.unsubscribe(channel)
+
+    async def test_push_stream_ends_when_its_token_is_revoked(self):
+        push_hub.heartbeat_interval = 0.01
+        async with self.client.request('/push/stream', headers=self.headers) as connection:
+            await connection.send_complete()
+            received = ''
+            while 'event: devices' not in received:
+                received += (await connection.receive()).decode()
+
+            response = await self.client.post('/auth/logout', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            response = await connection.as_response()
+            self.assertEqual(response.status_code, 200)
+
+if __name__ == '__main__':
+    unittest.main()
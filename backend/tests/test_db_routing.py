@@ -0,0 +1,148 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+from sqlalchemy import select, update
+from app import create_app, db
+from models import User, Subscription, Device
+from services.device_service import device_activity
+from services.metrics_service import metrics_buffer
+from services.webhook_service import stripe_event_worker
+from utils.db_routing import ReplicaRouter, replica_router
+from flask_jwt_extended import create_access_token
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    def setUp(self):
+        # Two SQLite files stand in for a primary and its replica.
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = create_app('testing', config_overrides={
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(self.tmpdir, 'primary.db')}",
+            'SQLALCHEMY_BINDS': {'replica0': f"sqlite:///{os.path.join(self.tmpdir, 'replica.db')}"},
+            'SQLALCHEMY_REPLICA_BINDS': ('replica0',),
+        })
+        stripe_event_worker.enabled = False
+        metrics_buffer.interval = 0
+        device_activity.interval = 0
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.metadata.create_all(db.engines['replica0'])
+
+        self.user = User(username='testuser', email='test@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        db.session.add(Subscription(user_id=self.user.id, plan='premium_monthly', status='active', device_limit=5))
+        db.session.add(Device(user_id=self.user.id, device_id='device-1', name='device-1'))
+        db.session.commit()
+        self.replicate()
+        self.headers = {'Authorization': f'Bearer {create_access_token(identity=str(self.user.id))}'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.tmpdir)
+        # db.create_all() in other tests would look for the replica bind.
+        db.metadatas.pop('replica0', None)
+
+    def replicate(self):
+        with db.engines[None].connect() as primary, db.engines['replica0'].begin() as replica:
+            for table in reversed(db.metadata.sorted_tables):
+                replica.execute(table.delete())
+            for table in db.metadata.sorted_tables:
+                rows = [row._asdict() for row in primary.execute(table.select())]
+                if rows:
+                    replica.execute(table.insert(), rows)
+
+    def listed_devices(self):
+        response = self.client.get('/user/export?format=csv&dataset=devices', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        return [line.split(',')[3] for line in response.get_data(as_text=True).splitlines()[1:]]
+
+    def test_reads_go_to_the_replica_until_the_user_writes(self):
+        # A device the replica has not caught up with yet.
+        db.session.add(Device(user_id=self.user.id, device_id='device-2', name='device-2'))
+        db.session.commit()
+        self.assertEqual(self.listed_devices(), ['device-1'])
+
+        response = self.client.post('/devices/register', json={'device_id': 'device-3', 'device_name': 'device-3'}, headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(replica_router.is_sticky(self.user.id))
+        self.assertEqual(self.listed_devices(), ['device-1', 'device-2', 'device-3'])
+
+        replica_router.sticky_seconds = 0
+        self.client.post('/devices/register', json={'device_id': 'device-4', 'device_name': 'device-4'}, headers=self.headers)
+        self.assertEqual(self.listed_devices(), ['device-1'])
+
+    def test_export_flushes_buffered_events_against_the_primary(self):
+        # A user the replica has not caught up with yet.
+        user = User(username='newuser', email='new@example.com')
+        db.session.add(user)
+        db.session.commit()
+        headers = {'Authorization': f'Bearer {create_access_token(identity=str(user.id))}'}
+        # Sent from another worker, so this one has not seen the write.
+        replica_router.sticky_seconds = 0
+        self.client.post('/user/metrics/events', json={'events': [{'id': 'evt-1', 'duration': 30}]}, headers=headers)
+
+        response = self.client.get('/user/export?format=csv&dataset=users', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True).splitlines()[1].split(',')[4:], ['30', '1'])
+
+    def test_conditional_get_views_read_the_primary(self):
+        # Their ETag comes from the primary, so the body must too.
+        db.session.add(Device(user_id=self.user.id, device_id='device-2', name='device-2'))
+        db.session.commit()
+        response = self.client.get('/devices/list', headers=self.headers)
+        self.assertEqual([device['name'] for device in response.get_json()['devices']], ['device-1', 'device-2'])
+
+    def test_writes_and_locking_reads_use_the_primary(self):
+        primary, replica = db.engines[None], db.engines['replica0']
+        with self.app.test_request_context('/devices/list'):
+            replica_router.use_replica()
+            self.assertIs(db.session.get_bind(clause=select(Device.id)), replica)
+            with replica_router.primary():
+                self.assertIs(db.session.get_bind(clause=select(Device.id)), primary)
+            self.assertIs(db.session.get_bind(clause=select(Device.id).with_for_update()), primary)
+            # The request wrote, so it keeps reading from the primary.
+            self.assertIs(db.session.get_bind(clause=select(Device.id)), primary)
+
+        with self.app.test_request_context('/devices/list'):
+            replica_router.use_replica()
+            db.session.execute(update(Device).where(Device.device_id == 'device-1').values(name='Laptop'))
+            self.assertEqual(db.session.scalar(select(Device.name).where(Device.device_id == 'device-1')), 'Laptop')
+            db.session.rollback()
+
+    def test_recent_writes_are_shared_by_the_nodes_workers(self):
+        app = create_app('testing', config_overrides={
+            'SQLALCHEMY_BINDS': self.app.config['SQLALCHEMY_BINDS'],
+            'SQLALCHEMY_REPLICA_BINDS': ('replica0',),
+            'REPLICA_STICKY_STORAGE': 'sqlite',
+            'REPLICA_STICKY_SQLITE_PATH': os.path.join(self.tmpdir, 'replica-writes.sqlite3'),
+        })
+        # Two routers stand in for two worker processes on the node.
+        writer, reader = ReplicaRouter(), ReplicaRouter()
+        writer.init_app(app)
+        reader.init_app(app)
+        writer.mark_written(self.user.id)
+        self.assertTrue(reader.is_sticky(self.user.id))
+        self.assertFalse(reader.is_sticky(self.user.id + 1))
+
+        reader.sticky_seconds = 0
+        reader.mark_written(self.user.id)
+        self.assertTrue(writer.is_sticky(self.user.id))
+
+        # Without the record, reads go to the primary.
+        with mock.patch.object(reader.storage, 'until', side_effect=sqlite3.OperationalError('database is locked')):
+            self.assertTrue(reader.is_sticky(self.user.id + 1))
+        replica_router.init_app(self.app)
+
+    def test_unknown_replica_bind_is_rejected(self):
+        with self.assertRaises(ValueError):
+            create_app('testing', config_overrides={'SQLALCHEMY_REPLICA_BINDS': ('replica9',)})
+        replica_router.init_app(self.app)
+
+if __name__ == '__main__':
+    unittest.main()
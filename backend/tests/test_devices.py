@@ -0,0 +1,106 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from models import User, Device, Subscription
+from services.device_service import device_activity, sweep_stale_devices
+from flask_jwt_extended import create_access_token
+
+class DeviceActivityTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        device_activity.interval = 0
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.user = User(username='testuser', email='test@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {create_access_token(identity=str(self.user.id))}'}
+
+    def tearDown(self):
+        device_activity.flush_now()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def create_device(self, device_id, last_active):
+        device = Device(user_id=self.user.id, device_id=device_id, name=device_id, last_active=last_active)
+        db.session.add(device)
+        db.session.commit()
+        return device
+
+    def test_heartbeats_are_coalesced_and_visible_before_flush(self):
+        device = self.create_device('device-1', datetime(2026, 1, 1))
+
+        for _ in range(3):
+            response = self.client.post(f'/devices/update-activity/{device.id}', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+
+        db.session.refresh(device)
+        self.assertEqual(device.last_active, datetime(2026, 1, 1))
+        listed = self.client.get('/devices/list', headers=self.headers).get_json()['devices'][0]
+        self.assertGreater(listed['last_active'], '2026-01-01T00:00:00')
+
+        self.assertEqual(device_activity.flush_now(), 1)
+        db.session.refresh(device)
+        self.assertEqual(device.last_active.isoformat(), listed['last_active'])
+
+    def test_heartbeat_for_another_users_device_is_rejected(self):
+        other = User(username='otheruser', email='other@example.com')
+        db.session.add(other)
+        db.session.commit()
+        device = Device(user_id=other.id, device_id='device-2', name='Other')
+        db.session.add(device)
+        db.session.commit()
+
+        response = self.client.post(f'/devices/update-activity/{device.id}', headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_sweep_prunes_stale_devices(self):
+        self.create_device('stale', datetime.utcnow() - timedelta(days=120))
+        fresh = self.create_device('fresh', datetime.utcnow() - timedelta(days=120))
+        device_activity.touch(fresh.id)
+
+        self.assertEqual(sweep_stale_devices(90, dry_run=True), 1)
+        self.assertEqual(sweep_stale_devices(90, batch_size=1), 1)
+        self.assertEqual([d.device_id for d in Device.query.all()], ['fresh'])
+
+    def register(self, device_id):
+        return self.client.post('/devices/register', json={'device_id': device_id, 'device_name': 'Laptop'},
+                                headers=self.headers)
+
+    def test_registration_requires_active_subscription(self):
+        self.assertEqual(self.register('device-1').status_code, 403)
+        self.assertEqual(Device.query.count(), 0)
+
+    def test_registration_never_exceeds_device_limit(self):
+        db.session.add(Subscription(user_id=self.user.id, plan='basic_monthly', status='active', device_limit=2))
+        db.session.commit()
+
+        self.assertEqual(self.register('device-1').status_code, 201)
+        self.assertEqual(self.register('device-2').status_code, 201)
+        response = self.register('device-3')
+        self.assertEqual(response.status_code, 403)
+        self.assertIn('Device limit reached', response.get_json()['message'])
+
+        # Re-registering a known device at the limit still succeeds.
+        response = self.register('device-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Device.query.filter_by(user_id=self.user.id).count(), 2)
+
+    def test_registration_of_another_users_device_conflicts(self):
+        other = User(username='otheruser', email='other@example.com')
+        db.session.add(other)
+        db.session.commit()
+        db.session.add(Device(user_id=other.id, device_id='device-1', name='Other'))
+        db.session.add(Subscription(user_id=self.user.id, plan='basic_monthly', status='active', device_limit=2))
+        db.session.commit()
+
+        self.assertEqual(self.register('device-1').status_code, 409)
+        self.assertEqual(Device.query.filter_by(device_id='device-1').one().user_id, other.id)
+
+if __name__ == '__main__':
+    unittest.main()
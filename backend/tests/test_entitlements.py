@@ -0,0 +1,85 @@
+import unittest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+from sqlalchemy import event
+from app import create_app, db
+from models import User, Subscription, Device
+from services.entitlement_service import entitlement_cache
+from flask_jwt_extended import create_access_token
+
+class EntitlementCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.user = User(username='testuser', email='test@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        db.session.add(Subscription(user_id=self.user.id, plan='premium_monthly', status='active', device_limit=5,
+                                    stripe_subscription_id='sub_test123'))
+        db.session.add(Device(user_id=self.user.id, device_id='device-1', name='Laptop'))
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {create_access_token(identity=str(self.user.id))}'}
+
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.record_statement)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.record_statement)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def record_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def test_hot_reads_hit_the_cache(self):
+        self.assertEqual(self.client.get('/subscription/subscription', headers=self.headers).status_code, 200)
+        self.assertEqual(len(self.statements), 1)
+
+        self.statements.clear()
+        response = self.client.get('/subscription/subscription', headers=self.headers)
+        self.assertEqual(response.get_json()['plan'], 'premium_monthly')
+        self.client.get('/auth/user', headers=self.headers)
+        self.client.get('/user/metrics', headers=self.headers)
+        self.assertEqual(self.statements, [])
+
+    @patch('routes.subscription.cancel_subscription')
+    def test_cancel_invalidates_snapshot(self, mock_cancel):
+        mock_cancel.return_value = MagicMock(status='canceled', current_period_end=1609459200)
+        self.client.get('/subscription/subscription', headers=self.headers)
+
+        response = self.client.post('/subscription/cancel', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/subscription/subscription', headers=self.headers)
+        self.assertEqual(response.get_json()['status'], 'canceled')
+
+    def test_device_removal_invalidates_snapshot(self):
+        device = Device.query.filter_by(device_id='device-1').first()
+        self.assertEqual(entitlement_cache.get(self.user.id)['device_ids'], {device.id})
+
+        self.client.delete(f'/devices/remove/{device.id}', headers=self.headers)
+        self.assertEqual(entitlement_cache.get(self.user.id)['device_ids'], set())
+
+    def test_session_bootstrap_is_one_query_and_warms_the_cache(self):
+        response = self.client.get('/session/bootstrap', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(data['user']['username'], 'testuser')
+        self.assertEqual(data['subscription']['plan'], 'premium_monthly')
+        self.assertEqual([d['name'] for d in data['devices']], ['Laptop'])
+        self.assertEqual(data['device_limit'], 5)
+        self.assertEqual(data['metrics'], {'total_muted_time': 0, 'total_ads_muted': 0})
+        self.assertEqual(len(self.statements), 1)
+
+        self.statements.clear()
+        self.client.get('/subscription/subscription', headers=self.headers)
+        self.assertEqual(self.statements, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+from sqlalchemy import event
+from app import create_app, db
+from models import User, Subscription, Device
+from services.metrics_service import metrics_buffer
+from services.device_service import device_activity
+from services.webhook_service import record_event, process_pending_events, stripe_event_worker
+from flask_jwt_extended import create_access_token
+
+class ConditionalGetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        stripe_event_worker.enabled = False
+        metrics_buffer.interval = 0
+        device_activity.interval = 0
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.user = User(username='testuser', email='test@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        db.session.add(Subscription(user_id=self.user.id, plan='premium_monthly', status='active', device_limit=5,
+                                    stripe_subscription_id='sub_test123'))
+        self.device = Device(user_id=self.user.id, device_id='device-1', name='Laptop')
+        db.session.add(self.device)
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {create_access_token(identity=str(self.user.id))}'}
+
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.record_statement)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.record_statement)
+        metrics_buffer.flush_now()
+        device_activity.flush_now()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def record_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def get(self, path, etag=None):
+        headers = dict(self.headers)
+        if etag:
+            headers['If-None-Match'] = etag
+        return self.client.get(path, headers=headers)
+
+    def test_unchanged_resources_are_answered_with_304_without_queries(self):
+        for path in ('/subscription/subscription', '/devices/list', '/user/metrics', '/auth/user'):
+            response = self.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('no-cache', response.headers['Cache-Control'])
+            etag = response.headers['ETag']
+            self.assertFalse(etag.startswith('W/'))
+
+            self.statements.clear()
+            response = self.get(path, etag)
+            self.assertEqual(response.status_code, 304, path)
+            self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(self.statements, [])
+
+    def test_etags_are_per_endpoint(self):
+        self.assertNotEqual(self.get('/auth/user').headers['ETag'], self.get('/user/metrics').headers['ETag'])
+
+    def test_device_removal_changes_the_etag(self):
+        etag = self.get('/devices/list').headers['ETag']
+        self.assertEqual(self.client.delete(f'/devices/remove/{self.device.id}', headers=self.headers).status_code, 200)
+
+        response = self.get('/devices/list', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['devices'], [])
+
+    def test_buffered_heartbeats_and_metric_events_change_the_etag(self):
+        devices_etag = self.get('/devices/list').headers['ETag']
+        metrics_etag = self.get('/user/metrics').headers['ETag']
+
+        self.client.post(f'/devices/update-activity/{self.device.id}', headers=self.headers)
+        self.client.post('/user/metrics/events', json={'events': [{'id': 'evt-1', 'duration': 30}]},
+                         headers=self.headers)
+        response = self.get('/devices/list', devices_etag)
+        self.assertEqual(response.status_code, 200)
+        last_active = response.get_json()['devices'][0]['last_active']
+
+        # After the flush the tag must not fall back to the pre-heartbeat one.
+        device_activity.flush_now()
+        response = self.get('/devices/list', devices_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['devices'][0]['last_active'], last_active)
+        response = self.get('/user/metrics', metrics_etag)
+        self.assertEqual(response.status_code, 200)
+        pending_etag = response.headers['ETag']
+
+        # Flushing moves the totals into the row and bumps data_version.
+        metrics_buffer.flush_now()
+        self.assertEqual(db.session.get(User, self.user.id).data_version, 3)
+        response = self.get('/user/metrics', pending_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['total_muted_time'], 30)
+
+    def test_buffer_flushes_leave_the_subscription_etag_alone(self):
+        etag = self.get('/subscription/subscription').headers['ETag']
+
+        self.client.post(f'/devices/update-activity/{self.device.id}', headers=self.headers)
+        self.client.post('/user/metrics/events', json={'events': [{'id': 'evt-1', 'duration': 30}]},
+                         headers=self.headers)
+        device_activity.flush_now()
+        metrics_buffer.flush_now()
+
+        self.assertEqual(self.get('/subscription/subscription', etag).status_code, 304)
+
+    def test_webhook_handlers_bump_the_version(self):
+        etag = self.get('/subscription/subscription').headers['ETag']
+        record_event({'id': 'evt_1', 'type': 'customer.subscription.deleted', 'created': 1700000000,
+                      'data': {'object': {'id': 'sub_test123'}}})
+        process_pending_events()
+
+        response = self.get('/subscription/subscription', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['status'], 'cancelled')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from app import create_app, db
+from models import User, Subscription
+from services.analytics_service import global_counters, recount
+from services.entitlement_service import get_entitlement
+from services.expiry_service import expire_lapsed_subscriptions
+from services.webhook_service import stripe_event_worker
+
+class SubscriptionExpiryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        stripe_event_worker.enabled = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        now = datetime.now()
+        cases = [
+            ('active', now - timedelta(days=3)),
+            ('past_due', now - timedelta(days=3)),
+            ('active', now - timedelta(hours=2)),    # within the grace period
+            ('active', now + timedelta(days=10)),
+            ('cancelled', now - timedelta(days=3)),
+            ('active', now - timedelta(days=5)),
+        ]
+        self.subscriptions = []
+        for i, (status, period_end) in enumerate(cases):
+            user = User(username=f'user{i}', email=f'user{i}@example.com')
+            db.session.add(user)
+            db.session.flush()
+            subscription = Subscription(user_id=user.id, plan='basic_monthly', status=status,
+                                        current_period_end=period_end)
+            db.session.add(subscription)
+            self.subscriptions.append(subscription)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_lapsed_subscriptions_expire_in_batches(self):
+        user_id = self.subscriptions[0].user_id
+        self.assertEqual(get_entitlement(user_id)['subscription']['status'], 'active')
+
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.assertEqual(expire_lapsed_subscriptions(grace_hours=24, batch_size=1),
+                             {'active': 2, 'trialing': 0, 'past_due': 1})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(sum('UPDATE subscription' in statement for statement in statements), 3)
+
+        db.session.expire_all()
+        self.assertEqual([s.status for s in self.subscriptions],
+                         ['expired', 'expired', 'active', 'active', 'cancelled', 'expired'])
+        # The cached snapshot was invalidated.
+        self.assertEqual(get_entitlement(user_id)['subscription']['status'], 'expired')
+
+        nonzero = lambda totals: {name: value for name, value in totals.items() if value}
+        self.assertEqual(nonzero(global_counters.totals()), nonzero(recount()))
+        self.assertEqual(sum(expire_lapsed_subscriptions().values()), 0)
+
+    def test_sweep_uses_the_status_period_end_index(self):
+        plan = db.session.execute(db.text(
+            "EXPLAIN QUERY PLAN SELECT id FROM subscription "
+            "WHERE status = 'active' AND current_period_end < '2024-01-01' ORDER BY current_period_end"
+        )).all()
+        self.assertIn('ix_subscription_status_period_end', ' '.join(str(row[-1]) for row in plan))
+
+if __name__ == '__main__':
+    unittest.main()
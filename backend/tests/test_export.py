@@ -0,0 +1,107 @@
+import csv
+import io
+import json
+import unittest
+from datetime import datetime
+from app import create_app, db
+from models import User, Subscription, Device, MetricRollup
+from services.export_service import export_rows
+from services.metrics_service import metrics_buffer
+from services.partition_service import ensure_partitions
+from services.device_service import device_activity
+from services.webhook_service import stripe_event_worker
+from flask_jwt_extended import create_access_token
+
+class ExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing', config_overrides={'ADMIN_API_TOKEN': 'admin-token'})
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        stripe_event_worker.enabled = False
+        metrics_buffer.interval = 0
+        device_activity.interval = 0
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.user = User(username='testuser', email='test@example.com', total_muted_time=30, total_ads_muted=2)
+        self.user.set_password('password123')
+        other = User(username='other', email='other@example.com')
+        db.session.add_all([self.user, other])
+        db.session.commit()
+        db.session.add(Subscription(user_id=self.user.id, plan='premium_monthly', status='active', device_limit=5,
+                                    stripe_subscription_id='sub_test123'))
+        db.session.add(Device(user_id=self.user.id, device_id='device-1', name='Laptop'))
+        db.session.add(Device(user_id=other.id, device_id='device-2', name='Desktop'))
+        db.session.add(MetricRollup(user_id=self.user.id, service='YouTube', granularity='day',
+                                    bucket_start=datetime(2024, 1, 1), muted_time=30, ads_muted=2))
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {create_access_token(identity=str(self.user.id))}'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_user_export_streams_all_of_their_data_as_ndjson(self):
+        response = self.client.get('/user/export', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([line['dataset'] for line in lines], ['users', 'subscriptions', 'devices', 'metrics'])
+        self.assertEqual(lines[0]['email'], 'test@example.com')
+        self.assertNotIn('password_hash', lines[0])
+        self.assertEqual(lines[2]['device_id'], 'device-1')
+        self.assertEqual(lines[3]['bucket_start'], '2024-01-01T00:00:00')
+
+    def test_csv_export_holds_one_dataset(self):
+        response = self.client.get('/user/export?format=csv&dataset=devices', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(rows[0], ['id', 'user_id', 'device_id', 'name', 'last_active', 'created_at'])
+        self.assertEqual([row[2] for row in rows[1:]], ['device-1'])
+
+        response = self.client.get('/user/export?format=csv', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_admin_export_covers_the_whole_table(self):
+        response = self.client.get('/admin/export/devices', headers={'Authorization': 'Bearer admin-token'})
+        self.assertEqual(response.status_code, 200)
+        device_ids = [json.loads(line)['device_id'] for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(device_ids, ['device-1', 'device-2'])
+
+        self.assertEqual(self.client.get('/admin/export/passwords',
+                                         headers={'Authorization': 'Bearer admin-token'}).status_code, 400)
+
+    def test_rows_are_read_in_batches(self):
+        db.session.add_all([Device(user_id=self.user.id, device_id=f'bulk-{i}') for i in range(25)])
+        db.session.commit()
+        rows = list(export_rows('devices', batch_size=4))
+        self.assertEqual(len(rows), 27)
+        self.assertEqual([row['id'] for row in rows], sorted(row['id'] for row in rows))
+
+    def test_raw_ad_events_are_exported_from_every_attached_partition(self):
+        ensure_partitions(ahead=1, now=datetime(2026, 1, 1))
+        other = User.query.filter_by(username='other').one()
+        metrics_buffer.add_events(self.user.id, [
+            {'id': 'feb', 'duration': 5, 'service': 'YouTube', 'occurred_at': datetime(2026, 2, 3)},
+            {'id': 'jan', 'duration': 7, 'service': 'Hulu', 'occurred_at': datetime(2026, 1, 9)},
+        ])
+        metrics_buffer.add_events(other.id, [
+            {'id': 'other', 'duration': 9, 'service': 'YouTube', 'occurred_at': datetime(2026, 1, 2)},
+        ])
+        metrics_buffer.flush_now()
+
+        response = self.client.get('/user/export?format=csv&dataset=ad_events', headers=self.headers)
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(rows[0], ['user_id', 'event_id', 'service', 'duration', 'occurred_at', 'received_at'])
+        self.assertEqual([row[1:5] for row in rows[1:]],
+                         [['jan', 'Hulu', '7', '2026-01-09T00:00:00'], ['feb', 'YouTube', '5', '2026-02-03T00:00:00']])
+
+        rows = list(export_rows('ad_events', batch_size=1))
+        self.assertEqual([row['event_id'] for row in rows], ['jan', 'other', 'feb'])
+
+if __name__ == '__main__':
+    unittest.main()
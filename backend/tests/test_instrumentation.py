@@ -0,0 +1,81 @@
+import unittest
+from app import create_app, db
+from models import User
+from utils.instrumentation import instrumentation, fingerprint, parameter_shape
+from flask_jwt_extended import create_access_token
+
+class InstrumentationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        self.app.config['METRICS_SCRAPE_TOKEN'] = 'scrape-secret'
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.user = User(username='testuser', email='test@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {create_access_token(identity=str(self.user.id))}'}
+        instrumentation.reset()
+
+    def tearDown(self):
+        instrumentation.slow_query_ms = 200
+        instrumentation.repeated_query_threshold = 10
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def scrape(self):
+        response = self.client.get('/internal/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True)
+
+    def test_requests_and_statements_are_attributed_to_endpoints(self):
+        self.client.get('/devices/list', headers=self.headers)
+        self.client.get('/devices/list', headers=self.headers)
+
+        body = self.scrape()
+        self.assertIn('http_requests_total{endpoint="device.get_devices",method="GET",status="200"} 2', body)
+        self.assertIn('http_request_duration_seconds_count{endpoint="device.get_devices"} 2', body)
+        # The first request loads the entitlement snapshot, the second is served from cache.
+        self.assertIn('db_statements_per_request_sum{endpoint="device.get_devices"} 1.0', body)
+        self.assertIn('db_statements_total{endpoint="device.get_devices"} 1', body)
+
+    def test_slow_queries_are_logged_with_fingerprint_and_no_values(self):
+        instrumentation.slow_query_ms = 0
+        with self.assertLogs(self.app.logger, level='WARNING') as logs:
+            self.client.post('/auth/login', json={'username': 'testuser', 'password': 'secret-value'})
+
+        message = logs.output[0]
+        self.assertIn('Slow query', message)
+        self.assertIn('auth.login', message)
+        self.assertNotIn('testuser', message)
+        self.assertIn('db_slow_statements_total{endpoint="auth.login"} 1', self.scrape())
+
+    def test_repeated_statements_are_flagged(self):
+        instrumentation.repeated_query_threshold = 3
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            with self.assertLogs(self.app.logger, level='WARNING') as logs:
+                for _ in range(4):
+                    db.session.get(User, self.user.id)
+                    db.session.expire_all()
+        self.assertTrue(any('possible N+1' in line for line in logs.output))
+
+    def test_fingerprint_ignores_literals_and_list_length(self):
+        a = fingerprint("SELECT * FROM device WHERE id IN (?, ?, ?) AND name = 'x'")
+        b = fingerprint("SELECT * FROM device WHERE id IN (?) AND name = 'yy'")
+        self.assertEqual(a, b)
+        self.assertEqual(parameter_shape({'username': 'testuser', 'id': 1}, False), '{username: str, id: int}')
+
+    def test_scrape_token(self):
+        self.assertEqual(self.client.get('/internal/metrics').status_code, 401)
+        response = self.client.get('/internal/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+        self.assertEqual(response.status_code, 200)
+        self.app.config['METRICS_SCRAPE_TOKEN'] = None
+        self.assertEqual(self.client.get('/internal/metrics').status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+from flask.cli import ScriptInfo
+from app import create_app, db
+from models import User, Device, RuleBundle
+from manage import cli
+
+
+class ManageCommandsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def invoke(self, *args):
+        result = self.app.test_cli_runner().invoke(cli, args, obj=ScriptInfo(create_app=lambda: self.app))
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result.output
+
+    def test_prune_devices(self):
+        user = User(username='testuser', email='test@example.com')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add_all([
+            Device(user_id=user.id, device_id='stale', name='stale', last_active=datetime.utcnow() - timedelta(days=120)),
+            Device(user_id=user.id, device_id='fresh', name='fresh', last_active=datetime.utcnow())
+        ])
+        db.session.commit()
+
+        self.assertEqual(self.invoke('prune_devices', '--days', '90', '--dry-run'), 'Found 1 stale devices\n')
+        self.assertEqual(Device.query.count(), 2)
+        self.assertEqual(self.invoke('prune_devices', '-d', '90'), 'Pruned 1 stale devices\n')
+        self.assertEqual([device.device_id for device in Device.query], ['fresh'])
+
+    def test_rules_seed_and_publish(self):
+        self.assertIn('Seeded youtube', self.invoke('rules', 'seed'))
+        self.assertEqual(self.invoke('rules', 'seed'), 'Every service already has rules\n')
+        output = self.invoke('rules', 'publish')
+        self.assertEqual(output.split()[1], RuleBundle.query.one().version)
+
+    def test_expiry_loop_keeps_the_grace_period(self):
+        with mock.patch('services.expiry_service.expire_lapsed_subscriptions') as expire, \
+                mock.patch('services.expiry_service.time.sleep', side_effect=[None, StopIteration]):
+            result = self.app.test_cli_runner().invoke(cli, ['expire_subscriptions', '--loop', '-g', '48', '-i', '5'],
+                                                       obj=ScriptInfo(create_app=lambda: self.app))
+        self.assertIsInstance(result.exception, StopIteration)
+        self.assertEqual([call.args for call in expire.call_args_list], [(48,), (48,)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import unittest
+from datetime import datetime
+from app import create_app, db
+from sqlalchemy import func, select
+from models import User, MetricRollup
+from services.metrics_service import metrics_buffer, summarize_by_service
+from services.partition_service import ledger_months, ledger_table
+from flask_jwt_extended import create_access_token
+
+class MetricsTestBase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        metrics_buffer.interval = 0
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        metrics_buffer.flush_now()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def create_user(self, username='testuser'):
+        user = User(username=username, email=f'{username}@example.com', total_muted_time=10, total_ads_muted=1)
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def post_events(self, user, events):
+        access_token = create_access_token(identity=str(user.id))
+        return self.client.post(
+            '/user/metrics/events',
+            json={'events': events},
+            headers={'Authorization': f'Bearer {access_token}'}
+        )
+
+class MetricsIngestionTestCase(MetricsTestBase):
+    def test_events_are_buffered_then_applied_as_increments(self):
+        user = self.create_user()
+
+        response = self.post_events(user, [{'id': 'a', 'duration': 15}, {'id': 'b', 'duration': 30}])
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()['accepted'], 2)
+
+        # Nothing is written until the buffer flushes, but reads include pending deltas.
+        db.session.refresh(user)
+        self.assertEqual(user.total_muted_time, 10)
+        access_token = create_access_token(identity=str(user.id))
+        response = self.client.get('/user/metrics', headers={'Authorization': f'Bearer {access_token}'})
+        self.assertEqual(response.get_json(), {'total_muted_time': 55, 'total_ads_muted': 3})
+
+        self.assertEqual(metrics_buffer.flush_now(), 2)
+        db.session.refresh(user)
+        self.assertEqual(user.total_muted_time, 55)
+        self.assertEqual(user.total_ads_muted, 3)
+
+    def test_duplicate_event_ids_are_applied_once(self):
+        user = self.create_user()
+
+        self.post_events(user, [{'id': 'a', 'duration': 15}])
+        response = self.post_events(user, [{'id': 'a', 'duration': 15}])
+        self.assertEqual(response.get_json()['duplicates'], 1)
+        metrics_buffer.flush_now()
+
+        # A retry after the flush is filtered by the event ledger.
+        self.post_events(user, [{'id': 'a', 'duration': 15}, {'id': 'c', 'duration': 5}])
+        metrics_buffer.flush_now()
+
+        db.session.refresh(user)
+        self.assertEqual(user.total_muted_time, 30)
+        self.assertEqual(user.total_ads_muted, 3)
+        [ledger] = ledger_months()
+        table = ledger_table(ledger)
+        self.assertEqual(db.session.scalar(select(func.count()).where(table.c.user_id == user.id)), 2)
+
+    def test_deltas_from_several_devices_accumulate(self):
+        user = self.create_user()
+        other = self.create_user('otheruser')
+
+        self.post_events(user, [{'id': 'laptop-1', 'duration': 20}])
+        self.post_events(user, [{'id': 'desktop-1', 'duration': 40}])
+        self.post_events(other, [{'id': 'laptop-1', 'duration': 7}])
+        metrics_buffer.flush_now()
+
+        db.session.refresh(user)
+        db.session.refresh(other)
+        self.assertEqual(user.total_muted_time, 70)
+        self.assertEqual(other.total_muted_time, 17)
+
+    def test_invalid_batch_is_rejected(self):
+        user = self.create_user()
+        response = self.post_events(user, [{'id': 'a', 'duration': -1}])
+        self.assertEqual(response.status_code, 400)
+
+class MetricsRollupTestCase(MetricsTestBase):
+    def ms(self, *args):
+        return int((datetime(*args) - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+    def test_events_roll_up_into_hour_day_and_month_buckets(self):
+        user = self.create_user()
+        self.post_events(user, [
+            {'id': 'a', 'duration': 15, 'service': 'YouTube', 'timestamp': self.ms(2026, 3, 2, 10, 5)},
+            {'id': 'b', 'duration': 30, 'service': 'YouTube', 'timestamp': self.ms(2026, 3, 2, 10, 50)},
+            {'id': 'c', 'duration': 20, 'service': 'Hulu', 'timestamp': self.ms(2026, 3, 3, 9, 0)},
+        ])
+        metrics_buffer.flush_now()
+        self.post_events(user, [{'id': 'd', 'duration': 5, 'service': 'YouTube', 'timestamp': self.ms(2026, 3, 2, 23, 0)}])
+        metrics_buffer.flush_now()
+
+        day = MetricRollup.query.filter_by(user_id=user.id, granularity='day', service='YouTube',
+                                           bucket_start=datetime(2026, 3, 2)).one()
+        self.assertEqual((day.muted_time, day.ads_muted), (50, 3))
+        month = MetricRollup.query.filter_by(user_id=user.id, granularity='month', service='YouTube').one()
+        self.assertEqual(month.muted_time, 50)
+        self.assertEqual(MetricRollup.query.filter_by(user_id=user.id, granularity='hour').count(), 3)
+
+    def test_summary_combines_month_day_and_hour_rollups(self):
+        user = self.create_user()
+        self.post_events(user, [
+            {'id': 'a', 'duration': 10, 'service': 'YouTube', 'timestamp': self.ms(2026, 1, 31, 12)},
+            {'id': 'b', 'duration': 20, 'service': 'YouTube', 'timestamp': self.ms(2026, 2, 14, 8)},
+            {'id': 'c', 'duration': 40, 'service': 'Twitch', 'timestamp': self.ms(2026, 3, 1, 6)},
+            {'id': 'd', 'duration': 80, 'service': 'Twitch', 'timestamp': self.ms(2026, 3, 1, 7)},
+        ])
+        metrics_buffer.flush_now()
+
+        summary = summarize_by_service(user.id, datetime(2026, 1, 31, 12), datetime(2026, 3, 1, 7))
+        self.assertEqual(summary, {
+            'Twitch': {'muted_time': 40, 'ads_muted': 1},
+            'YouTube': {'muted_time': 30, 'ads_muted': 2},
+        })
+
+    def test_usage_endpoint_returns_buckets(self):
+        user = self.create_user()
+        self.post_events(user, [{'id': 'a', 'duration': 15, 'service': 'YouTube', 'timestamp': self.ms(2026, 3, 2, 10)}])
+        metrics_buffer.flush_now()
+
+        access_token = create_access_token(identity=str(user.id))
+        response = self.client.get(
+            '/metrics/usage?granularity=day&start=2026-03-01&end=2026-03-08',
+            headers={'Authorization': f'Bearer {access_token}'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['buckets'], [
+            {'bucket_start': '2026-03-02T00:00:00', 'service': 'YouTube', 'muted_time': 15, 'ads_muted': 1}
+        ])
+
+if __name__ == '__main__':
+    unittest.main()
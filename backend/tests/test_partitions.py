@@ -0,0 +1,151 @@
+import unittest
+from datetime import datetime
+from unittest import mock
+from sqlalchemy import insert, inspect, select
+from app import create_app, db
+from models import User, MetricRollup, EventPartition
+from services.metrics_service import metrics_buffer
+from services.partition_service import (
+    ensure_partitions, detach_partition, attach_partition, attached_partitions, enforce_event_retention,
+    delete_user_events, roll_up_partition, event_table, ensure_ledger_month, enforce_ledger_retention, ledger_months,
+    ledger_name, ledger_table, run_partition_maintenance
+)
+
+def ad(event_id, occurred_at, duration=10, service='YouTube'):
+    return {'id': event_id, 'duration': duration, 'service': service, 'occurred_at': occurred_at}
+
+class EventPartitionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        metrics_buffer.interval = 0
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.user = User(username='testuser', email='test@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.user_id = self.user.id
+
+    def tearDown(self):
+        metrics_buffer.flush_now()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def ingest(self, events):
+        metrics_buffer.add_events(self.user_id, events)
+        metrics_buffer.flush_now()
+
+    def event_ids(self, start, end):
+        event_ids = []
+        for name in attached_partitions(start, end):
+            table = event_table(name)
+            event_ids += db.session.scalars(select(table.c.event_id).where(
+                table.c.user_id == self.user_id, table.c.occurred_at >= start, table.c.occurred_at < end))
+        return sorted(event_ids)
+
+    def test_events_are_stored_in_their_month(self):
+        names = [p.name for p in ensure_partitions(ahead=1, now=datetime(2026, 1, 20))]
+        self.assertEqual(names, ['ad_event_p202601', 'ad_event_p202602'])
+        self.assertTrue(set(names) <= set(inspect(db.engine).get_table_names()))
+
+        self.ingest([ad('jan', datetime(2026, 1, 31, 23)), ad('feb', datetime(2026, 2, 1, 1)),
+                     ad('dec', datetime(2025, 12, 31))])
+        # December has no partition: counted in the rollups, not kept raw.
+        self.assertEqual(self.event_ids(datetime(2025, 12, 1), datetime(2026, 3, 1)), ['feb', 'jan'])
+        self.assertEqual(MetricRollup.query.filter_by(granularity='month').count(), 3)
+
+        # Range reads only touch the partitions that overlap the range.
+        self.assertEqual(attached_partitions(datetime(2026, 2, 1), datetime(2026, 2, 15)), ['ad_event_p202602'])
+        self.assertEqual(attached_partitions(datetime(2026, 1, 31), datetime(2026, 2, 1)), ['ad_event_p202601'])
+        self.assertEqual(attached_partitions(datetime(2026, 5, 1), datetime(2026, 6, 1)), [])
+
+    def test_detached_partitions_are_skipped_until_reattached(self):
+        ensure_partitions(ahead=0, now=datetime(2026, 1, 1))
+        self.ingest([ad('a', datetime(2026, 1, 2))])
+        detach_partition('ad_event_p202601')
+        self.ingest([ad('b', datetime(2026, 1, 3))])
+        self.assertEqual(self.event_ids(datetime(2026, 1, 1), datetime(2026, 2, 1)), [])
+        with self.assertRaises(ValueError):
+            detach_partition('ad_event_p202601')
+
+        attach_partition('ad_event_p202601')
+        self.assertEqual(self.event_ids(datetime(2026, 1, 1), datetime(2026, 2, 1)), ['a'])
+
+    def test_retention_rolls_up_then_drops_old_partitions(self):
+        ensure_partitions(ahead=1, now=datetime(2025, 1, 1))
+        self.ingest([ad('a', datetime(2025, 1, 5), 20), ad('b', datetime(2025, 1, 5), 30),
+                     ad('c', datetime(2025, 2, 9), 5)])
+        # A lost increment, which the roll-up restores from the raw rows.
+        MetricRollup.query.filter_by(granularity='month', bucket_start=datetime(2025, 1, 1)).delete()
+        db.session.commit()
+
+        dropped = enforce_event_retention(days=180, now=datetime(2025, 8, 15))
+        self.assertEqual(dropped, ['ad_event_p202501'])
+        self.assertNotIn('ad_event_p202501', inspect(db.engine).get_table_names())
+        self.assertIn('ad_event_p202502', inspect(db.engine).get_table_names())
+
+        partition = db.session.get(EventPartition, 'ad_event_p202501')
+        self.assertEqual((partition.state, partition.rows), ('dropped', 2))
+        month = MetricRollup.query.filter_by(granularity='month', bucket_start=datetime(2025, 1, 1)).one()
+        self.assertEqual((month.muted_time, month.ads_muted), (50, 2))
+        day = MetricRollup.query.filter_by(granularity='day', bucket_start=datetime(2025, 1, 5)).one()
+        self.assertEqual((day.muted_time, day.ads_muted), (50, 2))
+        self.assertEqual(enforce_event_retention(days=180, now=datetime(2025, 8, 15)), [])
+
+    def test_roll_up_streams_in_batches(self):
+        [partition] = ensure_partitions(ahead=0, now=datetime(2025, 3, 1))
+        self.ingest([ad(f'{service}-{day}', datetime(2025, 3, day, 12), 10, service)
+                     for service in ('Hulu', 'YouTube') for day in (1, 2, 3)])
+        MetricRollup.query.filter(MetricRollup.granularity != 'hour').delete()
+        db.session.commit()
+
+        with mock.patch('services.partition_service.ROLLUP_BATCH_SIZE', 2), \
+                mock.patch('services.partition_service.upsert_greatest') as upsert:
+            self.assertEqual(roll_up_partition(partition), 6)
+        self.assertTrue(all(len(call.args[2]) <= 3 for call in upsert.call_args_list))
+        rows = [row for call in upsert.call_args_list for row in call.args[2]]
+        self.assertEqual(sorted((row['service'], row['granularity'], row['ads_muted']) for row in rows),
+                         [('Hulu', 'day', 1)] * 3 + [('Hulu', 'month', 3)] + [('YouTube', 'day', 1)] * 3 +
+                         [('YouTube', 'month', 3)])
+
+        roll_up_partition(partition)
+        months = MetricRollup.query.filter_by(granularity='month').order_by(MetricRollup.service)
+        self.assertEqual([(row.service, row.muted_time) for row in months], [('Hulu', 30), ('YouTube', 30)])
+        self.assertEqual(MetricRollup.query.filter_by(granularity='day').count(), 6)
+
+    def test_purge_deletes_a_users_events_from_every_partition(self):
+        ensure_partitions(ahead=1, now=datetime(2026, 1, 1))
+        self.ingest([ad('a', datetime(2026, 1, 2)), ad('b', datetime(2026, 2, 2))])
+        # Both raw events and their ledger rows.
+        self.assertEqual(delete_user_events(self.user_id), 4)
+        self.assertEqual(self.event_ids(datetime(2026, 1, 1), datetime(2026, 3, 1)), [])
+        self.assertEqual(db.session.scalars(select(ledger_table(ledger_name(datetime.utcnow())).c.id)).all(), [])
+
+    def test_ledger_dedupes_across_months_and_expires_whole_months(self):
+        january = ensure_ledger_month(datetime(2026, 1, 15))
+        db.session.execute(insert(ledger_table(january)),
+                           [{'user_id': self.user_id, 'event_id': 'a', 'created_at': datetime(2026, 1, 15)}])
+        db.session.commit()
+
+        # 'a' was already applied in January.
+        self.ingest([ad('a', datetime.utcnow()), ad('b', datetime.utcnow())])
+        self.assertEqual(db.session.get(User, self.user_id).total_ads_muted, 1)
+        current = ledger_name(datetime.utcnow())
+        self.assertEqual(ledger_months(), [january, current])
+
+        # January's ids are kept until the month ended 90 days ago, then dropped with the table.
+        self.assertEqual(enforce_ledger_retention(days=90, now=datetime(2026, 5, 1)), [])
+        self.assertEqual(enforce_ledger_retention(days=90, now=datetime(2026, 5, 2)), [january])
+        self.assertEqual(ledger_months(), [current])
+        self.assertNotIn(january, inspect(db.engine).get_table_names())
+
+    def test_maintenance_prepares_ledger_months(self):
+        created, dropped = run_partition_maintenance(now=datetime(2026, 1, 20))
+        self.assertEqual(created, ['ad_event_p202601', 'ad_event_p202602', 'ad_event_p202603',
+                                   'metric_event_p202601', 'metric_event_p202602'])
+        self.assertEqual(dropped, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import threading
+import unittest
+from unittest import mock
+from app import create_app, db
+from models import User
+from services.password_service import password_hasher, hash_rounds, node_share_workers, PasswordHasherBusy
+
+class PasswordHashingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        password_hasher.shutdown()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_login_rehashes_when_work_factor_changes(self):
+        password_hasher.rounds = 4
+        user = User(username='testuser', email='testuser@example.com')
+        user.set_password('testpassword')
+        db.session.add(user)
+        db.session.commit()
+        self.assertEqual(hash_rounds(user.password_hash), 4)
+
+        password_hasher.rounds = 5
+        response = self.client.post('/auth/login', json={'username': 'testuser', 'password': 'testpassword'})
+        self.assertEqual(response.status_code, 200)
+
+        db.session.refresh(user)
+        self.assertEqual(hash_rounds(user.password_hash), 5)
+        self.assertTrue(user.check_password('testpassword'))
+
+    def test_pool_is_sized_per_node(self):
+        with mock.patch('os.cpu_count', return_value=8):
+            with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '4'}):
+                self.assertEqual(node_share_workers(), 2)
+            with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '16'}):
+                self.assertEqual(node_share_workers(), 1)
+
+    def test_pool_rejects_work_beyond_queue_bound(self):
+        password_hasher.workers = 1
+        password_hasher.queue_timeout = 0
+        password_hasher._slots = threading.BoundedSemaphore(1)
+        password_hasher._slots.acquire()
+        try:
+            with self.assertRaises(PasswordHasherBusy):
+                password_hasher.hash('testpassword')
+            response = self.client.post('/auth/register', json={
+                'username': 'testuser',
+                'email': 'testuser@example.com',
+                'password': 'testpassword'
+            })
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+        finally:
+            password_hasher._slots.release()
+
+        self.assertTrue(password_hasher.verify(password_hasher.hash('testpassword'), 'testpassword'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import time
+import unittest
+from datetime import datetime
+from app import create_app, db
+from models import (
+    User, Subscription, Device, MetricRollup, RefreshToken, StripeEvent, AccountDeletion
+)
+from services.analytics_service import global_counters, recount
+from sqlalchemy import func, insert, select
+from services.purge_service import process_pending_deletions, purge_expired_records
+from services.partition_service import ensure_ledger_month, ledger_table
+from services.metrics_service import metrics_buffer
+from services.device_service import device_activity
+from services.webhook_service import stripe_event_worker
+from services.token_service import revocation_filter
+from flask_jwt_extended import create_access_token
+
+class AccountPurgeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing', config_overrides={'STRIPE_GATEWAY': 'fake'})
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        stripe_event_worker.enabled = False
+        metrics_buffer.interval = 0
+        device_activity.interval = 0
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        revocation_filter.clear()
+
+        gateway = self.app.extensions['stripe_gateway']
+        checkout = gateway.create_checkout_session(line_items=[{'price': 'price_test'}], mode='subscription',
+                                                   client_reference_id='1', metadata={'plan': 'premium_monthly'})
+        stripe_subscription = gateway.retrieve_subscription(gateway.complete_checkout_session(checkout.id).subscription)
+
+        self.user = User(username='testuser', email='test@example.com', total_muted_time=30, total_ads_muted=3)
+        self.user.set_password('password123')
+        other = User(username='other', email='other@example.com')
+        db.session.add_all([self.user, other])
+        db.session.commit()
+        self.other_id = other.id
+        db.session.add(Subscription(user_id=self.user.id, plan='premium_monthly', status='active', device_limit=5,
+                                    stripe_subscription_id=stripe_subscription.id))
+        db.session.add_all([Device(user_id=self.user.id, device_id=f'device-{i}') for i in range(5)])
+        db.session.add(Device(user_id=other.id, device_id='other-device'))
+        db.session.add(MetricRollup(user_id=self.user.id, service='YouTube', granularity='day',
+                                    bucket_start=datetime(2024, 1, 1), muted_time=30, ads_muted=3))
+        db.session.commit()
+        self.ledger = ledger_table(ensure_ledger_month())
+        db.session.execute(insert(self.ledger), [{'user_id': self.user.id, 'event_id': f'evt-{i}',
+                                                  'created_at': datetime.utcnow()} for i in range(3)])
+        db.session.commit()
+        self.stripe_subscription_id = stripe_subscription.id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self):
+        return self.client.post('/auth/login', json={'username': 'testuser', 'password': 'password123'})
+
+    def test_deletion_is_queued_and_signs_the_user_out(self):
+        tokens = self.login().get_json()
+        headers = {'Authorization': f'Bearer {tokens["access_token"]}'}
+
+        response = self.client.delete('/auth/account', json={'password': 'wrong'}, headers=headers)
+        self.assertEqual(response.status_code, 401)
+        response = self.client.delete('/auth/account', json={'password': 'password123'}, headers=headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()['deletion']['status'], 'pending')
+
+        self.assertEqual(self.client.get('/auth/user', headers=headers).status_code, 401)
+        self.assertEqual(self.login().status_code, 401)
+        # Nothing is deleted until the purge worker runs.
+        self.assertEqual(Device.query.filter_by(user_id=self.user.id).count(), 5)
+
+    def test_purge_removes_rows_in_batches_and_cancels_billing(self):
+        user_id = self.user.id
+        self.login()
+        self.client.delete('/auth/account', json={'password': 'password123'},
+                           headers={'Authorization': f'Bearer {create_access_token(identity=str(user_id))}'})
+
+        self.assertEqual(process_pending_deletions(batch_size=2, pause=0), 1)
+
+        deletion = AccountDeletion.query.filter_by(user_id=user_id).one()
+        self.assertEqual(deletion.status, 'done')
+        # 1 refresh token, 3 metric events, 1 rollup, 5 devices, the subscription and the user.
+        self.assertEqual(deletion.rows_deleted, 12)
+        self.assertIsNone(db.session.get(User, user_id))
+        for model in (Device, Subscription, MetricRollup, RefreshToken):
+            self.assertEqual(model.query.filter_by(user_id=user_id).count(), 0)
+        self.assertEqual(db.session.scalar(select(func.count()).select_from(self.ledger)), 0)
+        self.assertEqual(Device.query.filter_by(user_id=self.other_id).count(), 1)
+
+        stripe_subscription = self.app.extensions['stripe_gateway'].retrieve_subscription(self.stripe_subscription_id)
+        self.assertEqual(stripe_subscription.status, 'canceled')
+
+        nonzero = lambda totals: {name: value for name, value in totals.items() if value}
+        self.assertEqual(nonzero(global_counters.totals()), nonzero(recount()))
+        self.assertEqual(process_pending_deletions(), 0)
+
+    def test_retention_purge_only_removes_expired_ledger_rows(self):
+        now = int(time.time())
+        db.session.add_all([
+            StripeEvent(id='evt_old', type='invoice.paid', created=now - 200 * 86400, payload='{}', status='done'),
+            StripeEvent(id='evt_failed', type='invoice.paid', created=now - 200 * 86400, payload='{}', status='failed'),
+            StripeEvent(id='evt_new', type='invoice.paid', created=now, payload='{}', status='done'),
+        ])
+        db.session.commit()
+
+        self.assertEqual(purge_expired_records(batch_size=1, pause=0), {'stripe_event': 1})
+        self.assertEqual(sorted(event.id for event in StripeEvent.query), ['evt_failed', 'evt_new'])
+
+if __name__ == '__main__':
+    unittest.main()
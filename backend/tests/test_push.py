@@ -0,0 +1,197 @@
+import json
+import os
+import tempfile
+import unittest
+from app import create_app, db
+from models import User, Subscription
+from services.device_service import device_activity
+from services.push_service import push_hub, PushHub, SUBSCRIPTION_CHANGED, DEVICES_CHANGED
+from services.webhook_service import stripe_event_worker, record_event, process_pending_events
+from services.reconcile_service import reconcile_subscriptions
+from flask_jwt_extended import create_access_token
+
+
+def parse_events(chunk):
+    events = []
+    for block in chunk.split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if line.startswith(('event', 'data')))
+        if 'event' in fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+    return events
+
+
+class PushStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing', config_overrides={
+            'PUSH_STREAM_WSGI': True,
+            'PUSH_HEARTBEAT_INTERVAL': 0.01,
+            'PUSH_MAX_STREAMS_PER_USER': 2
+        })
+        stripe_event_worker.enabled = False
+        device_activity.interval = 0
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        user = User(username='testuser', email='test@example.com')
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+        db.session.add(Subscription(user_id=user.id, plan='basic_monthly', status='active', device_limit=2,
+                                    stripe_subscription_id='sub_test123'))
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {create_access_token(identity=str(user.id))}'}
+
+    def tearDown(self):
+        device_activity.flush_now()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def open_stream(self):
+        response = self.client.get('/push/stream', headers=self.headers, buffered=False)
+        self.assertEqual(response.status_code, 200)
+        return response, iter(response.response)
+
+    def next_events(self, chunks):
+        # Skips heartbeats up to the next state message.
+        for _ in range(100):
+            chunk = next(chunks).decode()
+            if not chunk.startswith((':', 'retry')):
+                return parse_events(chunk)
+        self.fail('No event on the stream')
+
+    def apply_webhook(self, status):
+        record_event({'id': f'evt_{status}', 'type': 'customer.subscription.updated', 'created': 1700000000,
+                      'data': {'object': {'id': 'sub_test123', 'status': status,
+                                          'current_period_end': 1800000000}}})
+        process_pending_events()
+
+    def test_stream_sends_state_on_connect_and_after_changes(self):
+        stream, chunks = self.open_stream()
+        self.assertEqual(stream.mimetype, 'text/event-stream')
+        self.assertEqual(stream.headers['Cache-Control'], 'no-cache')
+        self.assertTrue(next(chunks).decode().startswith('retry: '))
+        self.assertEqual(self.next_events(chunks), [
+            ('subscription', {'status': 'active', 'plan': 'basic_monthly', 'device_limit': 2,
+                              'current_period_end': None}),
+            ('devices', {'device_ids': [], 'device_limit': 2})
+        ])
+
+        self.assertEqual(next(chunks), b': keepalive\n\n')
+        response = self.client.post('/devices/register', json={'device_id': 'device-1'}, headers=self.headers)
+        device_pk = response.get_json()['id']
+        self.assertEqual(self.next_events(chunks), [('devices', {'device_ids': [device_pk], 'device_limit': 2})])
+
+        self.apply_webhook('past_due')
+        [(kind, data)] = self.next_events(chunks)
+        self.assertEqual((kind, data['status']), ('subscription', 'past_due'))
+
+        self.assertEqual(push_hub.stream_count(self.user_id), 1)
+        stream.close()
+        self.assertEqual(push_hub.stream_count(self.user_id), 0)
+
+    def test_changes_are_published_after_commit(self):
+        channel = push_hub.subscribe(self.user_id)
+        response = self.client.post('/devices/register', json={'device_id': 'device-1'}, headers=self.headers)
+        device_pk = response.get_json()['id']
+        # Re-registering changes nothing the stream shows.
+        self.client.post('/devices/register', json={'device_id': 'device-1'}, headers=self.headers)
+        self.client.delete(f'/devices/remove/{device_pk}', headers=self.headers)
+        self.assertEqual(channel.take(), [DEVICES_CHANGED])
+        self.assertEqual(channel.take(), [])
+
+        self.apply_webhook('past_due')
+        self.assertEqual(channel.take(), [SUBSCRIPTION_CHANGED])
+
+        # Nothing for other users' streams.
+        other = push_hub.subscribe(self.user_id + 1)
+        self.apply_webhook('canceled')
+        self.assertEqual(other.take(), [])
+        push_hub.unsubscribe(channel)
+        push_hub.unsubscribe(other)
+
+    def test_checkout_and_reconcile_publish_subscription_changes(self):
+        gateway = self.app.extensions['stripe_gateway']
+        user = User(username='newuser', email='new@example.com')
+        db.session.add(user)
+        db.session.commit()
+        channel = push_hub.subscribe(user.id)
+        checkout = gateway.create_checkout_session(line_items=[{'price': 'price_basic_monthly'}],
+                                                   client_reference_id=str(user.id), metadata={'plan': 'basic_monthly'})
+        gateway.complete_checkout_session(checkout.id)
+        response = self.client.get(f'/subscription/subscription-success?session_id={checkout.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(channel.take(), [SUBSCRIPTION_CHANGED])
+
+        # A cancellation whose webhook never arrived.
+        gateway.cancel_subscription(db.session.get(User, user.id).subscription.stripe_subscription_id)
+        reconcile_subscriptions()
+        self.assertEqual(channel.take(), [SUBSCRIPTION_CHANGED])
+        push_hub.unsubscribe(channel)
+
+    def test_streams_per_user_are_capped(self):
+        first, _ = self.open_stream()
+        second, _ = self.open_stream()
+        response = self.client.get('/push/stream', headers=self.headers)
+        self.assertEqual(response.status_code, 429)
+        second.close()
+        first.close()
+        third, _ = self.open_stream()
+        third.close()
+
+    def test_stream_requires_a_token(self):
+        self.assertEqual(self.client.get('/push/stream').status_code, 401)
+
+    def test_stream_ends_when_its_token_is_revoked(self):
+        stream, chunks = self.open_stream()
+        next(chunks)
+        self.next_events(chunks)
+        self.assertEqual(self.client.post('/auth/logout', headers=self.headers).status_code, 200)
+        with self.assertRaises(StopIteration):
+            for _ in range(100):
+                next(chunks)
+        self.assertEqual(push_hub.stream_count(self.user_id), 0)
+        stream.close()
+
+    def test_stream_is_off_for_sync_wsgi_workers(self):
+        self.app.config['PUSH_STREAM_WSGI'] = False
+        self.assertEqual(self.client.get('/push/stream', headers=self.headers).status_code, 404)
+
+
+class PushBrokerTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.app = create_app('testing', config_overrides={
+            'PUSH_BROKER': 'sqlite',
+            'PUSH_BROKER_PATH': self.path,
+            'PUSH_BROKER_POLL_INTERVAL': 0.01
+        })
+        # Two hubs stand in for two worker processes on the node.
+        self.hubs = [PushHub(), PushHub()]
+        for hub in self.hubs:
+            hub.init_app(self.app)
+
+    def tearDown(self):
+        for hub in self.hubs:
+            hub.broker = None
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_publishes_reach_streams_in_other_processes(self):
+        sender, receiver = self.hubs
+        channel = receiver.subscribe(1)
+        own = sender.subscribe(1)
+        sender.publish(1, SUBSCRIPTION_CHANGED)
+        sender.publish(2, DEVICES_CHANGED)
+
+        self.assertEqual(channel.wait(5), [SUBSCRIPTION_CHANGED])
+        # Delivered locally once, not again through the broker.
+        self.assertEqual(own.take(), [SUBSCRIPTION_CHANGED])
+        self.assertEqual(own.wait(0.1), [])
+
+if __name__ == '__main__':
+    unittest.main()
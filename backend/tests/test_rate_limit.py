@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+from app import create_app, db
+from models import User, Subscription, Device
+from services.metrics_service import metrics_buffer
+from services.device_service import device_activity
+from services.webhook_service import stripe_event_worker
+from utils.instrumentation import instrumentation
+from utils.rate_limit import MemoryBuckets, SQLiteBuckets
+from flask_jwt_extended import create_access_token
+
+class RateLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing', config_overrides={
+            'RATE_LIMITS': {
+                'auth.login': [{'key': 'ip', 'rate': 2, 'per': 60, 'burst': 2}],
+                'device': [{'key': 'device', 'rate': 1, 'per': 60, 'burst': 1}],
+            }
+        })
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        stripe_event_worker.enabled = False
+        metrics_buffer.interval = 0
+        device_activity.interval = 0
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.user = User(username='testuser', email='test@example.com')
+        self.user.set_password('password123')
+        db.session.add(self.user)
+        db.session.commit()
+        db.session.add(Subscription(user_id=self.user.id, plan='premium_monthly', status='active', device_limit=5,
+                                    stripe_subscription_id='sub_test123'))
+        self.devices = [Device(user_id=self.user.id, device_id=f'device-{i}', name='Laptop') for i in range(2)]
+        db.session.add_all(self.devices)
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {create_access_token(identity=str(self.user.id))}'}
+
+    def tearDown(self):
+        device_activity.flush_now()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, remote_addr='10.0.0.1'):
+        return self.client.post('/auth/login', json={'username': 'testuser', 'password': 'password123'},
+                                environ_base={'REMOTE_ADDR': remote_addr})
+
+    def test_login_is_limited_per_ip(self):
+        self.assertEqual(self.login().status_code, 200)
+        self.assertEqual(self.login().status_code, 200)
+        response = self.login()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '30')
+        self.assertEqual(self.login(remote_addr='10.0.0.2').status_code, 200)
+
+        metrics = instrumentation.render()
+        self.assertIn('rate_limit_decisions_total{policy="auth.login",decision="allowed"} 3', metrics)
+        self.assertIn('rate_limit_decisions_total{policy="auth.login",decision="limited"} 1', metrics)
+
+    def test_forwarded_client_address_is_used_behind_trusted_proxies(self):
+        app = create_app('testing', config_overrides={
+            'PROXY_FIX_HOPS': 1,
+            'RATE_LIMITS': {'auth.login': [{'key': 'ip', 'rate': 1, 'per': 60, 'burst': 1}]},
+        })
+        client = app.test_client()
+        login = lambda forwarded_for: client.post('/auth/login', json={'username': 'nobody', 'password': 'password123'},
+                                                  headers={'X-Forwarded-For': forwarded_for},
+                                                  environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        with app.app_context():
+            db.create_all()
+            self.assertEqual(login('203.0.113.5').status_code, 401)
+            self.assertEqual(login('203.0.113.6').status_code, 401)
+            self.assertEqual(login('203.0.113.5').status_code, 429)
+            # Only the hop the proxy appended is trusted, not what the client sent.
+            self.assertEqual(login('198.51.100.1, 203.0.113.5').status_code, 429)
+            db.drop_all()
+
+    def test_blueprint_policy_is_keyed_per_device(self):
+        first, second = (f'/devices/update-activity/{device.id}' for device in self.devices)
+        self.assertEqual(self.client.post(first, headers=self.headers).status_code, 200)
+        self.assertEqual(self.client.post(first, headers=self.headers).status_code, 429)
+        self.assertEqual(self.client.post(second, headers=self.headers).status_code, 200)
+
+    def test_unlisted_endpoints_are_not_limited(self):
+        for _ in range(5):
+            self.assertEqual(self.client.get('/auth/user', headers=self.headers).status_code, 200)
+
+    def test_sqlite_buckets_are_shared_between_workers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'buckets.sqlite3')
+            worker_a, worker_b = SQLiteBuckets(path, 0.1), SQLiteBuckets(path, 0.1)
+            bucket = [('k', 2, 1)]
+            self.assertIsNone(worker_a.take(bucket, 100.0))
+            self.assertIsNone(worker_b.take(bucket, 100.0))
+            self.assertEqual(worker_a.take(bucket, 100.0), 1)
+            # One token refilled after a second.
+            self.assertIsNone(worker_b.take(bucket, 101.0))
+
+            worker_a.prune(102.0)
+            self.assertIsNone(worker_a.take(bucket, 102.0))
+            self.assertIsNone(worker_a.take(bucket, 102.0))
+
+    def test_rejected_requests_take_no_tokens(self):
+        for storage in (MemoryBuckets(), SQLiteBuckets(':memory:', 0.1)):
+            buckets = [('ip', 5, 1), ('user', 1, 1)]
+            self.assertIsNone(storage.take(buckets, 100.0))
+            self.assertEqual(storage.take(buckets, 100.0), 1)
+            self.assertEqual(storage.take(buckets, 100.0), 1)
+            # The ip bucket kept its tokens while the user bucket was empty.
+            for _ in range(4):
+                self.assertIsNone(storage.take([('ip', 5, 1)], 100.0))
+            self.assertEqual(storage.take([('ip', 5, 1)], 100.0), 1)
+
+if __name__ == '__main__':
+    unittest.main()
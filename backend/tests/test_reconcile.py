@@ -0,0 +1,93 @@
+import unittest
+from datetime import datetime
+from app import create_app, db
+from models import User, Subscription, SyncCheckpoint
+from services.analytics_service import global_counters, recount
+from services.reconcile_service import reconcile_subscriptions, CHECKPOINT_NAME
+from services.stripe_gateway import FakeStripeGateway
+from services.webhook_service import stripe_event_worker
+
+PERIOD_END = 1700000000 + FakeStripeGateway.PERIOD_SECONDS
+
+class SubscriptionReconcileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.gateway = FakeStripeGateway(clock=lambda: 1700000000)
+        self.app.extensions['stripe_gateway'] = self.gateway
+        stripe_event_worker.enabled = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        # Five subscriptions that agree with Stripe.
+        self.subscriptions = []
+        for i in range(5):
+            user = User(username=f'user{i}', email=f'user{i}@example.com')
+            db.session.add(user)
+            db.session.flush()
+            checkout = self.gateway.create_checkout_session(line_items=[{'price': 'price_test'}],
+                                                            client_reference_id=str(user.id))
+            stripe_id = self.gateway.complete_checkout_session(checkout.id).subscription
+            subscription = Subscription(user_id=user.id, plan='basic_monthly', status='active',
+                                        stripe_subscription_id=stripe_id,
+                                        current_period_end=datetime.fromtimestamp(PERIOD_END))
+            db.session.add(subscription)
+            self.subscriptions.append(subscription)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_only_drifted_fields_are_updated(self):
+        # Missed webhooks: a cancellation and a renewal.
+        cancelled, renewed, untouched = self.subscriptions[0], self.subscriptions[1], self.subscriptions[2]
+        self.gateway.cancel_subscription(cancelled.stripe_subscription_id)
+        self.gateway.update_subscription(renewed.stripe_subscription_id, current_period_end=PERIOD_END + 86400)
+        untouched_updated_at = untouched.updated_at
+
+        checkpoint = reconcile_subscriptions(page_size=2)
+        self.assertIsNotNone(checkpoint.completed_at)
+        self.assertEqual((checkpoint.pages, checkpoint.checked, checkpoint.changed), (3, 5, 2))
+
+        db.session.expire_all()
+        self.assertEqual(cancelled.status, 'canceled')
+        self.assertEqual(cancelled.current_period_end, datetime.fromtimestamp(PERIOD_END))
+        self.assertEqual(renewed.status, 'active')
+        self.assertEqual(renewed.current_period_end, datetime.fromtimestamp(PERIOD_END + 86400))
+        self.assertEqual(untouched.updated_at, untouched_updated_at)
+
+        nonzero = lambda totals: {name: value for name, value in totals.items() if value}
+        self.assertEqual(nonzero(global_counters.totals()), nonzero(recount()))
+
+    def test_interrupted_run_resumes_from_its_checkpoint(self):
+        for subscription in self.subscriptions:
+            self.gateway.update_subscription(subscription.stripe_subscription_id, status='past_due')
+
+        checkpoint = reconcile_subscriptions(page_size=2, max_pages=1)
+        self.assertIsNone(checkpoint.completed_at)
+        self.assertEqual(checkpoint.changed, 2)
+        cursor = checkpoint.cursor
+        self.assertIsNotNone(cursor)
+
+        calls = []
+        list_subscriptions = self.gateway.list_subscriptions
+        self.gateway.list_subscriptions = lambda **kwargs: calls.append(kwargs) or list_subscriptions(**kwargs)
+        checkpoint = reconcile_subscriptions(page_size=2)
+        self.assertEqual(calls[0]['starting_after'], cursor)
+        self.assertEqual((checkpoint.pages, checkpoint.checked, checkpoint.changed), (3, 5, 5))
+        self.assertEqual(Subscription.query.filter_by(status='past_due').count(), 5)
+        self.assertIsNone(db.session.get(SyncCheckpoint, CHECKPOINT_NAME).cursor)
+
+    def test_rows_with_newer_webhook_state_are_skipped(self):
+        subscription = self.subscriptions[0]
+        self.gateway.update_subscription(subscription.stripe_subscription_id, status='past_due')
+        subscription.last_event_created = 4102444800  # applied from an event newer than the page
+        db.session.commit()
+
+        self.assertEqual(reconcile_subscriptions().changed, 0)
+        self.assertEqual(db.session.get(Subscription, subscription.id).status, 'active')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import gzip
+import json
+import unittest
+from unittest import mock
+from app import create_app, db
+from models import RuleBundle
+from services.rules_service import (
+    DEFAULT_RULES, rule_bundles, seed_default_rules, set_service_rules, publish_rules, validate_rules
+)
+
+class RuleBundleTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing', config_overrides={'ADMIN_API_TOKEN': 'admin-token'})
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.admin = {'Authorization': 'Bearer admin-token'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get_json(self, url, **headers):
+        response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        if response.headers.get('Content-Encoding') == 'gzip':
+            return response, json.loads(gzip.decompress(response.data))
+        return response, response.get_json()
+
+    def test_validation(self):
+        self.assertEqual(validate_rules({'ad_markers': [[' .ad ']]}), {'ad_markers': [['.ad']]})
+        for rules in (None, {}, {'ad_markers': []}, {'ad_markers': [[]]}, {'ad_markers': [['.ad']], 'css': 'x'},
+                      {'ad_markers': [['.ad']], 'heuristics': {'threshold': 'high'}}, {'ad_markers': [[1]]}):
+            with self.assertRaises(ValueError):
+                validate_rules(rules)
+        with self.assertRaises(ValueError):
+            set_service_rules('You Tube', {'ad_markers': [['.ad']]})
+
+    def test_bundle_is_content_addressed_and_immutable(self):
+        self.assertEqual(self.client.get('/rules/latest').status_code, 404)
+        seed_default_rules()
+        version = publish_rules().version
+        # Republishing the same rules keeps the same bundle.
+        self.assertEqual(publish_rules().version, version)
+        self.assertEqual(RuleBundle.query.count(), 1)
+
+        response, pointer = self.get_json('/rules/latest')
+        self.assertEqual(pointer, {'version': version, 'bundle': f'/rules/bundle/{version}'})
+        self.assertIn('max-age=', response.headers['Cache-Control'])
+        self.assertEqual(self.client.get('/rules/latest', headers={'If-None-Match': f'"{version}"'}).status_code, 304)
+
+        response, bundle = self.get_json(pointer['bundle'], **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(bundle, {'version': version, 'services': DEFAULT_RULES})
+        response, plain = self.get_json(pointer['bundle'])
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(plain, bundle)
+        response = self.client.get(pointer['bundle'], headers={'If-None-Match': f'"{version}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/rules/bundle/0123abcd').status_code, 404)
+
+    def test_delta_carries_only_changed_services(self):
+        seed_default_rules()
+        old = publish_rules().version
+        set_service_rules('hulu', {'ad_markers': [['.ad-break']]})
+        set_service_rules('crunchyroll', {'ad_markers': [['.ad-overlay']]})
+        self.client.delete('/admin/rules/twitch', headers=self.admin)
+        response = self.client.post('/admin/rules/publish', headers=self.admin)
+        new = response.get_json()['version']
+        self.assertNotEqual(new, old)
+
+        _, delta = self.get_json(f'/rules/delta/{old}/{new}', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(delta, {
+            'from': old,
+            'version': new,
+            'services': {'hulu': {'ad_markers': [['.ad-break']]}, 'crunchyroll': {'ad_markers': [['.ad-overlay']]}},
+            'removed': ['twitch']
+        })
+        # Applying the delta gives the new bundle.
+        _, before = self.get_json(f'/rules/bundle/{old}')
+        _, after = self.get_json(f'/rules/bundle/{new}')
+        services = {name: rules for name, rules in before['services'].items() if name not in delta['removed']}
+        services.update(delta['services'])
+        self.assertEqual(services, after['services'])
+        self.assertEqual(self.client.get(f'/rules/delta/0123abcd/{new}').status_code, 404)
+
+    def test_bundles_are_served_from_memory(self):
+        seed_default_rules()
+        version = publish_rules().version
+        self.get_json(f'/rules/bundle/{version}')
+        self.get_json('/rules/latest')
+
+        with mock.patch.object(db.session, 'scalar', side_effect=AssertionError('database read')):
+            self.get_json(f'/rules/bundle/{version}')
+            self.get_json('/rules/latest')
+
+    def test_old_bundles_are_pruned(self):
+        versions = []
+        for n in range(3):
+            set_service_rules('hulu', {'ad_markers': [[f'.ad-{n}']]})
+            versions.append(publish_rules(keep=2).version)
+        self.assertEqual(sorted(b.version for b in RuleBundle.query), sorted(versions[1:]))
+        self.assertEqual(self.client.get(f'/rules/bundle/{versions[0]}').status_code, 404)
+
+    def test_admin_rules_api(self):
+        self.assertEqual(self.client.put('/admin/rules/hulu', json={'ad_markers': [['.ad']]}).status_code, 401)
+        response = self.client.put('/admin/rules/hulu', json={'ad_markers': '.ad'}, headers=self.admin)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post('/admin/rules/publish', headers=self.admin).status_code, 400)
+
+        response = self.client.put('/admin/rules/hulu', json={'ad_markers': [['.ad']]}, headers=self.admin)
+        self.assertEqual(response.status_code, 200)
+        self.client.post('/admin/rules/publish', headers=self.admin)
+        listed = self.client.get('/admin/rules', headers=self.admin).get_json()
+        self.assertEqual(listed['services'], {'hulu': {'ad_markers': [['.ad']]}})
+        self.assertEqual(len(listed['bundles']), 1)
+        self.assertEqual(self.client.delete('/admin/rules/peacock', headers=self.admin).status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+import unittest
+from app import create_app
+from services.stripe_gateway import FakeStripeGateway
+from services.stripe_service import LazyStripeGateway
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class StartupTestCase(unittest.TestCase):
+    def test_create_app_defers_stripe_and_alembic(self):
+        probe = ("import sys; from app import create_app; create_app('testing', {'FAST_START': True}); "
+                 "print(' '.join(m for m in ('stripe', 'flask_migrate', 'alembic') if m in sys.modules))")
+        output = subprocess.check_output([sys.executable, '-c', probe], cwd=BACKEND_DIR)
+        self.assertEqual(output.decode().strip(), '')
+
+    def test_stripe_gateway_is_built_on_first_use(self):
+        app = create_app('testing', config_overrides={'STRIPE_GATEWAY': 'fake', 'FAST_START': True})
+        gateway = app.extensions['stripe_gateway']
+        self.assertIsInstance(gateway, LazyStripeGateway)
+        self.assertNotIn('migrate', app.extensions)
+
+        checkout = gateway.create_checkout_session(line_items=[{'price': 'price_test'}])
+        self.assertIsInstance(gateway.gateway, FakeStripeGateway)
+        self.assertEqual(gateway.retrieve_checkout_session(checkout.id).id, checkout.id)
+
+    def test_migrations_are_registered_outside_fast_start(self):
+        self.assertIn('migrate', create_app('testing', config_overrides={'FAST_START': False}).extensions)
+
+    def test_production_requires_its_secrets(self):
+        probe = "import sys; from app import create_app; create_app(sys.argv[1])"
+        env = {key: value for key, value in os.environ.items() if key not in ('SECRET_KEY', 'JWT_SECRET_KEY')}
+        env['SECRET_KEY'] = 'production-secret'
+        result = subprocess.run([sys.executable, '-c', probe, 'production'], cwd=BACKEND_DIR, env=env,
+                                capture_output=True, text=True)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn('Required settings are not set: JWT_SECRET_KEY', result.stderr)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+import stripe
+from app import create_app, db
+from models import User, Subscription
+from services.stripe_gateway import FakeStripeGateway, LiveStripeGateway, StripeGateway
+from services.webhook_service import stripe_event_worker, process_pending_events
+from flask_jwt_extended import create_access_token
+
+class FakeStripeFlowTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        self.app.config['PREMIUM_MONTHLY_PRICE_ID'] = 'price_premium_monthly'
+        self.gateway = FakeStripeGateway(clock=lambda: 1700000000)
+        self.app.extensions['stripe_gateway'] = self.gateway
+        stripe_event_worker.enabled = False
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.user = User(username='testuser', email='test@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {create_access_token(identity=str(self.user.id))}'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def subscribe(self):
+        response = self.client.post('/subscription/create-checkout-session', json={'plan': 'premium_monthly'},
+                                    headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        session_id = response.get_json()['sessionId']
+        self.gateway.complete_checkout_session(session_id)
+        response = self.client.get(f'/subscription/subscription-success?session_id={session_id}')
+        self.assertEqual(response.status_code, 200)
+        return Subscription.query.filter_by(user_id=self.user.id).one()
+
+    def test_checkout_creates_subscription(self):
+        subscription = self.subscribe()
+        self.assertEqual(subscription.status, 'active')
+        self.assertEqual(subscription.plan, 'premium_monthly')
+        self.assertEqual(subscription.device_limit, 5)
+        self.assertEqual(subscription.stripe_subscription_id, 'sub_fake_000003')
+
+    def test_signed_webhook_updates_subscription(self):
+        subscription = self.subscribe()
+        stripe_subscription = self.gateway.update_subscription(subscription.stripe_subscription_id, status='past_due')
+        payload, signature = self.gateway.make_event('customer.subscription.updated', stripe_subscription,
+                                                     self.app.config['STRIPE_WEBHOOK_SECRET'])
+
+        response = self.client.post('/subscription/webhook', data=payload, headers={'Stripe-Signature': signature})
+        self.assertEqual(response.status_code, 200)
+        process_pending_events()
+        self.assertEqual(db.session.get(Subscription, subscription.id).status, 'past_due')
+
+        response = self.client.post('/subscription/webhook', data=payload,
+                                    headers={'Stripe-Signature': signature.replace('v1=', 'v1=0')})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cancel_goes_through_gateway(self):
+        subscription = self.subscribe()
+        response = self.client.post('/subscription/cancel', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.gateway.subscriptions[subscription.stripe_subscription_id]['status'], 'canceled')
+        self.assertEqual(db.session.get(Subscription, subscription.id).status, 'canceled')
+
+    def test_list_subscriptions_pages(self):
+        for _ in range(3):
+            session = self.gateway.create_checkout_session(line_items=[], metadata={})
+            self.gateway.complete_checkout_session(session.id)
+        first = self.gateway.list_subscriptions(limit=2)
+        self.assertTrue(first.has_more)
+        second = self.gateway.list_subscriptions(limit=2, starting_after=first.data[-1].id)
+        self.assertFalse(second.has_more)
+        self.assertEqual(len({s.id for s in first.data + second.data}), 3)
+
+    def test_live_gateways_keep_their_own_keys(self):
+        with self.assertRaises(TypeError):
+            StripeGateway()
+        with mock.patch.object(stripe, 'api_key', None):
+            first, second = LiveStripeGateway('sk_test_first'), LiveStripeGateway('sk_test_second')
+            self.assertIsNone(stripe.api_key)
+        with mock.patch('stripe.Subscription.retrieve') as retrieve:
+            first.retrieve_subscription('sub_1')
+            second.retrieve_subscription('sub_1')
+        self.assertEqual([call.kwargs['api_key'] for call in retrieve.call_args_list],
+                         ['sk_test_first', 'sk_test_second'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app, db
+from models import User, RefreshToken, RevokedToken
+from services.token_service import revocation_filter, prune_tokens
+from flask_jwt_extended import create_refresh_token
+
+class RefreshTokenRotationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['JWT_SECRET_KEY'] = 'test-jwt-secret-key'
+        self.app.config['REFRESH_TOKEN_REUSE_GRACE'] = 0
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        response = self.client.post('/auth/register', json={
+            'username': 'testuser', 'email': 'test@example.com', 'password': 'password123'
+        })
+        self.tokens = response.get_json()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def refresh(self, refresh_token):
+        return self.client.post('/auth/refresh', headers={'Authorization': f'Bearer {refresh_token}'})
+
+    def get_user(self, access_token):
+        return self.client.get('/auth/user', headers={'Authorization': f'Bearer {access_token}'})
+
+    def test_refresh_rotates_the_token(self):
+        response = self.refresh(self.tokens['refresh_token'])
+        self.assertEqual(response.status_code, 200)
+        rotated = response.get_json()
+        self.assertNotEqual(rotated['refresh_token'], self.tokens['refresh_token'])
+        self.assertEqual(self.get_user(rotated['access_token']).status_code, 200)
+        self.assertEqual(self.refresh(rotated['refresh_token']).status_code, 200)
+
+        tokens = RefreshToken.query.all()
+        self.assertEqual(len(tokens), 3)
+        self.assertEqual(len({t.family_id for t in tokens}), 1)
+
+    def test_reuse_revokes_the_whole_family(self):
+        rotated = self.refresh(self.tokens['refresh_token']).get_json()
+
+        # The old token is replayed, e.g. by whoever stole it.
+        response = self.refresh(self.tokens['refresh_token'])
+        self.assertEqual(response.status_code, 401)
+
+        self.assertEqual(self.refresh(rotated['refresh_token']).status_code, 401)
+        self.assertEqual(self.get_user(rotated['access_token']).status_code, 401)
+        self.assertEqual(self.get_user(self.tokens['access_token']).status_code, 401)
+
+        # Other logins are unaffected.
+        other = self.client.post('/auth/login', json={'username': 'testuser', 'password': 'password123'}).get_json()
+        self.assertEqual(self.get_user(other['access_token']).status_code, 200)
+
+    def test_concurrent_refresh_within_grace_is_not_treated_as_theft(self):
+        self.app.config['REFRESH_TOKEN_REUSE_GRACE'] = 30
+        rotated = self.refresh(self.tokens['refresh_token']).get_json()
+
+        response = self.refresh(self.tokens['refresh_token'])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.refresh(rotated['refresh_token']).status_code, 200)
+
+    def test_logout_revokes_access_and_refresh_tokens(self):
+        headers = {'Authorization': f"Bearer {self.tokens['access_token']}"}
+        self.assertEqual(self.client.post('/auth/logout', headers=headers).status_code, 200)
+
+        self.assertEqual(self.get_user(self.tokens['access_token']).status_code, 401)
+        self.assertEqual(self.refresh(self.tokens['refresh_token']).status_code, 401)
+
+    def test_revocations_from_other_workers_arrive_on_sync(self):
+        revocation_filter.sync()
+        family_id = RefreshToken.query.one().family_id
+        db.session.add(RevokedToken(key=family_id, expires_at=datetime.utcnow() + timedelta(days=1)))
+        db.session.commit()
+
+        # Until the next sync this worker still answers from its local set.
+        revocation_filter.sync_interval = 60
+        self.assertEqual(self.get_user(self.tokens['access_token']).status_code, 200)
+        revocation_filter.sync()
+        self.assertEqual(self.get_user(self.tokens['access_token']).status_code, 401)
+
+    def test_tokens_issued_before_rotation_are_exchanged_once(self):
+        user = User.query.one()
+        legacy = create_refresh_token(identity=str(user.id))
+
+        response = self.refresh(legacy)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_user(response.get_json()['access_token']).status_code, 200)
+        self.assertEqual(self.refresh(legacy).status_code, 401)
+
+    def test_prune_removes_expired_rows(self):
+        RefreshToken.query.update({'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.add(RevokedToken(key='expired', expires_at=datetime.utcnow() - timedelta(seconds=1)))
+        db.session.commit()
+
+        self.assertEqual(prune_tokens(), 2)
+        self.assertEqual(RefreshToken.query.count(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
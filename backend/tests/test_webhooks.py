@@ -0,0 +1,132 @@
+import hashlib
+import hmac
+import json
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+from app import create_app, db
+from models import User, Subscription, StripeEvent
+from services.webhook_service import stripe_event_worker, process_pending_events, claim_events, apply_event
+
+class WebhookLedgerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        stripe_event_worker.enabled = False
+        self.client = self.app.test_client()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        user = User(username='testuser', email='test@example.com')
+        db.session.add(user)
+        db.session.commit()
+        self.subscription = Subscription(user_id=user.id, plan='basic_monthly', status='active',
+                                         stripe_subscription_id='sub_test123')
+        db.session.add(self.subscription)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post_event(self, event_id, event_type, created, obj):
+        payload = json.dumps({
+            'id': event_id,
+            'object': 'event',
+            'type': event_type,
+            'created': created,
+            'data': {'object': obj}
+        })
+        timestamp = int(time.time())
+        signature = hmac.new(self.app.config['STRIPE_WEBHOOK_SECRET'].encode('utf-8'),
+                             f'{timestamp}.{payload}'.encode('utf-8'), hashlib.sha256).hexdigest()
+        return self.client.post('/subscription/webhook', data=payload,
+                                headers={'Stripe-Signature': f't={timestamp},v1={signature}'})
+
+    def subscription_updated(self, event_id, created, status, period_end):
+        return self.post_event(event_id, 'customer.subscription.updated', created, {
+            'id': 'sub_test123', 'object': 'subscription', 'status': status, 'current_period_end': period_end
+        })
+
+    def test_webhook_only_records_the_event(self):
+        response = self.subscription_updated('evt_1', 1700000000, 'past_due', 1700000000)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StripeEvent.query.get('evt_1').status, 'pending')
+        self.assertEqual(db.session.get(Subscription, self.subscription.id).status, 'active')
+
+        self.assertEqual(process_pending_events(), 1)
+        self.assertEqual(StripeEvent.query.get('evt_1').status, 'done')
+        self.assertEqual(db.session.get(Subscription, self.subscription.id).status, 'past_due')
+
+    def test_retried_deliveries_are_deduplicated(self):
+        self.subscription_updated('evt_1', 1700000000, 'past_due', 1700000000)
+        response = self.subscription_updated('evt_1', 1700000000, 'past_due', 1700000000)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StripeEvent.query.count(), 1)
+        self.assertEqual(process_pending_events(), 1)
+        self.assertEqual(process_pending_events(), 0)
+
+    def test_older_events_do_not_overwrite_newer_state(self):
+        self.subscription_updated('evt_new', 1700000100, 'active', 1702592100)
+        process_pending_events()
+        self.subscription_updated('evt_old', 1700000000, 'past_due', 1700000000)
+        process_pending_events()
+
+        subscription = db.session.get(Subscription, self.subscription.id)
+        self.assertEqual(subscription.status, 'active')
+        self.assertEqual(subscription.current_period_end, datetime.fromtimestamp(1702592100))
+
+    def test_events_in_one_batch_apply_in_created_order(self):
+        self.subscription_updated('evt_b', 1700000100, 'canceled', 1702592100)
+        self.subscription_updated('evt_a', 1700000000, 'past_due', 1700000000)
+        self.assertEqual(process_pending_events(), 2)
+        self.assertEqual(db.session.get(Subscription, self.subscription.id).status, 'canceled')
+
+    def test_older_event_claimed_concurrently_is_skipped(self):
+        self.subscription_updated('evt_old', 1700000000, 'past_due', 1700000000)
+        [old] = claim_events()
+        token = old.claim_token
+        # Another worker applies a newer event before this one does.
+        self.subscription_updated('evt_new', 1700000100, 'active', 1702592100)
+        process_pending_events()
+        apply_event(old, token)
+
+        self.assertEqual(db.session.get(Subscription, self.subscription.id).status, 'active')
+        self.assertEqual(StripeEvent.query.get('evt_old').status, 'done')
+
+    def test_event_is_not_applied_after_losing_its_claim(self):
+        self.subscription_updated('evt_1', 1700000000, 'past_due', 1700000000)
+        [event] = claim_events()
+        token = event.claim_token
+        # The lease ran out and another worker claimed the event.
+        StripeEvent.query.filter_by(id='evt_1').update({'claim_token': 'other-worker'})
+        db.session.commit()
+        apply_event(event, token)
+
+        self.assertEqual(db.session.get(Subscription, self.subscription.id).status, 'active')
+        stored = db.session.get(StripeEvent, 'evt_1')
+        self.assertEqual((stored.status, stored.claim_token), ('processing', 'other-worker'))
+
+    def test_failed_events_are_retried_after_a_delay(self):
+        self.subscription_updated('evt_1', 1700000000, 'past_due', 1700000000)
+        with mock.patch('services.webhook_service.bump_version', side_effect=RuntimeError('database hiccup')):
+            self.assertEqual(process_pending_events(), 1)
+        event = db.session.get(StripeEvent, 'evt_1')
+        self.assertEqual((event.status, event.last_error), ('pending', 'database hiccup'))
+        self.assertGreater(event.locked_until, datetime.utcnow() + timedelta(seconds=20))
+        self.assertEqual(process_pending_events(), 0)
+
+        event.locked_until = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        self.assertEqual(process_pending_events(), 1)
+        self.assertEqual(db.session.get(Subscription, self.subscription.id).status, 'past_due')
+
+    def test_invalid_signature_is_rejected(self):
+        response = self.client.post('/subscription/webhook', data='{}', headers={'Stripe-Signature': 't=1,v1=bad'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(StripeEvent.query.count(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, has_app_context, request, current_app
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql import Select
+from utils.rate_limit import DEFAULT_SQLITE_DIR, PRUNE_INTERVAL
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class RoutingSession(Session):
+    # db.session class. While the current request has picked a replica (see
+    # read_replica), plain SELECTs go to it; flushes, INSERT/UPDATE/DELETE
+    # and SELECT ... FOR UPDATE go to the primary, and after the first of
+    # those the rest of the request stays on the primary so it reads its
+    # own writes.
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            replica = replica_router.current_bind()
+            if replica is not None:
+                if not self._flushing and isinstance(clause, Select) and clause._for_update_arg is None:
+                    return self._db.engines[replica]
+                replica_router.use_primary()
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class MemoryWrites:
+    # Per-process record of recent writers, bounded to `max_tracked` users.
+
+    def __init__(self, max_tracked):
+        self.max_tracked = max_tracked
+        self._written = OrderedDict()
+        self._lock = threading.Lock()
+
+    def mark(self, identity, until):
+        with self._lock:
+            self._written[identity] = until
+            self._written.move_to_end(identity)
+            while len(self._written) > self.max_tracked:
+                self._written.popitem(last=False)
+
+    def until(self, identity):
+        with self._lock:
+            return self._written.get(identity)
+
+    def prune(self, before):
+        with self._lock:
+            for identity in [identity for identity, until in self._written.items() if until < before]:
+                del self._written[identity]
+
+
+class SQLiteWrites:
+    # Recent writers in a small SQLite file shared by every worker on the
+    # node, next to the rate limit buckets, so a user's follow-up reads stay
+    # on the primary whichever worker serves them.
+
+    def __init__(self, path, lock_timeout):
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS replica_write (identity TEXT PRIMARY KEY, until REAL NOT NULL)')
+
+    def _connection(self):
+        # One connection per thread and process; forked workers reconnect.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.lock_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def mark(self, identity, until):
+        self._connection().execute(
+            'INSERT INTO replica_write (identity, until) VALUES (?, ?) '
+            'ON CONFLICT (identity) DO UPDATE SET until = MAX(until, excluded.until)',
+            (identity, until)
+        )
+
+    def until(self, identity):
+        row = self._connection().execute('SELECT until FROM replica_write WHERE identity = ?', (identity,)).fetchone()
+        return row[0] if row else None
+
+    def prune(self, before):
+        self._connection().execute('DELETE FROM replica_write WHERE until < ?', (before,))
+
+
+class ReplicaRouter:
+    # Picks a replica bind per request for views marked with @read_replica,
+    # round robin over SQLALCHEMY_REPLICA_BINDS. Users who changed something
+    # in the last REPLICA_STICKY_SECONDS are kept on the primary so they do
+    # not read around replication lag. Outside tests that record is shared
+    # by the node's workers (REPLICA_STICKY_STORAGE='sqlite'); if the store
+    # is unavailable, reads go to the primary.
+
+    def __init__(self):
+        self.app = None
+        self.binds = ()
+        self.sticky_seconds = 15
+        self.max_tracked = 100000
+        self.storage = MemoryWrites(self.max_tracked)
+        self._cycle = iter(())
+        self._lock = threading.Lock()
+        self._next_prune = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.binds = tuple(app.config.get('SQLALCHEMY_REPLICA_BINDS', ()))
+        missing = set(self.binds) - set(app.config.get('SQLALCHEMY_BINDS') or {})
+        if missing:
+            raise ValueError(f'Replica binds missing from SQLALCHEMY_BINDS: {", ".join(sorted(missing))}')
+        self.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', 15)
+        self._cycle = itertools.cycle(self.binds)
+        self._next_prune = 0
+        # Tests get a fresh per-app record unless they ask otherwise.
+        backend = app.config.get('REPLICA_STICKY_STORAGE', 'memory' if app.testing else 'sqlite')
+        if self.binds and backend == 'sqlite':
+            path = (app.config.get('REPLICA_STICKY_SQLITE_PATH')
+                    or os.path.join(DEFAULT_SQLITE_DIR, 'replica-writes.sqlite3'))
+            self.storage = SQLiteWrites(path, app.config.get('REPLICA_STICKY_LOCK_TIMEOUT', 0.1))
+        else:
+            self.storage = MemoryWrites(self.max_tracked)
+        if self.binds:
+            app.after_request(self._after_request)
+        app.extensions['replica_router'] = self
+
+    @property
+    def enabled(self):
+        return bool(self.binds)
+
+    def current_bind(self):
+        if not has_app_context():
+            return None
+        return g.get('_replica_bind')
+
+    def use_replica(self, identity=None):
+        if not self.enabled or (identity is not None and self.is_sticky(identity)):
+            return None
+        with self._lock:
+            g._replica_bind = next(self._cycle)
+        return g._replica_bind
+
+    def use_primary(self):
+        g._replica_bind = None
+
+    @contextmanager
+    def primary(self):
+        # Reads inside the block go to the primary, e.g. ones whose results
+        # are cached beyond this request.
+        bind = self.current_bind()
+        if bind is None:
+            yield
+            return
+        g._replica_bind = None
+        try:
+            yield
+        finally:
+            g._replica_bind = bind
+
+    def mark_written(self, identity):
+        now = time.time()
+        try:
+            self.storage.mark(str(identity), now + self.sticky_seconds)
+            self._maybe_prune(now)
+        except sqlite3.Error as e:
+            self._logger().warning(f'Replica write record unavailable: {str(e)}')
+
+    def is_sticky(self, identity):
+        try:
+            until = self.storage.until(str(identity))
+        except sqlite3.Error as e:
+            self._logger().warning(f'Replica write record unavailable, reading the primary: {str(e)}')
+            return True
+        return until is not None and until >= time.time()
+
+    def _maybe_prune(self, now):
+        if now < self._next_prune:
+            return
+        self._next_prune = now + PRUNE_INTERVAL
+        self.storage.prune(now)
+
+    def _logger(self):
+        return current_app.logger if has_app_context() else self.app.logger
+
+    def _after_request(self, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            identity = _current_identity()
+            if identity is not None:
+                self.mark_written(identity)
+        return response
+
+
+def _current_identity():
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        # No JWT was checked for this request.
+        return None
+
+
+def read_replica(view):
+    # Lets a read-only view's queries go to a replica unless the user
+    # recently wrote something. Goes below @jwt_required(). Not for
+    # @conditional_get views: their ETag comes from the primary's data
+    # version, so a lagging replica's body would be cached under it.
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in SAFE_METHODS:
+            replica_router.use_replica(_current_identity())
+        return view(*args, **kwargs)
+    return wrapper
+
+
+replica_router = ReplicaRouter()
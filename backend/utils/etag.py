@@ -0,0 +1,49 @@
+import hashlib
+from functools import wraps
+from flask import request, make_response
+from flask_jwt_extended import get_jwt_identity
+from services.entitlement_service import get_entitlement
+
+
+def conditional_get(scope, extra=None, state=None):
+    # Strong ETags for polled per-user reads. The tag is derived from the
+    # user's data_version in the (usually cached) entitlement snapshot plus
+    # anything `extra(user_id, entitlement)` returns for state that lives in
+    # write-behind buffers, so a matching If-None-Match is answered with a
+    # 304 before the view runs. Views that return a section of the snapshot
+    # pass `state(user_id, entitlement)` instead, and their tag is a hash of
+    # that section alone, so buffer flushes bumping data_version leave it
+    # alone. Goes below @jwt_required().
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+            user_id = int(get_jwt_identity())
+            entitlement = get_entitlement(user_id)
+            if entitlement is None:
+                return view(*args, **kwargs)
+
+            etag = make_etag(scope, user_id, entitlement, extra, state)
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # The browser may keep the body but must revalidate every time.
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+def make_etag(scope, user_id, entitlement, extra=None, state=None):
+    if state is not None:
+        parts = [scope, str(user_id), repr(state(user_id, entitlement))]
+    else:
+        parts = [scope, str(user_id), str(entitlement['version'])]
+    if extra is not None:
+        parts.append(repr(extra(user_id, entitlement)))
+    return hashlib.sha1(':'.join(parts).encode('utf-8')).hexdigest()[:24]
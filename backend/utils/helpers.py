@@ -0,0 +1,40 @@
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def dialect_insert(session, table):
+    # INSERT construct supporting ON CONFLICT for the session's database.
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table)
+    if dialect == 'sqlite':
+        return sqlite.insert(table)
+    raise NotImplementedError(f'Upserts are not supported on {dialect}')
+
+
+def upsert_increment(session, table, rows, index_elements, counters):
+    # Inserts each row or adds its counter columns onto the existing row,
+    # in a single executemany.
+    if not rows:
+        return
+    stmt = dialect_insert(session, table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={name: table.c[name] + stmt.excluded[name] for name in counters}
+    )
+    session.execute(stmt, rows)
+
+
+def upsert_greatest(session, table, rows, index_elements, columns):
+    # Inserts each row or raises the existing row's `columns` to the row's
+    # values where they are larger, in a single executemany.
+    if not rows:
+        return
+    stmt = dialect_insert(session, table)
+    # Two-argument max() is SQLite's scalar greatest().
+    greatest = func.greatest if session.get_bind().dialect.name == 'postgresql' else func.max
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={name: greatest(table.c[name], stmt.excluded[name]) for name in columns}
+    )
+    session.execute(stmt, rows)
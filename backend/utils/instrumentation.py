@@ -0,0 +1,230 @@
+import hashlib
+import re
+import threading
+import time
+from functools import lru_cache
+from flask import g, request, has_app_context, has_request_context, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+BACKGROUND = '<background>'
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LIST = re.compile(r'\(\s*(?:\?|%\(\w+\)s|:\w+|%s)(?:\s*,\s*(?:\?|%\(\w+\)s|:\w+|%s))*\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=2048)
+def fingerprint(statement):
+    # Normalized statement and a short hash of it. Literals become `?` and
+    # IN/VALUES lists collapse to `(...)`, so the same query shape always gets
+    # the same fingerprint whatever its parameters or list length.
+    normalized = _STRING_LITERAL.sub('?', statement)
+    normalized = _NUMBER_LITERAL.sub('?', normalized)
+    normalized = _PLACEHOLDER_LIST.sub('(...)', normalized)
+    normalized = _WHITESPACE.sub(' ', normalized).strip()
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12], normalized
+
+
+def parameter_shape(parameters, executemany):
+    # Types of the bound parameters, never their values, so slow-query logs
+    # carry no emails, tokens or password hashes.
+    if executemany:
+        rows = len(parameters) if parameters else 0
+        first = parameters[0] if rows else ()
+        return f'{rows} rows of {parameter_shape(first, False)}'
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{k}: {type(v).__name__}' for k, v in parameters.items()) + '}'
+    return '(' + ', '.join(type(v).__name__ for v in parameters or ()) + ')'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0, 0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += 1
+        series[2] += value
+
+
+class Instrumentation:
+    # Per-process request and SQL statistics. Engine event hooks count and
+    # time every statement and attribute it to the blueprint endpoint serving
+    # the current request (or to <background> for flusher threads and
+    # workers). Statements slower than SLOW_QUERY_MS are logged with their
+    # fingerprint, and a statement shape repeated REPEATED_QUERY_THRESHOLD
+    # times within one request (the N+1 pattern) is logged and counted.
+    # render() produces the Prometheus text format for the scrape endpoint.
+
+    def __init__(self):
+        self.app = None
+        self.enabled = True
+        self.slow_query_ms = 200
+        self.repeated_query_threshold = 10
+        self._lock = threading.Lock()
+        self.reset()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('INSTRUMENTATION_ENABLED', True)
+        self.slow_query_ms = app.config.get('SLOW_QUERY_MS', 200)
+        self.repeated_query_threshold = app.config.get('REPEATED_QUERY_THRESHOLD', 10)
+        app.extensions['instrumentation'] = self
+        self.reset()
+        if not self.enabled:
+            return
+        _listen_once()
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.request_latency = Histogram(LATENCY_BUCKETS)
+            self.request_statements = Histogram(STATEMENT_BUCKETS)
+            self.statements = {}
+            self.statement_seconds = {}
+            self.slow_statements = {}
+            self.repeated_statements = {}
+            self.rate_limit_decisions = {}
+
+    def _before_request(self):
+        g._instrumentation = {'started': time.perf_counter(), 'statements': 0, 'fingerprints': {}, 'repeated': set()}
+
+    def _after_request(self, response):
+        state = g.pop('_instrumentation', None)
+        if state is None:
+            return response
+        elapsed = time.perf_counter() - state['started']
+        endpoint = request.endpoint or '<unmatched>'
+        with self._lock:
+            key = (endpoint, request.method, str(response.status_code))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.request_latency.observe((endpoint,), elapsed)
+            self.request_statements.observe((endpoint,), state['statements'])
+        return response
+
+    def record_statement(self, statement, parameters, executemany, elapsed):
+        state = None
+        endpoint = BACKGROUND
+        if has_request_context():
+            state = g.get('_instrumentation')
+            endpoint = request.endpoint or '<unmatched>'
+
+        fp, normalized = fingerprint(statement)
+        slow = elapsed * 1000 >= self.slow_query_ms
+        repeated = False
+        if state is not None:
+            state['statements'] += 1
+            count = state['fingerprints'].get(fp, 0) + 1
+            state['fingerprints'][fp] = count
+            if count >= self.repeated_query_threshold and fp not in state['repeated']:
+                state['repeated'].add(fp)
+                repeated = True
+
+        with self._lock:
+            self.statements[endpoint] = self.statements.get(endpoint, 0) + 1
+            self.statement_seconds[endpoint] = self.statement_seconds.get(endpoint, 0.0) + elapsed
+            if slow:
+                self.slow_statements[endpoint] = self.slow_statements.get(endpoint, 0) + 1
+            if repeated:
+                self.repeated_statements[endpoint] = self.repeated_statements.get(endpoint, 0) + 1
+
+        if slow:
+            self._logger().warning(
+                f'Slow query ({elapsed * 1000:.1f} ms) in {endpoint} [{fp}]: {normalized} '
+                f'params={parameter_shape(parameters, executemany)}')
+        if repeated:
+            self._logger().warning(
+                f'Query [{fp}] ran {self.repeated_query_threshold} times in one {endpoint} request '
+                f'(possible N+1): {normalized}')
+
+    def record_rate_limit(self, policy, decision):
+        with self._lock:
+            key = (policy, decision)
+            self.rate_limit_decisions[key] = self.rate_limit_decisions.get(key, 0) + 1
+
+    def _logger(self):
+        return current_app.logger if has_app_context() else self.app.logger
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def counter(name, help_text, values):
+            metric(name, 'counter', help_text)
+            for endpoint, value in sorted(values.items()):
+                lines.append(f'{name}{{endpoint="{endpoint}"}} {value}')
+
+        def histogram(name, help_text, hist):
+            metric(name, 'histogram', help_text)
+            for (endpoint,), (counts, total, value_sum) in sorted(hist.series.items()):
+                for bound, count in zip(hist.buckets, counts):
+                    lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {total}')
+                lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {value_sum}')
+                lines.append(f'{name}_count{{endpoint="{endpoint}"}} {total}')
+
+        with self._lock:
+            metric('http_requests_total', 'counter', 'HTTP requests by endpoint, method and status.')
+            for (endpoint, method, status), value in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {value}')
+            histogram('http_request_duration_seconds', 'Request latency by endpoint.', self.request_latency)
+            histogram('db_statements_per_request', 'SQL statements issued per request.', self.request_statements)
+            counter('db_statements_total', 'SQL statements executed.', self.statements)
+            counter('db_statement_seconds_total', 'Time spent executing SQL statements.', self.statement_seconds)
+            counter('db_slow_statements_total', 'SQL statements slower than SLOW_QUERY_MS.', self.slow_statements)
+            counter('db_repeated_statements_total',
+                    'Requests that repeated one statement shape REPEATED_QUERY_THRESHOLD times.',
+                    self.repeated_statements)
+            metric('rate_limit_decisions_total', 'counter', 'Rate limiter decisions by policy (allowed, limited, error).')
+            for (policy, decision), value in sorted(self.rate_limit_decisions.items()):
+                lines.append(f'rate_limit_decisions_total{{policy="{policy}",decision="{decision}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+instrumentation = Instrumentation()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['_query_started'].pop()
+    if instrumentation.enabled and (has_app_context() or instrumentation.app is not None):
+        instrumentation.record_statement(statement, parameters, executemany, time.perf_counter() - started)
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute.
+    stack = exception_context.connection.info.get('_query_started') if exception_context.connection else None
+    if stack:
+        stack.pop()
+
+
+_listening = False
+
+
+def _listen_once():
+    # Class-level listeners cover every engine, including binds created later.
+    global _listening
+    if _listening:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Engine, 'handle_error', _handle_error)
+    _listening = True
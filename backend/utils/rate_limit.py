@@ -0,0 +1,234 @@
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from flask import request, jsonify, has_app_context, current_app
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+from utils.instrumentation import instrumentation
+
+# Policies keyed by endpoint ('auth.login') or blueprint ('auth'); an
+# endpoint entry takes precedence over its blueprint's. Each limit is a
+# token bucket of `burst` tokens, refilled at `rate` tokens per `per`
+# seconds, one token per request, counted per `key`:
+#   ip      remote address
+#   user    JWT identity (falls back to ip when there is no valid token)
+#   device  JWT identity plus the <device_id> in the URL
+# RATE_LIMITS entries in the config are merged over these (a blueprint
+# entry replaces the defaults of its endpoints); an empty list disables one.
+DEFAULT_POLICIES = {
+    # Every attempt costs a bcrypt hash.
+    'auth.login': [{'key': 'ip', 'rate': 10, 'per': 60, 'burst': 10}],
+    'auth.register': [{'key': 'ip', 'rate': 5, 'per': 60, 'burst': 5}],
+    'auth.refresh': [{'key': 'user', 'rate': 10, 'per': 60, 'burst': 10}],
+    'user.user_metrics': [{'key': 'user', 'rate': 30, 'per': 60, 'burst': 30, 'methods': ['POST']}],
+    'user.ingest_metric_events': [{'key': 'user', 'rate': 30, 'per': 60, 'burst': 30}],
+    'user.export_data': [{'key': 'user', 'rate': 10, 'per': 3600, 'burst': 5}],
+    # The extension heartbeats every few minutes; this leaves room for retries.
+    'device.update_device_activity': [{'key': 'device', 'rate': 6, 'per': 60, 'burst': 6}],
+    # Streams reconnect on token expiry and network changes, not in a loop.
+    'push.stream': [{'key': 'user', 'rate': 6, 'per': 60, 'burst': 6}],
+}
+
+DEFAULT_SQLITE_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+PRUNE_INTERVAL = 60
+
+
+class MemoryBuckets:
+    # Per-process buckets; limits are multiplied by the number of workers.
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, buckets, now):
+        with self._lock:
+            levels = [_refill(*self._buckets.get(key, (capacity, now)), capacity, refill, now)
+                      for key, capacity, refill in buckets]
+            retry_after = _retry_after(buckets, levels)
+            if retry_after is None:
+                for (key, _, _), tokens in zip(buckets, levels):
+                    self._buckets[key] = (tokens - 1, now)
+            return retry_after
+
+    def prune(self, before):
+        with self._lock:
+            for key in [key for key, (_, updated) in self._buckets.items() if updated < before]:
+                del self._buckets[key]
+
+
+class SQLiteBuckets:
+    # Buckets in a small SQLite file shared by every worker on the node.
+    # It lives on tmpfs by default and is throwaway state, so it skips
+    # fsync. Each take() is one short write transaction over all of a
+    # request's buckets.
+
+    def __init__(self, path, lock_timeout):
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS rate_limit_bucket '
+                '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+            )
+
+    def _connection(self):
+        # One connection per thread and process; forked workers reconnect.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.lock_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, buckets, now):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            levels = []
+            for key, capacity, refill in buckets:
+                row = conn.execute('SELECT tokens, updated FROM rate_limit_bucket WHERE key = ?', (key,)).fetchone()
+                levels.append(_refill(*(row or (capacity, now)), capacity, refill, now))
+            retry_after = _retry_after(buckets, levels)
+            if retry_after is None:
+                conn.executemany(
+                    'INSERT INTO rate_limit_bucket (key, tokens, updated) VALUES (?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                    [(key, tokens - 1, now) for (key, _, _), tokens in zip(buckets, levels)]
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return retry_after
+
+    def prune(self, before):
+        self._connection().execute('DELETE FROM rate_limit_bucket WHERE updated < ?', (before,))
+
+
+def _refill(tokens, updated, capacity, refill, now):
+    return min(capacity, tokens + max(0.0, now - updated) * refill)
+
+
+def _retry_after(buckets, levels):
+    # A request takes one token from every bucket or from none, so a request
+    # rejected by one limit does not drain the others.
+    waits = [(1 - tokens) / refill for (_, _, refill), tokens in zip(buckets, levels) if tokens < 1]
+    return max(waits) if waits else None
+
+
+class RateLimiter:
+    # Token-bucket limits applied before the view runs, so shed requests
+    # never reach bcrypt or the database. Rejections get a 429 with
+    # Retry-After; every decision is counted in the instrumentation
+    # metrics. If the bucket store is unavailable requests are let through.
+
+    def __init__(self):
+        self.app = None
+        self.enabled = True
+        self.policies = {}
+        self.storage = None
+        self._next_prune = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('RATE_LIMIT_ENABLED', True)
+        overrides = app.config.get('RATE_LIMITS', {})
+        # A configured blueprint policy also replaces the defaults for its endpoints.
+        self.policies = {name: limits for name, limits in DEFAULT_POLICIES.items()
+                         if name.split('.', 1)[0] not in overrides}
+        self.policies.update(overrides)
+        # Tests get fresh per-app buckets unless they ask otherwise.
+        backend = app.config.get('RATE_LIMIT_STORAGE', 'memory' if app.testing else 'sqlite')
+        if backend == 'sqlite':
+            path = app.config.get('RATE_LIMIT_SQLITE_PATH') or os.path.join(DEFAULT_SQLITE_DIR, 'rate-limits.sqlite3')
+            self.storage = SQLiteBuckets(path, app.config.get('RATE_LIMIT_LOCK_TIMEOUT', 0.1))
+        else:
+            self.storage = MemoryBuckets()
+        self._next_prune = 0
+        app.extensions['rate_limiter'] = self
+        if self.enabled:
+            app.before_request(self._before_request)
+
+    def limits_for(self, endpoint, method):
+        if not endpoint:
+            return None, []
+        name = endpoint if endpoint in self.policies else endpoint.rsplit('.', 1)[0]
+        limits = [limit for limit in self.policies.get(name, ())
+                  if 'methods' not in limit or method in limit['methods']]
+        return name, limits
+
+    def check(self, endpoint, method, remote_addr, identity, view_args):
+        # Returns None if the request may proceed, or the seconds until it may be retried.
+        policy, limits = self.limits_for(endpoint, method)
+        if not limits:
+            return None
+        now = time.time()
+        buckets = [(_bucket_key(policy, limit['key'], remote_addr, identity, view_args),
+                    limit.get('burst', limit['rate']), limit['rate'] / limit['per'])
+                   for limit in limits]
+        try:
+            retry_after = self.storage.take(buckets, now)
+        except sqlite3.Error as e:
+            self._logger().warning(f'Rate limit store unavailable, allowing request: {str(e)}')
+            instrumentation.record_rate_limit(policy, 'error')
+            return None
+        instrumentation.record_rate_limit(policy, 'allowed' if retry_after is None else 'limited')
+        self._maybe_prune(now)
+        return retry_after
+
+    def _before_request(self):
+        policy, limits = self.limits_for(request.endpoint, request.method)
+        if not limits:
+            return None
+        identity = None
+        if any(limit['key'] != 'ip' for limit in limits):
+            identity = _request_identity()
+        retry_after = self.check(request.endpoint, request.method, request.remote_addr, identity, request.view_args)
+        if retry_after is None:
+            return None
+        return too_many_requests(retry_after)
+
+    def _maybe_prune(self, now):
+        if now < self._next_prune:
+            return
+        self._next_prune = now + PRUNE_INTERVAL
+        # A bucket untouched for this long has refilled completely.
+        longest = max((limit['per'] * limit.get('burst', limit['rate']) / limit['rate']
+                       for limits in self.policies.values() for limit in limits), default=0)
+        try:
+            self.storage.prune(now - longest)
+        except sqlite3.Error as e:
+            self._logger().warning(f'Could not prune rate limit buckets: {str(e)}')
+
+    def _logger(self):
+        return current_app.logger if has_app_context() else self.app.logger
+
+
+rate_limiter = RateLimiter()
+
+
+def _bucket_key(policy, kind, remote_addr, identity, view_args):
+    if kind == 'device' and identity is not None:
+        return f'{policy}:device:{identity}:{(view_args or {}).get("device_id")}'
+    if kind in ('user', 'device') and identity is not None:
+        return f'{policy}:user:{identity}'
+    return f'{policy}:ip:{remote_addr}'
+
+
+def _request_identity():
+    # The view's own @jwt_required rejects bad tokens; here they just mean
+    # the request is counted against its address.
+    try:
+        verify_jwt_in_request(optional=True, refresh=request.endpoint == 'auth.refresh')
+        return get_jwt_identity()
+    except Exception:
+        return None
+
+
+def too_many_requests(retry_after):
+    return jsonify({'message': 'Too many requests'}), 429, {'Retry-After': str(max(1, math.ceil(retry_after)))}
@@ -0,0 +1,102 @@
+import atexit
+import os
+import threading
+import time
+from flask import has_app_context
+
+
+class WriteBehindBuffer:
+    # Base class for in-memory buffers that absorb hot writes and apply them to
+    # the database in batches. Subclasses keep their own pending state and
+    # implement _take(), _restore() and flush().
+
+    name = None
+    config_prefix = None
+    default_interval = 5
+    default_max_pending = 10000
+
+    def __init__(self):
+        self.app = None
+        self.interval = self.default_interval
+        self.max_pending = self.default_max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._pending_count = 0
+        self._reset()
+        atexit.register(self._flush_at_exit)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get(f'{self.config_prefix}_FLUSH_INTERVAL', self.default_interval)
+        self.max_pending = app.config.get(f'{self.config_prefix}_MAX_PENDING', self.default_max_pending)
+        app.extensions[self.name] = self
+
+    def _reset(self):
+        raise NotImplementedError
+
+    def _take(self):
+        raise NotImplementedError
+
+    def _restore(self, batch):
+        raise NotImplementedError
+
+    def flush(self, batch):
+        raise NotImplementedError
+
+    def added(self):
+        # Called by subclasses (outside the lock) after buffering new items and
+        # bumping _pending_count.
+        self._ensure_thread()
+        if self._pending_count >= self.max_pending:
+            self.flush_now()
+
+    def flush_now(self):
+        with self._flush_lock:
+            with self._lock:
+                batch = self._take()
+                self._pending_count = 0
+            if not batch:
+                return 0
+            try:
+                if has_app_context():
+                    return self.flush(batch)
+                with self.app.app_context():
+                    return self.flush(batch)
+            except Exception as e:
+                self._restore(batch)
+                if self.app:
+                    self.app.logger.error(f'Error flushing {self.name}: {str(e)}')
+                raise
+
+    def _ensure_thread(self):
+        if not self.interval or self.app is None:
+            return
+        # Threads do not survive fork(), so a pre-fork master and each worker
+        # get their own flusher.
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread_pid == pid and self._thread.is_alive():
+                return
+            self._thread_pid = pid
+            self._thread = threading.Thread(target=self._run, name=f'{self.name}-flusher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush_now()
+            except Exception:
+                pass
+
+    def _flush_at_exit(self):
+        if self.app is None:
+            return
+        try:
+            self.flush_now()
+        except Exception:
+            pass
@@ -0,0 +1,19 @@
+import os
+from app import create_app, preload_app
+
+# WSGI entry point for forking servers, e.g.
+#
+#     PRELOAD_APP=1 WEB_CONCURRENCY=4 gunicorn --preload --bind 0.0.0.0:5000 wsgi:app
+#
+# With --preload the master imports and builds the app once and workers
+# fork from it, so a new or respawned worker starts serving without
+# repeating that work; PRELOAD_APP=1 also loads what create_app defers.
+# Without it each worker builds the app itself and only pays for what it
+# uses, e.g. Stripe is loaded on the first Stripe call. Either way the
+# background threads and process pools start lazily inside each worker;
+# WEB_CONCURRENCY also sizes each worker's share of the bcrypt pool.
+# /push/stream answers 404 here unless PUSH_STREAM_WSGI=1 (only with
+# threaded or gevent workers); asgi.py serves it without that cost.
+app = create_app(os.environ.get('FLASK_CONFIG', 'production'), {'FAST_START': True})
+if os.environ.get('PRELOAD_APP') == '1':
+    preload_app(app)
@@ -1,4 +1,4 @@
-import { decrypt } from './utils/crypto-utils.js';
+import { encrypt, decrypt } from './utils/crypto-utils.js';
 const API_URL = 'http://localhost:5000';
 
 async function getAuthenticatedRequest(endpoint, options = {}) {
@@ -48,7 +48,19 @@ async function getAuthenticatedRequest(endpoint, options = {}) {
     }
 }
 
-  async function refreshAccessToken() {
+  // Refresh tokens are single-use, so concurrent 401s share one refresh call.
+  let refreshInFlight = null;
+
+  function refreshAccessToken() {
+    if (!refreshInFlight) {
+      refreshInFlight = doRefreshAccessToken().finally(() => {
+        refreshInFlight = null;
+      });
+    }
+    return refreshInFlight;
+  }
+
+  async function doRefreshAccessToken() {
     try {
       const { refreshToken } = await new Promise((resolve) => 
         chrome.storage.local.get(['refreshToken'], resolve)
@@ -61,9 +73,8 @@ async function getAuthenticatedRequest(endpoint, options = {}) {
       const response = await fetch(`${API_URL}/auth/refresh`, {
         method: 'POST',
         headers: {
-          'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({ refresh_token: refreshToken })
+          'Authorization': `Bearer ${decrypt(refreshToken)}`
+        }
       });
   
       if (!response.ok) {
@@ -83,8 +94,8 @@ async function getAuthenticatedRequest(endpoint, options = {}) {
     const expiryTime = new Date(Date.now() + 3600 * 1000).toISOString(); // 1 hour from now
     await new Promise((resolve) => 
       chrome.storage.local.set({
-        accessToken: accessToken,
-        refreshToken: refreshToken,
+        accessToken: encrypt(accessToken),
+        refreshToken: encrypt(refreshToken),
         tokenExpiry: expiryTime
       }, resolve)
     );
@@ -121,6 +132,29 @@ async function getAuthenticatedRequest(endpoint, options = {}) {
     return response.json();
   }
 
+  export async function sendMetricEvents(events) {
+    const response = await getAuthenticatedRequest('/user/metrics/events', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json'
+      },
+      body: JSON.stringify({ events })
+    });
+    if (!response.ok) {
+      throw new Error('Failed to send metric events');
+    }
+    return response.json();
+  }
+
+  export async function getSessionBootstrap() {
+    const response = await getAuthenticatedRequest('/session/bootstrap');
+    if (!response.ok) {
+      const errorText = await response.text();
+      throw new Error(`Failed to bootstrap session: ${response.status} ${errorText}`);
+    }
+    return response.json();
+  }
+
   export async function getUserMetrics() {
     const response = await getAuthenticatedRequest('/user/metrics');
     if (!response.ok) {
@@ -245,12 +279,12 @@ export async function login(username, password) {
 export async function refreshToken(refreshToken) {
     try {
         console.log('Sending refresh token request...');
+        // Refresh tokens are single-use: the server rotates them on every call.
         const response = await fetch(`${API_URL}/auth/refresh`, {
             method: 'POST',
             headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({ refresh_token: refreshToken })
+                'Authorization': `Bearer ${refreshToken}`
+            }
         });
         
         console.log('Refresh token response status:', response.status);
@@ -258,7 +292,9 @@ export async function refreshToken(refreshToken) {
         if (!response.ok) {
             const errorData = await response.json();
             console.error('Refresh token error:', errorData);
-            throw new Error(`Failed to refresh token: ${errorData.message || response.statusText}`);
+            const error = new Error(`Failed to refresh token: ${errorData.message || response.statusText}`);
+            error.status = response.status;
+            throw error;
         }
         
         const responseData = await response.json();
@@ -275,6 +311,17 @@ export async function refreshToken(refreshToken) {
     }
 }
 
+export async function logout() {
+  // Revokes this login's access and refresh tokens on the server.
+  const response = await getAuthenticatedRequest('/auth/logout', {
+    method: 'POST'
+  });
+  if (!response.ok) {
+    throw new Error('Failed to log out');
+  }
+  return response.json();
+}
+
 export async function createCheckoutSession(plan) {
   const response = await getAuthenticatedRequest('/subscription/create-checkout-session', {
     method: 'POST',
@@ -297,4 +344,80 @@ export async function cancelSubscription() {
     throw new Error('Failed to cancel subscription');
   }
   return response.json();
-}
\ No newline at end of file
+}
+export async function openPushStream(onEvent, signal) {
+  // Reads /push/stream until the server ends it (token expiry), the signal
+  // aborts it or the connection drops. fetch() rather than EventSource,
+  // which service workers lack and which cannot send the Authorization
+  // header. Resolves with the server's reconnect hint in milliseconds.
+  const response = await getAuthenticatedRequest('/push/stream', {
+    headers: { 'Accept': 'text/event-stream' },
+    signal
+  });
+  if (!response.ok) {
+    const error = new Error(`Failed to open push stream: ${response.status}`);
+    error.status = response.status;
+    error.retryAfter = Number(response.headers.get('Retry-After')) || null;
+    throw error;
+  }
+
+  const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+  let buffer = '';
+  let retry = null;
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      return retry;
+    }
+    buffer += value;
+    let end;
+    while ((end = buffer.indexOf('\n\n')) !== -1) {
+      const block = buffer.slice(0, end);
+      buffer = buffer.slice(end + 2);
+      let event = 'message';
+      const data = [];
+      for (const line of block.split('\n')) {
+        if (line.startsWith('event: ')) {
+          event = line.slice(7);
+        } else if (line.startsWith('data: ')) {
+          data.push(line.slice(6));
+        } else if (line.startsWith('retry: ')) {
+          retry = Number(line.slice(7));
+        }
+      }
+      if (data.length) {
+        onEvent(event, JSON.parse(data.join('\n')));
+      }
+    }
+  }
+}
+
+// Ad-detection rules are public and served with long-lived cache headers,
+// so these requests carry no token.
+export async function getRulesPointer() {
+  const response = await fetch(`${API_URL}/rules/latest`);
+  if (!response.ok) {
+    throw new Error(`Failed to fetch rules version: ${response.status}`);
+  }
+  return response.json();
+}
+
+export async function getRulesBundle(path) {
+  const response = await fetch(`${API_URL}${path}`);
+  if (!response.ok) {
+    throw new Error(`Failed to fetch rules bundle: ${response.status}`);
+  }
+  return response.json();
+}
+
+export async function getRulesDelta(fromVersion, version) {
+  // Resolves with null when the server no longer has fromVersion.
+  const response = await fetch(`${API_URL}/rules/delta/${fromVersion}/${version}`);
+  if (response.status === 404) {
+    return null;
+  }
+  if (!response.ok) {
+    throw new Error(`Failed to fetch rules delta: ${response.status}`);
+  }
+  return response.json();
+}
@@ -1,9 +1,14 @@
 import { encrypt, decrypt } from './utils/crypto-utils.js';
 import { 
-    getUserInfo, 
+    getRulesBundle,
+    getRulesDelta,
+    getRulesPointer,
+    getSessionBootstrap,
     getSubscriptionStatus, 
+    logout,
+    openPushStream,
     refreshToken,
-    updateUserMetrics
+    sendMetricEvents
 } from './api.js';
 
 const SUPPORTED_SERVICES = [
@@ -15,7 +20,14 @@ const SUPPORTED_SERVICES = [
     { domain: 'twitch.tv', name: 'Twitch' }
 ];
 
+const METRIC_EVENTS_BATCH_SIZE = 500;
+const PUSH_RECONNECT_MIN = 1000;
+const PUSH_RECONNECT_MAX = 5 * 60 * 1000;
+const RULES_ALARM = 'refreshAdRules';
+const RULES_REFRESH_MINUTES = 6 * 60;
+
 let refreshTokenTimeout;
+let pushController = null;
 
 chrome.runtime.onInstalled.addListener(() => {
     console.log('Ad Muter extension installed');
@@ -24,6 +36,8 @@ chrome.runtime.onInstalled.addListener(() => {
     });
     initializeMetrics();
     checkAuthStatus();
+    refreshAdRules();
+    chrome.alarms.create(RULES_ALARM, { periodInMinutes: RULES_REFRESH_MINUTES });
 });
 
 function initializeMetrics() {
@@ -41,16 +55,16 @@ async function checkAuthStatus() {
         const token = await getAccessToken();
         if (token) {
             try {
-                const userData = await getUserInfo();
-                console.log('User authenticated:', userData);
+                // One request for profile, subscription, devices and metrics
+                const session = await getSessionBootstrap();
+                console.log('User authenticated:', session.user);
                 scheduleTokenRefresh();
-                await checkSubscriptionStatus();
-                // Fetch and set the metrics from the server
-                const metrics = await getUserMetrics();
+                storeSubscriptionStatus(session.subscription);
                 chrome.storage.sync.set({ 
-                    timeMuted: metrics.total_muted_time, 
-                    adsMuted: metrics.total_ads_muted 
+                    timeMuted: session.metrics.total_muted_time, 
+                    adsMuted: session.metrics.total_ads_muted 
                 });
+                startPushStream();
             } catch (error) {
                 console.error('Error fetching user info:', error);
                 clearTokens();
@@ -75,21 +89,25 @@ function scheduleTokenRefresh() {
     });
 }
 
+function storeSubscriptionStatus(subscriptionData) {
+    chrome.storage.sync.set({ 
+        subscriptionStatus: subscriptionData.status,
+        subscriptionPlan: subscriptionData.plan,
+        deviceLimit: subscriptionData.device_limit,
+        subscriptionEnd: subscriptionData.current_period_end
+    }, () => {
+        console.log('Subscription status updated:', subscriptionData.status);
+        chrome.runtime.sendMessage({ action: 'subscriptionUpdated' });
+    });
+}
+
 async function checkSubscriptionStatus() {
     try {
         const subscriptionData = await getSubscriptionStatus();
         if (!subscriptionData) {
             throw new Error('Invalid response from subscription status endpoint');
         }
-        chrome.storage.sync.set({ 
-            subscriptionStatus: subscriptionData.status,
-            subscriptionPlan: subscriptionData.plan,
-            deviceLimit: subscriptionData.device_limit,
-            subscriptionEnd: subscriptionData.current_period_end
-        }, () => {
-            console.log('Subscription status updated:', subscriptionData.status);
-            chrome.runtime.sendMessage({ action: 'subscriptionUpdated' });
-        });
+        storeSubscriptionStatus(subscriptionData);
         return subscriptionData.status === 'active';
     } catch (error) {
         console.error('Error checking subscription status:', error);
@@ -97,13 +115,137 @@ async function checkSubscriptionStatus() {
     }
 }
 
+// Subscription and device changes arrive on one long-lived /push/stream
+// request instead of periodic polls. Its heartbeats also keep the service
+// worker alive while the user is logged in. The stream ends when the access
+// token expires; reconnecting refreshes it.
+function startPushStream() {
+    if (pushController) {
+        return;
+    }
+    const controller = new AbortController();
+    pushController = controller;
+    runPushStream(controller).finally(() => {
+        if (pushController === controller) {
+            pushController = null;
+        }
+    });
+}
+
+function stopPushStream() {
+    if (pushController) {
+        pushController.abort();
+        pushController = null;
+    }
+}
+
+async function runPushStream(controller) {
+    let backoff = PUSH_RECONNECT_MIN;
+    while (!controller.signal.aborted) {
+        let delay;
+        try {
+            delay = (await openPushStream(handlePushEvent, controller.signal)) || PUSH_RECONNECT_MIN;
+            backoff = PUSH_RECONNECT_MIN;
+        } catch (error) {
+            if (controller.signal.aborted || !(await getAccessToken())) {
+                return;
+            }
+            if (error.status === 404) {
+                // This deployment does not serve streams (sync WSGI workers).
+                return;
+            }
+            console.error('Push stream error:', error);
+            delay = error.retryAfter ? error.retryAfter * 1000 : backoff;
+            backoff = Math.min(backoff * 2, PUSH_RECONNECT_MAX);
+        }
+        // Jitter, so a server restart is not followed by every client at once.
+        await new Promise((resolve) => setTimeout(resolve, delay * (1 + Math.random() / 2)));
+    }
+}
+
+function handlePushEvent(event, data) {
+    if (event === 'subscription') {
+        storeSubscriptionStatus(data);
+    } else if (event === 'devices') {
+        chrome.storage.sync.set({ deviceLimit: data.device_limit, deviceCount: data.device_ids.length });
+    }
+}
+
+// The content scripts read their selectors from storage.local.adRules and
+// fall back to built-in ones until the first download. Bundles are
+// immutable and named by version, so an unchanged version costs one small
+// request, and a changed one only the services that differ.
+async function refreshAdRules() {
+    try {
+        const pointer = await getRulesPointer();
+        const { adRules } = await new Promise((resolve) =>
+            chrome.storage.local.get(['adRules'], resolve)
+        );
+        if (adRules && adRules.version === pointer.version) {
+            return;
+        }
+
+        let services = null;
+        if (adRules) {
+            const delta = await getRulesDelta(adRules.version, pointer.version);
+            if (delta) {
+                services = { ...adRules.services, ...delta.services };
+                delta.removed.forEach((name) => delete services[name]);
+            }
+        }
+        if (!services) {
+            services = (await getRulesBundle(pointer.bundle)).services;
+        }
+        await new Promise((resolve) =>
+            chrome.storage.local.set({ adRules: { version: pointer.version, services } }, resolve)
+        );
+        console.log('Ad rules updated to version', pointer.version);
+    } catch (error) {
+        console.error('Error refreshing ad rules:', error);
+    }
+}
+
+chrome.alarms.onAlarm.addListener((alarm) => {
+    if (alarm.name === RULES_ALARM) {
+        refreshAdRules();
+    }
+});
+
+function queueMetricEvent(event) {
+    return new Promise((resolve) => {
+        chrome.storage.local.get(['pendingMetricEvents'], (result) => {
+            const pending = result.pendingMetricEvents || [];
+            pending.push(event);
+            chrome.storage.local.set({ pendingMetricEvents: pending }, resolve);
+        });
+    });
+}
+
 async function sendMetricsToServer() {
     try {
-        const { timeMuted, adsMuted } = await new Promise((resolve) => 
-            chrome.storage.sync.get(['timeMuted', 'adsMuted'], resolve)
+        const { pendingMetricEvents } = await new Promise((resolve) => 
+            chrome.storage.local.get(['pendingMetricEvents'], resolve)
         );
-        
-        await updateUserMetrics({ timeMuted, adsMuted });
+        const pending = pendingMetricEvents || [];
+        if (pending.length === 0) {
+            return;
+        }
+
+        // Each event carries its own id, so a batch that is retried after a
+        // timeout is only counted once by the server.
+        const sentIds = new Set();
+        for (let i = 0; i < pending.length; i += METRIC_EVENTS_BATCH_SIZE) {
+            const batch = pending.slice(i, i + METRIC_EVENTS_BATCH_SIZE);
+            await sendMetricEvents(batch);
+            batch.forEach((event) => sentIds.add(event.id));
+        }
+
+        await new Promise((resolve) => {
+            chrome.storage.local.get(['pendingMetricEvents'], (result) => {
+                const remaining = (result.pendingMetricEvents || []).filter((event) => !sentIds.has(event.id));
+                chrome.storage.local.set({ pendingMetricEvents: remaining }, resolve);
+            });
+        });
         console.log('Metrics sent to server successfully');
     } catch (error) {
         console.error('Error sending metrics to server:', error);
@@ -112,7 +254,19 @@ async function sendMetricsToServer() {
 
 setInterval(sendMetricsToServer, 5 * 60 * 1000);
 
-async function refreshAccessToken() {
+// Refresh tokens are single-use, so overlapping callers share one refresh.
+let refreshInFlight = null;
+
+function refreshAccessToken() {
+    if (!refreshInFlight) {
+        refreshInFlight = doRefreshAccessToken().finally(() => {
+            refreshInFlight = null;
+        });
+    }
+    return refreshInFlight;
+}
+
+async function doRefreshAccessToken() {
     try {
         const { refreshToken: encryptedRefreshToken } = await new Promise((resolve) => 
             chrome.storage.local.get(['refreshToken'], resolve)
@@ -136,6 +290,11 @@ async function refreshAccessToken() {
         return newTokens.access_token;
     } catch (error) {
         console.error('Error refreshing token:', error);
+        if (error.status === 409) {
+            // Another context rotated this token a moment ago; its new pair
+            // is being stored, so keep the session.
+            return null;
+        }
         clearTokens();
         notifyUserReauthentication();
         return null;
@@ -158,6 +317,7 @@ async function storeTokens(accessToken, refreshToken) {
 }
 
 function clearTokens() {
+    stopPushStream();
     chrome.storage.local.remove(['accessToken', 'refreshToken', 'tokenExpiry'], () => {
         console.log('Tokens cleared due to refresh failure');
     });
@@ -253,6 +413,15 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
         });
         return true;
     } else if (message.action === 'updateMetrics') {
+        const service = sender.tab && sender.tab.url
+            ? SUPPORTED_SERVICES.find(s => sender.tab.url.includes(s.domain))
+            : null;
+        queueMetricEvent({
+            id: crypto.randomUUID(),
+            duration: message.muteDuration,
+            service: service ? service.name : 'Other',
+            timestamp: Date.now()
+        });
         chrome.storage.sync.get(['timeMuted', 'adsMuted'], (result) => {
             const newTimeMuted = (result.timeMuted || 0) + message.muteDuration;
             const newAdsMuted = (result.adsMuted || 0) + 1;
@@ -263,7 +432,10 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
         });
         return true;
     } else if (message.action === 'logout') {
-        sendMetricsToServer().then(() => {
+        sendMetricsToServer()
+            // Revoke the tokens server-side; clear them locally even if that fails.
+            .then(() => logout().catch((error) => console.error('Error revoking tokens:', error)))
+            .then(() => {
             clearTokens();
             sendResponse({ success: true });
         }).catch((error) => {
@@ -317,4 +489,17 @@ function isTabReady(tabId) {
     });
 }
 
+chrome.runtime.onStartup.addListener(() => {
+    checkAuthStatus();
+    refreshAdRules();
+    chrome.alarms.create(RULES_ALARM, { periodInMinutes: RULES_REFRESH_MINUTES });
+});
+
+chrome.storage.onChanged.addListener((changes, areaName) => {
+    // The popup stores the tokens on login.
+    if (areaName === 'local' && changes.accessToken && changes.accessToken.newValue) {
+        startPushStream();
+    }
+});
+
 console.log('Background script loaded');
\ No newline at end of file
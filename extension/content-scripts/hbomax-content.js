@@ -6,6 +6,57 @@ let adStartTime = 0;
 let consecutiveAdChecks = 0;
 const AD_CHECK_THRESHOLD = 3;
 
+// Built-in rules, used until background.js has downloaded the backend's
+// rules bundle into storage.local.adRules.
+const DEFAULT_AD_RULES = {
+    player: '.video-player',
+    ad_markers: [
+        [
+            '.ad-container',
+            '.ad-overlay',
+            '.ad-banner',
+            '[data-testid="ad-overlay"]',
+            '[data-testid="ad-banner"]'
+        ]
+    ],
+    heuristics: {
+        consecutive_checks: 3
+    }
+};
+let adRules = DEFAULT_AD_RULES;
+
+chrome.storage.local.get(['adRules'], (result) => applyAdRules(result.adRules));
+chrome.storage.onChanged.addListener((changes, areaName) => {
+    if (areaName === 'local' && changes.adRules) {
+        applyAdRules(changes.adRules.newValue);
+    }
+});
+
+function applyAdRules(bundle) {
+    adRules = (bundle && bundle.services && bundle.services.hbomax) || DEFAULT_AD_RULES;
+}
+
+function findFirst(selectors) {
+    for (const selector of selectors || []) {
+        try {
+            const element = document.querySelector(selector);
+            if (element) return element;
+        } catch (error) {
+            // Not a selector this browser understands; try the next one.
+        }
+    }
+    return null;
+}
+
+function adMarkersPresent() {
+    return adRules.ad_markers.every((group) => findFirst(group));
+}
+
+function heuristic(name, fallback) {
+    const value = adRules.heuristics && adRules.heuristics[name];
+    return typeof value === 'number' ? value : fallback;
+}
+
 chrome.storage.sync.get(['adMuterEnabled'], (result) => {
     isEnabled = result.adMuterEnabled !== undefined ? result.adMuterEnabled : true;
     if (isEnabled) {
@@ -23,13 +74,13 @@ function checkForHBOMaxAds() {
 
         if (adDetected) {
             consecutiveAdChecks++;
-            if (consecutiveAdChecks >= AD_CHECK_THRESHOLD && !isAdPlaying) {
+            if (consecutiveAdChecks >= heuristic('consecutive_checks', AD_CHECK_THRESHOLD) && !isAdPlaying) {
                 isAdPlaying = true;
                 adStartTime = Date.now();
                 handleAdStart();
             }
         } else {
-            if (consecutiveAdChecks >= AD_CHECK_THRESHOLD && isAdPlaying) {
+            if (consecutiveAdChecks >= heuristic('consecutive_checks', AD_CHECK_THRESHOLD) && isAdPlaying) {
                 isAdPlaying = false;
                 handleAdEnd();
             }
@@ -44,11 +95,7 @@ function checkForHBOMaxAds() {
 }
 
 function checkVisualAdMarkers() {
-    const adMarkers = [
-        '.ad-container', '.ad-overlay', '.ad-banner',
-        '[data-testid="ad-overlay"]', '[data-testid="ad-banner"]'
-    ];
-    return adMarkers.some(marker => document.querySelector(marker));
+    return adMarkersPresent();
 }
 
 function checkPlayerStateChanges() {
@@ -127,7 +174,7 @@ function initAdDetection() {
     const config = { childList: true, subtree: true, attributes: true, characterData: true };
 
     function observePlayer() {
-        const playerContainer = document.querySelector('.video-player') || document.body;
+        const playerContainer = findFirst([adRules.player]) || document.body;
         adObserver.observe(playerContainer, config);
         console.log('Observing HBO Max player container');
         checkForHBOMaxAds(); // Initial check
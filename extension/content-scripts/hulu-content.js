@@ -8,6 +8,63 @@ let lastKnownVideoDuration = 0;
 let consecutiveAdChecks = 0;
 const AD_CHECK_THRESHOLD = 3;
 
+// Built-in rules, used until background.js has downloaded the backend's
+// rules bundle into storage.local.adRules.
+const DEFAULT_AD_RULES = {
+    player: '#content-video-player',
+    ad_markers: [
+        [
+            '.ad-container',
+            '.AdUnitView',
+            '.ad-overlay',
+            '.ad-progress-bar',
+            '[data-automation-id="ad-unit"]',
+            '[data-automationid="player-ad-notice"]',
+            '.AdBanner',
+            '.AdTag',
+            '[data-ad-break-type]',
+            '[data-ad-break-start]'
+        ]
+    ],
+    heuristics: {
+        consecutive_checks: 3,
+        time_jump_seconds: 5
+    }
+};
+let adRules = DEFAULT_AD_RULES;
+
+chrome.storage.local.get(['adRules'], (result) => applyAdRules(result.adRules));
+chrome.storage.onChanged.addListener((changes, areaName) => {
+    if (areaName === 'local' && changes.adRules) {
+        applyAdRules(changes.adRules.newValue);
+    }
+});
+
+function applyAdRules(bundle) {
+    adRules = (bundle && bundle.services && bundle.services.hulu) || DEFAULT_AD_RULES;
+}
+
+function findFirst(selectors) {
+    for (const selector of selectors || []) {
+        try {
+            const element = document.querySelector(selector);
+            if (element) return element;
+        } catch (error) {
+            // Not a selector this browser understands; try the next one.
+        }
+    }
+    return null;
+}
+
+function adMarkersPresent() {
+    return adRules.ad_markers.every((group) => findFirst(group));
+}
+
+function heuristic(name, fallback) {
+    const value = adRules.heuristics && adRules.heuristics[name];
+    return typeof value === 'number' ? value : fallback;
+}
+
 chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
     if (request.action === 'updateAdMuterState') {
         isAdMuterEnabled = request.enabled;
@@ -40,13 +97,13 @@ function checkForHuluAds() {
 
         if (adDetected) {
             consecutiveAdChecks++;
-            if (consecutiveAdChecks >= AD_CHECK_THRESHOLD && !isAdPlaying) {
+            if (consecutiveAdChecks >= heuristic('consecutive_checks', AD_CHECK_THRESHOLD) && !isAdPlaying) {
                 isAdPlaying = true;
                 adStartTime = Date.now();
                 handleAdStart();
             }
         } else {
-            if (consecutiveAdChecks >= AD_CHECK_THRESHOLD && isAdPlaying) {
+            if (consecutiveAdChecks >= heuristic('consecutive_checks', AD_CHECK_THRESHOLD) && isAdPlaying) {
                 isAdPlaying = false;
                 handleAdEnd();
             }
@@ -61,12 +118,7 @@ function checkForHuluAds() {
 }
 
 function checkVisualAdMarkers() {
-    const adMarkers = [
-        '.ad-container', '.AdUnitView', '.ad-overlay', '.ad-progress-bar',
-        '[data-automation-id="ad-unit"]', '[data-automationid="player-ad-notice"]',
-        '.AdBanner', '.AdTag', '[data-ad-break-type]', '[data-ad-break-start]'
-    ];
-    return adMarkers.some(marker => document.querySelector(marker));
+    return adMarkersPresent();
 }
 
 function checkPlayerStateChanges() {
@@ -76,9 +128,10 @@ function checkPlayerStateChanges() {
     const currentTime = videoElement.currentTime;
     const duration = videoElement.duration;
 
-    const durationChanged = Math.abs(duration - lastKnownVideoDuration) > 5;
-    const unexpectedTimeJump = Math.abs(currentTime - lastKnownVideoTime) > 5 && 
-                               Math.abs(currentTime - lastKnownVideoTime) < duration - 5;
+    const jump = heuristic('time_jump_seconds', 5);
+    const durationChanged = Math.abs(duration - lastKnownVideoDuration) > jump;
+    const unexpectedTimeJump = Math.abs(currentTime - lastKnownVideoTime) > jump && 
+                               Math.abs(currentTime - lastKnownVideoTime) < duration - jump;
 
     lastKnownVideoTime = currentTime;
     lastKnownVideoDuration = duration;
@@ -162,7 +215,7 @@ function initAdDetection() {
     const config = { childList: true, subtree: true, attributes: true, characterData: true };
 
     function observePlayer() {
-        const playerContainer = document.querySelector('#content-video-player') || document.body;
+        const playerContainer = findFirst([adRules.player]) || document.body;
         if (playerContainer) {
             console.log('Player container found, initializing ad detection');
             adObserver.observe(playerContainer, config);
@@ -6,6 +6,44 @@ let adStartTime = 0;
 let adDuration = 0;
 const AD_CHECK_INTERVAL = 500;
 
+// Built-in rules, used until background.js has downloaded the backend's
+// rules bundle into storage.local.adRules.
+const DEFAULT_AD_RULES = {
+    ad_markers: [
+        ['.countdown__foreground-ring'],
+        ['.countdown-container.ad-countdown__container']
+    ],
+    remaining_time: '.countdown__remaining-time'
+};
+let adRules = DEFAULT_AD_RULES;
+
+chrome.storage.local.get(['adRules'], (result) => applyAdRules(result.adRules));
+chrome.storage.onChanged.addListener((changes, areaName) => {
+    if (areaName === 'local' && changes.adRules) {
+        applyAdRules(changes.adRules.newValue);
+    }
+});
+
+function applyAdRules(bundle) {
+    adRules = (bundle && bundle.services && bundle.services.peacock) || DEFAULT_AD_RULES;
+}
+
+function findFirst(selectors) {
+    for (const selector of selectors || []) {
+        try {
+            const element = document.querySelector(selector);
+            if (element) return element;
+        } catch (error) {
+            // Not a selector this browser understands; try the next one.
+        }
+    }
+    return null;
+}
+
+function adMarkersPresent() {
+    return adRules.ad_markers.every((group) => findFirst(group));
+}
+
 chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
     if (request.action === 'updateAdMuterState') {
         isAdMuterEnabled = request.enabled;
@@ -30,10 +68,7 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
 function checkForPeacockAds() {
     if (!isAdMuterEnabled) return;
 
-    const adCountdown = document.querySelector('.countdown__foreground-ring');
-    const adCountdownContainer = document.querySelector('.countdown-container.ad-countdown__container');
-
-    if (adCountdown && adCountdownContainer) {
+    if (adMarkersPresent()) {
         if (!isAdPlaying) {
             isAdPlaying = true;
             adStartTime = Date.now();
@@ -41,7 +76,7 @@ function checkForPeacockAds() {
         }
 
         // Try to get ad duration
-        const remainingTimeElement = adCountdownContainer.querySelector('.countdown__remaining-time');
+        const remainingTimeElement = findFirst([adRules.remaining_time]);
         if (remainingTimeElement) {
             const remainingTime = parseInt(remainingTimeElement.textContent);
             if (!isNaN(remainingTime)) {
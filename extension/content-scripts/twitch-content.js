@@ -5,6 +5,47 @@ let isAdPlaying = false;
 let adStartTime = 0;
 const AD_CHECK_INTERVAL = 500;
 
+// Built-in rules, used until background.js has downloaded the backend's
+// rules bundle into storage.local.adRules.
+const DEFAULT_AD_RULES = {
+    player: '.video-player',
+    ad_markers: [
+        [
+            '[aria-label="Ad"]',
+            '[data-a-target="video-ad-label"]',
+            '.video-player__overlay[data-a-target="player-overlay-ad-alert"]'
+        ]
+    ]
+};
+let adRules = DEFAULT_AD_RULES;
+
+chrome.storage.local.get(['adRules'], (result) => applyAdRules(result.adRules));
+chrome.storage.onChanged.addListener((changes, areaName) => {
+    if (areaName === 'local' && changes.adRules) {
+        applyAdRules(changes.adRules.newValue);
+    }
+});
+
+function applyAdRules(bundle) {
+    adRules = (bundle && bundle.services && bundle.services.twitch) || DEFAULT_AD_RULES;
+}
+
+function findFirst(selectors) {
+    for (const selector of selectors || []) {
+        try {
+            const element = document.querySelector(selector);
+            if (element) return element;
+        } catch (error) {
+            // Not a selector this browser understands; try the next one.
+        }
+    }
+    return null;
+}
+
+function adMarkersPresent() {
+    return adRules.ad_markers.every((group) => findFirst(group));
+}
+
 chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
     if (request.action === 'updateAdMuterState') {
         isAdMuterEnabled = request.enabled;
@@ -44,12 +85,7 @@ function checkForTwitchAds() {
 }
 
 function checkVisualAdMarkers() {
-    const adMarkers = [
-        '[aria-label="Ad"]',
-        '[data-a-target="video-ad-label"]',
-        '.video-player__overlay[data-a-target="player-overlay-ad-alert"]'
-    ];
-    return adMarkers.some(marker => document.querySelector(marker));
+    return adMarkersPresent();
 }
 
 function handleAdStart() {
@@ -117,7 +153,7 @@ function initAdDetection() {
     });
     const config = { childList: true, subtree: true, attributes: true, characterData: true };
 
-    const playerContainer = document.querySelector('.video-player') || document.body;
+    const playerContainer = findFirst([adRules.player]) || document.body;
     adObserver.observe(playerContainer, config);
     console.log('Twitch ad detection initialized');
 
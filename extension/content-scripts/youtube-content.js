@@ -4,6 +4,60 @@ let isMuted = false;
 let isAdPlaying = false;
 let adStartTime = 0;
 
+// Built-in rules, used until background.js has downloaded the backend's
+// rules bundle into storage.local.adRules.
+const DEFAULT_AD_RULES = {
+    player: '#player-container',
+    ad_markers: [
+        ['.ytp-ad-player-overlay', '.video-ads.ytp-ad-module'],
+        [
+            '.ytp-ad-skip-button',
+            '.videoAdUiSkipButton',
+            '[id^="skip-button"]',
+            '.ytp-ad-skip-button-modern',
+            '.ytp-ad-text',
+            '.videoAdUiAttribution',
+            '.ytp-ad-preview-text',
+            '.ad-showing',
+            '.ytp-ad-overlay-container'
+        ]
+    ],
+    skip_buttons: [
+        '.ytp-ad-skip-button',
+        '.videoAdUiSkipButton',
+        '[id^="skip-button"]',
+        '.ytp-ad-skip-button-modern'
+    ]
+};
+let adRules = DEFAULT_AD_RULES;
+
+chrome.storage.local.get(['adRules'], (result) => applyAdRules(result.adRules));
+chrome.storage.onChanged.addListener((changes, areaName) => {
+    if (areaName === 'local' && changes.adRules) {
+        applyAdRules(changes.adRules.newValue);
+    }
+});
+
+function applyAdRules(bundle) {
+    adRules = (bundle && bundle.services && bundle.services.youtube) || DEFAULT_AD_RULES;
+}
+
+function findFirst(selectors) {
+    for (const selector of selectors || []) {
+        try {
+            const element = document.querySelector(selector);
+            if (element) return element;
+        } catch (error) {
+            // Not a selector this browser understands; try the next one.
+        }
+    }
+    return null;
+}
+
+function adMarkersPresent() {
+    return adRules.ad_markers.every((group) => findFirst(group));
+}
+
 chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
     if (request.action === 'updateAdMuterState') {
         isAdMuterEnabled = request.enabled;
@@ -29,18 +83,11 @@ function checkForYouTubeAds() {
     if (!isAdMuterEnabled) return;
 
     try {
-        const adOverlay = document.querySelector('.ytp-ad-player-overlay, .video-ads.ytp-ad-module');
-        const skipButton = document.querySelector('.ytp-ad-skip-button, .videoAdUiSkipButton, [id^="skip-button"], .ytp-ad-skip-button-modern');
-        const adText = document.querySelector('.ytp-ad-text, .videoAdUiAttribution, .ytp-ad-preview-text');
-        const adDisplayContainer = document.querySelector('.ad-showing, .ytp-ad-overlay-container');
-
-        const newAdPlaying = !!(adOverlay && (skipButton || adText || adDisplayContainer));
+        const skipButton = findFirst(adRules.skip_buttons);
+        const newAdPlaying = adMarkersPresent();
 
         console.log('Checking for ads:', { 
-            adOverlay: !!adOverlay, 
             skipButton: !!skipButton, 
-            adText: !!adText,
-            adDisplayContainer: !!adDisplayContainer,
             newAdPlaying: newAdPlaying,
             currentAdPlayingState: isAdPlaying
         });
@@ -183,7 +230,7 @@ function initAdDetection() {
     const config = { childList: true, subtree: true };
 
     function observePlayer() {
-        const playerContainer = document.querySelector('#player-container') || document.body;
+        const playerContainer = findFirst([adRules.player]) || document.body;
         if (playerContainer) {
             console.log('Player container found, initializing ad detection');
             adObserver.observe(playerContainer, config);